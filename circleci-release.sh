@@ -49,6 +49,14 @@ mv ${name} ${CIRCLE_ARTIFACTS}/${name} || exit 2
 s3artifact -bucket $AWS_BUCKET -name v${release}/${name} ${CIRCLE_ARTIFACTS}/${name}
 s3artifact -bucket $AWS_BUCKET -name LATEST/${name} ${CIRCLE_ARTIFACTS}/${name}
 
+# dependencies are built into a separate layer zip, when botocore can publish layers
+layer=ebs_snapper_layer.zip
+if [[ -f ${layer} ]]; then
+  mv ${layer} ${CIRCLE_ARTIFACTS}/${layer} || exit 2
+  s3artifact -bucket $AWS_BUCKET -name v${release}/${layer} ${CIRCLE_ARTIFACTS}/${layer}
+  s3artifact -bucket $AWS_BUCKET -name LATEST/${layer} ${CIRCLE_ARTIFACTS}/${layer}
+fi
+
 aws_endpoint=https://s3.amazonaws.com/${AWS_BUCKET}
 # Check for official release ie v0.5.1 not v0.5.1-kj34kdf
 if [[ $release =~ ^([0-9]+).([0-9]+).([0-9]+)$ ]]; then
@@ -22,40 +22,45 @@
 """Module for cleaning up snapshots."""
 
 from __future__ import print_function
-from time import sleep
 from datetime import timedelta
 import datetime
-import json
+import functools
 import logging
-from ebs_snapper import utils, dynamo, timeout_check
+from ebs_snapper import utils, dispatch, dynamo, hub, regional, throttle, work, timeout_check
 
 LOG = logging.getLogger()
 
 
-def perform_fanout_all_regions(context, cli=False):
+def perform_fanout_all_regions(context, cli=False, installed_region='us-east-1', run=None):
     """For every region, run the supplied function"""
-    # get regions, regardless of instances
-    sns_topic = utils.get_topic_arn('CleanSnapshotTopic')
-    LOG.debug('perform_fanout_all_regions using SNS topic %s', sns_topic)
-
-    regions = utils.get_regions(must_contain_instances=True)
-    for region in regions:
-        sleep(5)  # API limit relief
-        send_fanout_message(context, region=region, topic_arn=sns_topic, cli=cli)
+    hub.fanout_accounts(context, installed_region, functools.partial(
+        perform_fanout_account, context, cli=cli, installed_region=installed_region, run=run))
 
     LOG.info('Function clean_perform_fanout_all_regions completed')
 
 
-def send_fanout_message(context, region, topic_arn, cli=False):
-    """Publish an SNS message to topic_arn that specifies a region to review snapshots on"""
-    message = json.dumps({'region': region})
-    LOG.debug('send_fanout_message: %s', message)
+def perform_fanout_account(context, member, cli=False, installed_region='us-east-1', run=None):
+    """For every region of this account, or a hub's member, send a message or clean up"""
+    configurations = dynamo.load_configurations(context, installed_region)
+    regions = regional.get_regions(must_contain_instances=True, configurations=configurations,
+                                   select=run.select if run is not None else None)
 
-    if cli:
-        clean_snapshot(context, region)
-    else:
-        utils.sns_publish(TopicArn=topic_arn, Message=message)
-    LOG.info('Function clean_send_fanout_message completed')
+    # the CLI may only do some regions, each with its own deadline
+    local_handler = functools.partial(perform_fanout_message, context)
+    if run is not None:
+        regions, local_handler = run.prepare(regions, configurations,
+                                             perform_fanout_message, context)
+
+    # send the configurations along, so every region works from the same ones
+    payload = None if cli else dynamo.build_payload(context, installed_region)
+    dispatch.fanout('clean', regions, configurations, local_handler,
+                    cli=cli, installed_region=installed_region, payload=payload,
+                    member=member, run=run)
+
+
+def perform_fanout_message(context, message):
+    """Clean up snapshots for the region in a fanout message, in this process"""
+    clean_snapshot(context, message['region'])
 
 
 def clean_snapshot(context, region, default_min_snaps=5, installed_region='us-east-1'):
@@ -63,8 +68,9 @@ def clean_snapshot(context, region, default_min_snaps=5, installed_region='us-ea
     LOG.info('clean_snapshot in region %s', region)
 
     # fetch these, in case we need to figure out what applies to an instance
-    configurations = dynamo.list_configurations(context, installed_region)
+    configurations = dynamo.load_configurations(context, installed_region)
     LOG.debug('Fetched all possible configuration rules from DynamoDB')
+    throttle.configure(utils.get_configuration_setting(configurations, 'api_rates'))
 
     # build a list of any IDs (anywhere) that we should ignore
     ignore_ids = utils.build_ignore_list(configurations)
@@ -87,6 +93,7 @@ def clean_snapshot(context, region, default_min_snaps=5, installed_region='us-ea
 
     # setup counters before we start
     deleted_count = 0
+    queue = work.WorkQueue(context, configurations, installed_region)
 
     # setup our filters
     filters = [
@@ -169,9 +176,12 @@ def clean_snapshot(context, region, default_min_snaps=5, installed_region='us-ea
                      delete_on,
                      log_snapcount,
                      minimum_snaps)
-            deleted_count += utils.delete_snapshot(snap['SnapshotId'], region)
+            deleted_count += queue.submit(work.delete_item(snap['SnapshotId'], region)) or 0
 
-    if deleted_count <= 0:
+    queue.flush()
+    if queue.queued > 0:
+        LOG.info('Queued %s snapshot deletions in %s', queue.queued, region)
+    elif deleted_count <= 0:
         LOG.warn('No snapshots were cleaned up for the entire region %s', region)
     else:
         LOG.info('Function clean_snapshots_tagged completed, deleted count: %s', str(deleted_count))
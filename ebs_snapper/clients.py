@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2016 Rackspace US, Inc.
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+"""Module for shared AWS clients, remembered lookups, and which account they work in."""
+
+from __future__ import print_function
+import logging
+import os
+import time
+import boto3
+import botocore.session
+from botocore.credentials import RefreshableCredentials
+from ebs_snapper import throttle, runtime
+
+LOG = logging.getLogger()
+
+# at least as large as our largest worker pool, so threads don't wait on connections
+MAX_POOL_CONNECTIONS = int(os.environ.get('EBS_SNAPPER_MAX_POOL_CONNECTIONS', 25))
+
+# control-plane lookups (owner, topics, rules) are remembered this long, in seconds
+DISCOVERY_TTL = int(os.environ.get('EBS_SNAPPER_DISCOVERY_TTL', 3600))
+
+# set by the CloudFormation template, so Lambda doesn't have to look up the owner at all
+OWNER_ID_ENV = 'EBS_SNAPPER_OWNER_ID'
+
+# other accounts are reached by assuming a role in them, for this long at a time
+ROLE_SESSION_NAME = 'ebs-snapper'
+ROLE_SESSION_SECONDS = int(os.environ.get('EBS_SNAPPER_ROLE_SESSION_SECONDS', 3600))
+
+# in hub mode, only these go to the member account being worked on, the rest stay here
+MEMBER_SERVICES = ['ec2']
+
+# every AWS call goes through the shared rate limiter, instead of fixed sleeps
+throttle.install()
+
+# clients are shared by every thread, and survive across warm Lambda invocations
+_CLIENTS = runtime.STATE.clients
+_CLIENTS_LOCK = runtime.STATE.clients_lock
+
+# (expires, value) for each control-plane lookup, also kept across warm invocations
+_DISCOVERED = runtime.STATE.discovered
+_DISCOVERED_LOCK = runtime.STATE.discovered_lock
+
+
+def get_client(service, region_name=None):
+    """Return the shared boto3 client for (service, region), creating it on first use"""
+    return _get_shared('client', service, region_name)
+
+
+def get_resource(service, region_name=None):
+    """Return the shared boto3 resource for (service, region), creating it on first use"""
+    return _get_shared('resource', service, region_name)
+
+
+def _get_shared(kind, service, region_name):
+    """Find or build a client or resource, boto3 clients are safe to share across threads"""
+    member = runtime.STATE.member if service in MEMBER_SERVICES else None
+    key = (kind, service, region_name)
+    session = boto3
+    if member is not None:
+        key = key + (member[0],)
+        session = member_session(*member)
+
+    with _CLIENTS_LOCK:
+        if key not in _CLIENTS:
+            factory = session.client if kind == 'client' else session.resource
+            _CLIENTS[key] = factory(
+                service,
+                region_name=region_name,
+                config=throttle.client_config(max_pool_connections=MAX_POOL_CONNECTIONS))
+
+        return _CLIENTS[key]
+
+
+def reset_clients():
+    """Forget every shared client, e.g. after credentials change"""
+    with _CLIENTS_LOCK:
+        _CLIENTS.clear()
+
+
+def discover(key, lookup, ttl=None):
+    """Return a remembered control-plane value for key, or call lookup() to find it"""
+    now = time.time()
+    with _DISCOVERED_LOCK:
+        if key in _DISCOVERED and _DISCOVERED[key][0] > now:
+            return _DISCOVERED[key][1]
+
+    value = lookup()
+
+    # don't remember a miss, it may well be there next time
+    if value:
+        with _DISCOVERED_LOCK:
+            _DISCOVERED[key] = (now + (DISCOVERY_TTL if ttl is None else ttl), value)
+
+    return value
+
+
+def reset_discovery():
+    """Forget every remembered control-plane value"""
+    with _DISCOVERED_LOCK:
+        _DISCOVERED.clear()
+
+
+def role_arn_for(aws_account_id, role_name):
+    """The ARN of a role by name in another account"""
+    return 'arn:aws:iam::{}:role/{}'.format(aws_account_id, role_name)
+
+
+def assume_role(role_arn):
+    """Temporary credentials for a role, always assumed from our own credentials"""
+    sts_client = boto3.session.Session().client('sts')
+    return sts_client.assume_role(
+        RoleArn=role_arn,
+        RoleSessionName=ROLE_SESSION_NAME,
+        DurationSeconds=ROLE_SESSION_SECONDS)['Credentials']
+
+
+def role_session(role_arn):
+    """A botocore session in role_arn, assuming it again whenever its credentials near expiry"""
+    def refresh():
+        """Credentials for the role, as botocore wants them"""
+        credentials = assume_role(role_arn)
+        return {
+            'access_key': credentials['AccessKeyId'],
+            'secret_key': credentials['SecretAccessKey'],
+            'token': credentials['SessionToken'],
+            'expiry_time': credentials['Expiration'].isoformat(),
+        }
+
+    session = botocore.session.get_session()
+    # pylint: disable=protected-access
+    session._credentials = RefreshableCredentials.create_from_metadata(
+        refresh(), refresh, 'assume-role')
+    return session
+
+
+def use_member(aws_account_id=None, role_arn=None):
+    """Send EC2 work to a member account (hub mode), or back to this account with None
+
+    Unlike use_account, only MEMBER_SERVICES clients change, so the hub's own
+    table, topics and queues are still used. It applies to the whole process,
+    so members must be worked on one at a time.
+    """
+    if aws_account_id is None:
+        runtime.STATE.member = None
+    else:
+        runtime.STATE.member = (str(aws_account_id), role_arn)
+
+
+def current_member():
+    """The member account EC2 work goes to, or None if it's this account"""
+    member = runtime.STATE.member
+    return member[0] if member is not None else None
+
+
+def member_session(aws_account_id, role_arn):
+    """A boto3 session in a member account, reused until its credentials are nearly expired"""
+    now = time.time()
+    with _CLIENTS_LOCK:
+        cached = runtime.STATE.member_sessions.get(aws_account_id)
+        if cached is not None and cached[0] > now:
+            return cached[1]
+
+    credentials = assume_role(role_arn)
+    session = boto3.session.Session(
+        aws_access_key_id=credentials['AccessKeyId'],
+        aws_secret_access_key=credentials['SecretAccessKey'],
+        aws_session_token=credentials['SessionToken'])
+    throttle.install(session)
+
+    with _CLIENTS_LOCK:
+        # clients built from the old credentials go with them
+        for key in [k for k in _CLIENTS if len(k) > 3 and k[3] == aws_account_id]:
+            del _CLIENTS[key]
+
+        expires = now + max(ROLE_SESSION_SECONDS - 300, 60)
+        runtime.STATE.member_sessions[aws_account_id] = (expires, session)
+
+    return session
+
+
+def use_account(aws_account_id, role_arn=None):
+    """Point this whole process at another account, by assuming role_arn there
+
+    Every shared client, remembered lookup and cached configuration belongs
+    to the previous account, so all of it is forgotten. Without a role_arn,
+    the process goes back to its own credentials. An account may be worked
+    on for longer than ROLE_SESSION_SECONDS, so the role is assumed again
+    as needed.
+    """
+    if role_arn is None:
+        boto3.setup_default_session()
+    else:
+        boto3.setup_default_session(botocore_session=role_session(role_arn))
+
+    # the new default session needs pacing and retries like the last one
+    throttle.install()
+    runtime.STATE.reset()
+    if aws_account_id is None:
+        os.environ.pop(OWNER_ID_ENV, None)
+    else:
+        os.environ[OWNER_ID_ENV] = str(aws_account_id)
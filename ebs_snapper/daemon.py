@@ -0,0 +1,369 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2016 Rackspace US, Inc.
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+"""Module for running the fanout jobs on their schedules, in one long-lived process."""
+
+from __future__ import print_function
+import collections
+import datetime
+import json
+import logging
+import re
+import signal
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+import dateutil
+from ebs_snapper import snapshot, clean, replication, runtime, utils
+
+LOG = logging.getLogger()
+
+# the same schedules a CloudFormation installation gets (see deploy.DEFAULT_STACK_PARAMS)
+JOB_NAMES = ['snapshot', 'clean', 'replication']
+DEFAULT_SCHEDULES = {
+    'snapshot': 'rate(30 minutes)',
+    'clean': 'rate(6 hours)',
+    'replication': 'rate(30 minutes)',
+}
+DISABLED_SCHEDULE = 'off'
+
+DEFAULT_JOB_TIMEOUT = 90  # minutes, the same as a single CLI run
+DEFAULT_STATUS_ADDRESS = '127.0.0.1'
+DEFAULT_STATUS_PORT = 8642
+
+HEARTBEAT_SECONDS = 5  # the loop wakes at least this often
+STALE_SECONDS = 60  # a loop that hasn't woken for this long is stuck
+
+RATE_EXPRESSION = re.compile(r'^rate\((\d+) (minutes?|hours?|days?)\)$')
+CRON_EXPRESSION = re.compile(r'^cron\((.+)\)$')
+RATE_SECONDS = {'minute': 60, 'hour': 3600, 'day': 86400}
+
+
+def parse_schedule(expression):
+    """Turn a CloudWatch schedule expression into a function of now, giving the next run
+
+    Times are seconds since the epoch. A rate counts from when the last run
+    started, and a run that was missed (the one before took too long)
+    happens once, late, as it would with a CloudWatch rule.
+    """
+    expression = expression.strip()
+    match = RATE_EXPRESSION.match(expression)
+    if match:
+        seconds = int(match.group(1)) * RATE_SECONDS[match.group(2).rstrip('s')]
+        if seconds <= 0:
+            raise Exception('Schedule {} would never wait between runs'.format(expression))
+        return lambda now: now + seconds
+
+    match = CRON_EXPRESSION.match(expression)
+    if match:
+        from crontab import CronTab
+        try:
+            # CloudWatch writes ? where cron writes *
+            cron = CronTab(match.group(1).replace('?', '*'))
+        except ValueError as e:
+            raise Exception('Could not parse schedule {}: {}'.format(expression, e))
+
+        def next_cron(now):
+            """The next time the cron expression matches, after now"""
+            when = datetime.datetime.fromtimestamp(now, dateutil.tz.tzutc())
+            return now + cron.next(when, default_utc=True)
+
+        return next_cron
+
+    raise Exception('Could not parse schedule {}, expected rate(...) or cron(...)'.format(
+        expression))
+
+
+LastRun = collections.namedtuple('LastRun', ['started', 'seconds', 'error'])
+
+
+class Job(object):
+    """One fanout job, its schedule, and how its runs have gone"""
+
+    def __init__(self, name, fanout, schedule, now=None):
+        self.name = name
+        self.fanout = fanout
+        self.schedule = schedule
+        parse_schedule(schedule)  # a bad schedule fails now, not after the first run
+        self.next_run = time.time() if now is None else now  # every job runs once at start
+        self.runs = 0
+        self.failures = 0
+        self.last = LastRun(None, None, None)
+
+    def due(self, now=None):
+        """Whether the job should run now"""
+        return self.next_run <= (time.time() if now is None else now)
+
+    def finished(self, started, error):
+        """Record a run, and when the next one is due"""
+        self.runs += 1
+        self.last = LastRun(started, time.time() - started, error)
+        if error is not None:
+            self.failures += 1
+        self.next_run = parse_schedule(self.schedule)(started)
+
+
+def build_jobs(schedules):
+    """A Job for every fanout job whose schedule isn't off, in the usual order"""
+    fanouts = {
+        'snapshot': snapshot.perform_fanout_all_regions,
+        'clean': clean.perform_fanout_all_regions,
+        'replication': replication.perform_fanout_all_regions,
+    }
+
+    jobs = []
+    for name in JOB_NAMES:
+        schedule = schedules.get(name) or DEFAULT_SCHEDULES[name]
+        if schedule.strip().lower() == DISABLED_SCHEDULE:
+            LOG.info('Job %s is off', name)
+            continue
+        jobs.append(Job(name, fanouts[name], schedule))
+
+    if len(jobs) <= 0:
+        raise Exception('Every job is off, so there is nothing to run')
+
+    return jobs
+
+
+# the loop's state is shared with the status server thread under one lock, so it stays together
+class Daemon(object):  # pylint: disable=too-many-instance-attributes
+    """Runs jobs one at a time as they come due, until stopped
+
+    Everything in runtime.STATE stays warm from one run to the next: clients,
+    the owner id and regions (until their TTLs pass), and configurations,
+    which are only read again when their version changes. Each run gets its
+    own deadline and a fresh RegionRun from build_run, and a failed run
+    forgets that state, in case what broke it was something remembered.
+    """
+
+    def __init__(self, jobs, installed_region='us-east-1', job_timeout=DEFAULT_JOB_TIMEOUT,
+                 build_run=None):
+        self.jobs = jobs
+        self.installed_region = installed_region
+        self.job_timeout = job_timeout
+        self.build_run = build_run or (lambda: None)
+        self.stopping = threading.Event()
+        self.started = time.time()
+        self.heartbeat = self.started
+        self.running = None
+        self.context = None
+        self.lock = threading.Lock()
+
+    def run_forever(self):
+        """Run jobs as they come due, until stop() is called"""
+        LOG.info('Daemon running %s', ', '.join(
+            '{} {}'.format(j.name, j.schedule) for j in self.jobs))
+        while not self.stopping.is_set():
+            self.heartbeat = time.time()
+            self.run_due()
+
+            wait = min(j.next_run for j in self.jobs) - time.time()
+            self.stopping.wait(min(max(wait, 0), HEARTBEAT_SECONDS))
+
+        LOG.info('Daemon stopped')
+
+    def run_due(self):
+        """Run every job that is due, the longest overdue first"""
+        for job in sorted(self.jobs, key=lambda j: j.next_run):
+            if self.stopping.is_set():
+                return
+            if job.due():
+                self.run_job(job)
+                self.heartbeat = time.time()
+
+    def run_job(self, job):
+        """Run one job with its own deadline, recording how it went"""
+        context = utils.DaemonContext()
+        context.set_remaining_time_in_millis(60000 * self.job_timeout)
+        run = self.build_run()
+        started = time.time()
+        with self.lock:
+            self.running = job
+            self.context = context
+
+        LOG.info('Job %s starting', job.name)
+        error = None
+        try:
+            job.fanout(context, cli=True, installed_region=self.installed_region, run=run)
+            failures = run.failures() if run is not None else []
+            if len(failures) > 0:
+                error = '{} of {} regions failed: {}'.format(
+                    len(failures), len(run.results), ', '.join(sorted(failures)))
+        except Exception as e:  # pylint: disable=broad-except
+            LOG.exception('Job %s failed', job.name)
+            error = str(e) or e.__class__.__name__
+
+        if error is not None:
+            LOG.warn('Job %s failed: %s', job.name, error)
+            runtime.STATE.reset()
+
+        with self.lock:
+            self.running = None
+            self.context = None
+            job.finished(started, error)
+
+        LOG.info('Job %s finished in %.1fs, next run at %s', job.name, job.last.seconds,
+                 timestamp(job.next_run))
+
+    def stop(self):
+        """Stop after the running job, which is told its time is up"""
+        self.stopping.set()
+        with self.lock:
+            if self.context is not None:
+                self.context.set_remaining_time_in_millis(0)
+
+    def healthy(self, now=None):
+        """Check the loop is still going: waking up, or running a job within its deadline"""
+        now = time.time() if now is None else now
+        if self.stopping.is_set():
+            return False
+
+        with self.lock:
+            if self.running is not None:
+                return now - self.heartbeat <= 60 * self.job_timeout + STALE_SECONDS
+            return now - self.heartbeat <= STALE_SECONDS
+
+    def status(self):
+        """Everything /health reports, as a dict"""
+        with self.lock:
+            running = self.running.name if self.running is not None else None
+
+        jobs = {}
+        for job in self.jobs:
+            jobs[job.name] = {
+                'schedule': job.schedule,
+                'runs': job.runs,
+                'failures': job.failures,
+                'last_started': timestamp(job.last.started),
+                'last_seconds': job.last.seconds,
+                'last_error': job.last.error,
+                'next_run': timestamp(job.next_run),
+            }
+
+        return {
+            'healthy': self.healthy(),
+            'uptime_seconds': int(time.time() - self.started),
+            'running': running,
+            'jobs': jobs,
+        }
+
+    def metrics(self):
+        """Everything /metrics reports, in the Prometheus text format"""
+        with self.lock:
+            running = self.running
+
+        lines = []
+
+        def metric(name, kind, text, values):
+            """Add one metric, given (labels, value) pairs"""
+            lines.append('# HELP ebs_snapper_{} {}'.format(name, text))
+            lines.append('# TYPE ebs_snapper_{} {}'.format(name, kind))
+            for labels, value in values:
+                lines.append('ebs_snapper_{}{} {}'.format(name, labels, value))
+
+        def per_job(get):
+            """(labels, value) for every job with a value"""
+            return [('{{job="{}"}}'.format(j.name), get(j)) for j in self.jobs
+                    if get(j) is not None]
+
+        metric('daemon_healthy', 'gauge', 'Whether the daemon loop is still going.',
+               [('', int(self.healthy()))])
+        metric('daemon_uptime_seconds', 'gauge', 'Seconds since the daemon started.',
+               [('', int(time.time() - self.started))])
+        metric('job_runs_total', 'counter', 'Runs of each job.',
+               per_job(lambda j: j.runs))
+        metric('job_failures_total', 'counter', 'Runs of each job that failed.',
+               per_job(lambda j: j.failures))
+        metric('job_running', 'gauge', 'Whether each job is running now.',
+               per_job(lambda j: int(j is running)))
+        metric('job_last_duration_seconds', 'gauge', 'How long the last run of each job took.',
+               per_job(lambda j: j.last.seconds))
+        metric('job_last_start_timestamp_seconds', 'gauge', 'When the last run of each job began.',
+               per_job(lambda j: j.last.started))
+        metric('job_next_run_timestamp_seconds', 'gauge', 'When each job is next due.',
+               per_job(lambda j: j.next_run))
+        metric('cached_clients', 'gauge', 'AWS clients kept warm between runs.',
+               [('', len(runtime.STATE.clients))])
+        metric('cached_configurations', 'gauge', 'Accounts whose configurations are kept warm.',
+               [('', len(runtime.STATE.configurations))])
+
+        return '\n'.join(lines) + '\n'
+
+
+def timestamp(seconds):
+    """Seconds since the epoch as an ISO 8601 UTC time, or None"""
+    if seconds is None:
+        return None
+    return datetime.datetime.utcfromtimestamp(seconds).isoformat() + 'Z'
+
+
+class StatusHandler(BaseHTTPRequestHandler):
+    """Answers /health (JSON, 503 when unhealthy) and /metrics (Prometheus text)"""
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """Report on the server's daemon"""
+        snapper = self.server.snapper
+        if self.path == '/health':
+            status = snapper.status()
+            self.respond(200 if status['healthy'] else 503, 'application/json',
+                         json.dumps(status, sort_keys=True) + '\n')
+        elif self.path == '/metrics':
+            self.respond(200, 'text/plain; version=0.0.4', snapper.metrics())
+        else:
+            self.respond(404, 'text/plain', 'Not found, try /health or /metrics\n')
+
+    def respond(self, code, content_type, body):
+        """Send a whole response"""
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        """Log requests quietly, instead of to stderr"""
+        LOG.debug('Status request: ' + format, *args)
+
+
+def start_status_server(snapper, address=DEFAULT_STATUS_ADDRESS, port=DEFAULT_STATUS_PORT):
+    """Answer status requests about snapper on a background thread, returning the server"""
+    server = HTTPServer((address, port), StatusHandler)
+    server.snapper = snapper
+    thread = threading.Thread(target=server.serve_forever, name='ebs-snapper-status')
+    thread.daemon = True
+    thread.start()
+
+    LOG.info('Status endpoint listening on %s:%s', *server.server_address)
+    return server
+
+
+def serve(snapper, address=DEFAULT_STATUS_ADDRESS, port=DEFAULT_STATUS_PORT):
+    """Run snapper until SIGTERM or Ctrl-C, with a status endpoint unless port is 0"""
+    server = start_status_server(snapper, address, port) if port else None
+    signal.signal(signal.SIGTERM, lambda *_: snapper.stop())
+    try:
+        snapper.run_forever()
+    except KeyboardInterrupt:
+        snapper.stop()
+    finally:
+        if server is not None:
+            server.shutdown()
+            server.server_close()
@@ -27,13 +27,22 @@ import logging
 import time
 import hashlib
 import base64
+import glob
+import imp
+import marshal
+import os
+import re
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import zipfile
 
-import boto3
 from botocore.exceptions import ClientError
-from lambda_uploader import package as lu_package
 
 import ebs_snapper
-from ebs_snapper import utils, dynamo
+from ebs_snapper import clients, regional, utils, dynamo
 
 LOG = logging.getLogger()
 DEFAULT_REGION = 'us-east-1'
@@ -45,8 +54,36 @@ STACK_FATAL_STATUS = ['CREATE_FAILED', 'ROLLBACK_IN_PROGRESS',
                       'UPDATE_ROLLBACK_IN_PROGRESS',
                       'UPDATE_ROLLBACK_COMPLETE_CLEANUP_IN_PROGRESS']
 STACK_SUCCESS_STATUS = ['CREATE_COMPLETE', 'UPDATE_COMPLETE']
-IGNORED_UPLOADER_FILES = ["circle.yml", ".git", "/*.pyc", "\\.cache",
-                          "\\.json$", "\\.sh$", "\\.zip$"]
+
+# the function artifact only carries what runs in Lambda, precompiled
+FUNCTION_ZIP = 'ebs_snapper.zip'
+LAYER_ZIP = 'ebs_snapper_layer.zip'
+LAYER_NAME = 'ebs-snapper-dependencies'
+LAYER_RUNTIMES = ['python2.7']
+NON_RUNTIME_MODULES = ['deploy.py', 'shell.py', 'mocks.py', 'daemon.py',
+                       'inventory.py']
+NON_RUNTIME_REQUIREMENTS = ['boto', 'lambda-uploader']
+ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)  # fixed, so unchanged code builds an identical zip
+
+# sanity checks take one inventory of each region, this many regions at a time
+SANITY_CHECK_WORKERS = int(os.environ.get('EBS_SNAPPER_SANITY_CHECK_WORKERS', 8))
+INVENTORY_KEYS = ['InstanceId', 'InstanceType', 'ImageId', 'KeyName', 'Placement',
+                  'State', 'SubnetId', 'VpcId', 'Tags']
+
+# describe_instances filters that sanity checks can evaluate against an inventory
+LOCAL_INSTANCE_FILTERS = {
+    'instance-id': lambda i: [i.get('InstanceId')],
+    'instance-type': lambda i: [i.get('InstanceType')],
+    'image-id': lambda i: [i.get('ImageId')],
+    'key-name': lambda i: [i.get('KeyName')],
+    'subnet-id': lambda i: [i.get('SubnetId')],
+    'vpc-id': lambda i: [i.get('VpcId')],
+    'availability-zone': lambda i: [i.get('Placement', {}).get('AvailabilityZone')],
+    'instance-state-name': lambda i: [i.get('State', {}).get('Name')],
+    'tag-key': lambda i: [t['Key'] for t in i.get('Tags', [])],
+    'tag-value': lambda i: [t['Value'] for t in i.get('Tags', [])],
+}
+
 DEFAULT_STACK_PARAMS = [
     {'ParameterKey': 'WatchdogRegion',
      'ParameterValue': 'us-east-1', 'UsePreviousValue': False},
@@ -65,18 +102,22 @@ DEFAULT_STACK_PARAMS = [
     {'ParameterKey': 'LambdaMemoryClean',
      'ParameterValue': '256', 'UsePreviousValue': False},
     {'ParameterKey': 'LambdaMemoryReplication',
-     'ParameterValue': '256', 'UsePreviousValue': False}
+     'ParameterValue': '256', 'UsePreviousValue': False},
+    {'ParameterKey': 'WorkItemConcurrency',
+     'ParameterValue': '10', 'UsePreviousValue': False}
 ]
 
 
-def deploy(context, aws_account_id=None, no_build=None, no_upload=None, no_stack=None):
+def deploy(context, aws_account_id=None, no_build=None, no_upload=None, no_stack=None,
+           hub=None):
     """Main function that does the deploy to an aws account"""
     # lambda-uploader configuration step
 
-    lambda_zip_filename = 'ebs_snapper.zip'
+    lambda_zip_filename = FUNCTION_ZIP
+
+    use_layer = layers_supported()
     if not no_build:
-        LOG.info("Building package using lambda-uploader")
-        build_package(lambda_zip_filename)
+        build(lambda_zip_filename, use_layer)
 
     # get security credentials from EC2 API, if we are going to use them
     needs_owner_id = (not no_upload) or (not no_stack)
@@ -95,13 +136,17 @@ def deploy(context, aws_account_id=None, no_build=None, no_upload=None, no_stack
         else:
             aws_account = found_owners[0]
 
-        # freshen the S3 bucket
+        # freshen the S3 bucket, and the layer if requirements changed
+        layer_arn = None
         if not no_upload:
             ebs_bucket_name = create_or_update_s3_bucket(aws_account, lambda_zip_filename)
+            if use_layer and os.path.exists(LAYER_ZIP):
+                layer_arn = publish_layer(ebs_bucket_name, LAYER_ZIP)
 
         # freshen the stack
         if not no_stack:
-            create_or_update_stack(aws_account, DEFAULT_REGION, ebs_bucket_name)
+            create_or_update_stack(aws_account, DEFAULT_REGION, ebs_bucket_name, layer_arn,
+                                   hub=hub)
 
     # freshen up lambda jobs themselves
     if not no_upload:
@@ -112,7 +157,7 @@ def deploy(context, aws_account_id=None, no_build=None, no_upload=None, no_stack
 def create_or_update_s3_bucket(aws_account, lambda_zip_filename):
     """Ensure the S3 bucket exists, then upload CF and Lambda files"""
     # ensure S3 bucket exists
-    s3_client = boto3.client('s3', region_name=DEFAULT_REGION)
+    s3_client = clients.get_client('s3', DEFAULT_REGION)
     ebs_bucket_name = 'ebs-snapper-{}'.format(aws_account)
     LOG.info("Creating S3 bucket %s if it doesn't exist", ebs_bucket_name)
     s3_client.create_bucket(
@@ -123,45 +168,214 @@ def create_or_update_s3_bucket(aws_account, lambda_zip_filename):
     LOG.info("Uploading files into S3 bucket")
     upload_files = ['cloudformation.json', lambda_zip_filename]
     for filename in upload_files:
+        upload_file(s3_client, ebs_bucket_name, filename)
 
-        local_hash = None
-        try:
-            local_hash = md5sum(filename).strip('"')
-        except:
-            raise
+    return ebs_bucket_name
 
-        try:
-            # check if file in bucket is already there and up to date
-            object_summary = s3_client.get_object(Bucket=ebs_bucket_name, Key=filename)
 
-            remote_hash = object_summary['ETag'].strip('"')
+def upload_file(s3_client, ebs_bucket_name, filename):
+    """Upload a file to the bucket, unless it's already there and up to date"""
+    local_hash = md5sum(filename).strip('"')
+
+    try:
+        # check if file in bucket is already there and up to date
+        object_summary = s3_client.get_object(Bucket=ebs_bucket_name, Key=filename)
+
+        remote_hash = object_summary['ETag'].strip('"')
+
+        LOG.debug("Local file MD5 sum: %s", str(local_hash))
+        LOG.debug("ETag from AWS: %s", str(remote_hash))
+
+        if local_hash == remote_hash:
+            LOG.info("Skipping upload of %s, already up-to-date in S3", filename)
+            return
+    except:
+        LOG.info("Failed to checksum remote file %s, uploading it anyway", filename)
+
+    with open(filename, 'rb') as data:
+        LOG.info('Uploading %s to bucket %s', filename, ebs_bucket_name)
+        s3_client.put_object(Bucket=ebs_bucket_name, Key=filename, Body=data)
+
+
+def build(lambda_zip_filename=FUNCTION_ZIP, use_layer=None):
+    """Build the function package, and the dependency layer if its requirements changed"""
+    # without Lambda layers, dependencies have to go in the function artifact
+    if use_layer is None:
+        use_layer = layers_supported()
 
-            LOG.debug("Local file MD5 sum: %s", str(local_hash))
-            LOG.debug("ETag from AWS: %s", str(remote_hash))
+    LOG.info("Building function package %s", lambda_zip_filename)
+    build_package(lambda_zip_filename, bundle_requirements=not use_layer)
+    if use_layer and not layer_is_current(LAYER_ZIP):
+        LOG.info("Requirements changed, building dependency layer %s", LAYER_ZIP)
+        build_layer(LAYER_ZIP)
 
-            if local_hash == remote_hash:
-                LOG.info("Skipping upload of %s, already up-to-date in S3", filename)
+
+def build_package(lambda_zip_filename, bundle_requirements=False, source_dir='.'):
+    """Build the function artifact: the runtime modules only, precompiled
+
+    Deploy and CLI tooling, tests and docs are left out. Dependencies are
+    only bundled in when there's no layer to carry them.
+    """
+    package_dir = os.path.join(source_dir, 'ebs_snapper')
+    zf = zipfile.ZipFile(lambda_zip_filename, 'w', zipfile.ZIP_DEFLATED)
+    try:
+        for path in sorted(glob.glob(os.path.join(package_dir, '*.py'))):
+            name = os.path.basename(path)
+            if name in NON_RUNTIME_MODULES:
                 continue
-        except:
-            LOG.info("Failed to checksum remote file %s, uploading it anyway", filename)
 
-        with open(filename, 'rb') as data:
-            LOG.info('Uploading %s to bucket %s', filename, ebs_bucket_name)
-            s3_client.put_object(Bucket=ebs_bucket_name, Key=filename, Body=data)
+            write_zip_entry(zf, 'ebs_snapper/{}c'.format(name), compile_module(path, name))
+
+        # the CloudFormation template's handlers are lambdas.<function>
+        lambdas_path = os.path.join(package_dir, 'lambdas.py')
+        write_zip_entry(zf, 'lambdas.pyc', compile_module(lambdas_path, 'lambdas.py'))
+
+        if bundle_requirements:
+            install_dir = install_requirements(os.path.join(source_dir, 'requirements.txt'))
+            try:
+                write_zip_tree(zf, install_dir, '')
+            finally:
+                shutil.rmtree(install_dir)
+    finally:
+        zf.close()
+
+    LOG.info('Built %s, %s bytes', lambda_zip_filename, os.path.getsize(lambda_zip_filename))
+
+
+def build_layer(layer_zip_filename, source_dir='.'):
+    """Build the dependency layer, tagged with the requirements it was built from"""
+    requirements_file = os.path.join(source_dir, 'requirements.txt')
+    install_dir = install_requirements(requirements_file)
+    zf = zipfile.ZipFile(layer_zip_filename, 'w', zipfile.ZIP_DEFLATED)
+    try:
+        # python runtimes find a layer's packages under python/
+        write_zip_tree(zf, install_dir, 'python/')
+        zf.comment = requirements_hash(requirements_file)
+    finally:
+        zf.close()
+        shutil.rmtree(install_dir)
+
+    LOG.info('Built %s, %s bytes', layer_zip_filename, os.path.getsize(layer_zip_filename))
+
+
+def layer_is_current(layer_zip_filename, source_dir='.'):
+    """True if the layer zip was built from the requirements we have now"""
+    if not os.path.exists(layer_zip_filename):
+        return False
+
+    zf = zipfile.ZipFile(layer_zip_filename)
+    try:
+        return zf.comment == requirements_hash(os.path.join(source_dir, 'requirements.txt'))
+    finally:
+        zf.close()
+
+
+def requirements_hash(requirements_file):
+    """Hash of the runtime requirements, which versions the dependency layer"""
+    return hashlib.sha256('\n'.join(runtime_requirements(requirements_file))).hexdigest()
+
+
+def runtime_requirements(requirements_file):
+    """The requirements Lambda needs, leaving out deploy-only ones"""
+    requirements = []
+    with open(requirements_file) as f:
+        for line in f:
+            line = line.split('#')[0].strip()
+            if not line:
+                continue
+
+            name = line.split('=')[0].split('<')[0].split('>')[0].strip().lower()
+            if name in NON_RUNTIME_REQUIREMENTS:
+                continue
+
+            requirements.append(line)
+
+    return sorted(requirements)
+
+
+def install_requirements(requirements_file):
+    """pip install the runtime requirements into a new temporary directory"""
+    install_dir = tempfile.mkdtemp(prefix='ebs_snapper_build_')
+    filtered = os.path.join(install_dir, 'requirements.txt')
+    with open(filtered, 'w') as f:
+        f.write('\n'.join(runtime_requirements(requirements_file)) + '\n')
+
+    subprocess.check_call([sys.executable, '-m', 'pip', 'install', '--quiet',
+                           '--target', install_dir, '-r', filtered])
+    os.remove(filtered)
+    return install_dir
+
+
+def compile_module(path, archive_name):
+    """Compile a module to .pyc bytes, with no source mtime to go stale"""
+    with open(path, 'rU') as f:
+        source = f.read()
+
+    code = compile(source + '\n', archive_name, 'exec')
+    return imp.get_magic() + struct.pack('<I', 0) + marshal.dumps(code)
+
+
+def write_zip_entry(zf, archive_name, data):
+    """Add data to the zip with a fixed timestamp, so builds are repeatable"""
+    info = zipfile.ZipInfo(archive_name, date_time=ZIP_DATE_TIME)
+    info.compress_type = zipfile.ZIP_DEFLATED
+    info.external_attr = 0o644 << 16
+    zf.writestr(info, data)
+
+
+def write_zip_tree(zf, root, prefix):
+    """Add every file under root to the zip, precompiling any python sources"""
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        dirnames[:] = [d for d in dirnames if not d.endswith('.dist-info') and d != 'tests']
+        for filename in sorted(filenames):
+            if filename.endswith('.pyc'):
+                continue
+
+            path = os.path.join(dirpath, filename)
+            archive_name = prefix + os.path.relpath(path, root).replace(os.sep, '/')
+            with open(path, 'rb') as f:
+                write_zip_entry(zf, archive_name, f.read())
+
+            if filename.endswith('.py'):
+                try:
+                    write_zip_entry(zf, archive_name + 'c', compile_module(path, archive_name))
+                except SyntaxError:
+                    LOG.debug('Not precompiling %s', archive_name)
 
-    return ebs_bucket_name
 
+def layers_supported():
+    """True if this botocore can publish Lambda layers"""
+    return hasattr(clients.get_client('lambda', DEFAULT_REGION), 'publish_layer_version')
+
+
+def publish_layer(ebs_bucket_name, layer_zip_filename):
+    """Return the ARN of the layer for these requirements, publishing it only if it's new"""
+    lambda_client = clients.get_client('lambda', DEFAULT_REGION)
+    zf = zipfile.ZipFile(layer_zip_filename)
+    try:
+        description = 'requirements {}'.format(zf.comment)
+    finally:
+        zf.close()
 
-def build_package(lambda_zip_filename):
-    """Given this project, package it using lambda_uploader"""
-    pkg = lu_package.Package('.', lambda_zip_filename)
-    pkg.clean_zipfile()
+    paginator = lambda_client.get_paginator('list_layer_versions')
+    for page in paginator.paginate(LayerName=LAYER_NAME):
+        for layer_version in page.get('LayerVersions', []):
+            if layer_version.get('Description') == description:
+                LOG.info('Layer %s is already up to date', layer_version['LayerVersionArn'])
+                return layer_version['LayerVersionArn']
 
-    # lambda-uploader step to build zip file
-    pkg.extra_file('ebs_snapper/lambdas.py')
-    pkg.requirements('requirements.txt')
-    pkg.build(IGNORED_UPLOADER_FILES)
-    pkg.clean_workspace()
+    s3_client = clients.get_client('s3', DEFAULT_REGION)
+    upload_file(s3_client, ebs_bucket_name, layer_zip_filename)
+
+    response = lambda_client.publish_layer_version(
+        LayerName=LAYER_NAME,
+        Description=description,
+        Content={'S3Bucket': ebs_bucket_name, 'S3Key': layer_zip_filename},
+        CompatibleRuntimes=LAYER_RUNTIMES)
+    LOG.info('Published dependency layer %s', response['LayerVersionArn'])
+
+    return response['LayerVersionArn']
 
 
 def wait_for_completion(cf_client, stack_name):
@@ -193,11 +407,14 @@ def wait_for_completion(cf_client, stack_name):
                 raise Exception('Stack was in a status I do not recognize', stack_data)
 
 
-def create_or_update_stack(aws_account, region, ebs_bucket_name):
-    """Handle creating or updating the ebs-snapper stack, and waiting"""
+def create_or_update_stack(aws_account, region, ebs_bucket_name, layer_arn=None, hub=None):
+    """Handle creating or updating the ebs-snapper stack, and waiting
+
+    hub turns HubMode on (True) or off (False), or leaves it as it was (None).
+    """
     # check for stack, create it if necessary
     stack_name = 'ebs-snapper-{}'.format(aws_account)
-    cf_client = boto3.client('cloudformation', region_name=region)
+    cf_client = clients.get_client('cloudformation', region)
 
     template_url = "https://s3.amazonaws.com/{}/cloudformation.json".format(ebs_bucket_name)
     try:
@@ -207,6 +424,16 @@ def create_or_update_stack(aws_account, region, ebs_bucket_name):
             'ParameterKey': 'LambdaS3Bucket',
             'ParameterValue': ebs_bucket_name,
             'UsePreviousValue': False})
+        if layer_arn:
+            DEFAULT_STACK_PARAMS.append({
+                'ParameterKey': 'LambdaLayerArn',
+                'ParameterValue': layer_arn,
+                'UsePreviousValue': False})
+        if hub is not None:
+            DEFAULT_STACK_PARAMS.append({
+                'ParameterKey': 'HubMode',
+                'ParameterValue': 'true' if hub else 'false',
+                'UsePreviousValue': False})
         response = cf_client.create_stack(
             StackName=stack_name,
             TemplateURL=template_url,
@@ -235,8 +462,23 @@ def create_or_update_stack(aws_account, region, ebs_bucket_name):
             # else we will get the default template value for this param
             params = []
             for k in es_param_keys:
+                if k == 'LambdaLayerArn' and layer_arn:
+                    continue
+                if k == 'HubMode' and hub is not None:
+                    continue
                 params.append({'ParameterKey': k, 'UsePreviousValue': True})
 
+            # a new dependency layer, for when requirements changed
+            if layer_arn:
+                params.append({'ParameterKey': 'LambdaLayerArn',
+                               'ParameterValue': layer_arn,
+                               'UsePreviousValue': False})
+
+            if hub is not None:
+                params.append({'ParameterKey': 'HubMode',
+                               'ParameterValue': 'true' if hub else 'false',
+                               'UsePreviousValue': False})
+
             response = cf_client.update_stack(
                 StackName=stack_name,
                 TemplateURL=template_url,
@@ -259,7 +501,7 @@ def create_or_update_stack(aws_account, region, ebs_bucket_name):
 
 def ensure_cloudwatch_logs_retention(aws_account):
     """Be sure retention values are set on CloudWatch Logs for this tool"""
-    cwlogs_client = boto3.client('logs', region_name=DEFAULT_REGION)
+    cwlogs_client = clients.get_client('logs', DEFAULT_REGION)
     loggroup_prefix = '/aws/lambda/ebs-snapper-{}-'.format(str(aws_account))
 
     list_groups = cwlogs_client.describe_log_groups(logGroupNamePrefix=loggroup_prefix)
@@ -277,7 +519,7 @@ def ensure_cloudwatch_logs_retention(aws_account):
 
 def update_function_and_version(ebs_bucket_name, lambda_zip_filename):
     """Re-publish lambda function and a new version based on our version"""
-    lambda_client = boto3.client('lambda', region_name=DEFAULT_REGION)
+    lambda_client = clients.get_client('lambda', DEFAULT_REGION)
     lambda_function_list = lambda_client.list_functions()
     lambda_function_map = dict()
     for entry in lambda_function_list['Functions']:
@@ -370,7 +612,7 @@ def sanity_check(context, installed_region='us-east-1', aws_account_id=None):
     # The bucket does not exist or you have no access
     bucket_exists = None
     try:
-        s3_client = boto3.client('s3', region_name=installed_region)
+        s3_client = clients.get_client('s3', installed_region)
         ebs_bucket_name = 'ebs-snapper-{}'.format(aws_account)
         s3_client.head_bucket(Bucket=ebs_bucket_name)
         bucket_exists = True
@@ -381,17 +623,34 @@ def sanity_check(context, installed_region='us-east-1', aws_account_id=None):
     configurations = []
     dynamodb_exists = None
     try:
-        configurations = dynamo.list_configurations(context, installed_region)
+        configurations = dynamo.list_configurations(context, installed_region,
+                                                    aws_account_id=aws_account)
         dynamodb_exists = True
     except ClientError:
         configurations = []
         dynamodb_exists = False
 
-    # we're going across all regions, but store these in one
-    regions = utils.get_regions(must_contain_instances=True)
+    # one paginated pass over each region's instances, every configuration is checked against it
+    regions = regional.get_regions(must_contain_instances=True, configurations=configurations)
+    inventories = dict(zip(regions, utils.map_concurrently(
+        instance_inventory, regions, SANITY_CHECK_WORKERS)))
+
     ignored_tag_values = ['false', '0', 'no']
     found_config_tag_values = []
-    found_backup_tag_values = []
+    found_backup_tags = []  # (key, value)
+
+    # Look at all the tags on instances
+    for r in regions:
+        for instance in inventories[r]:
+            for tag in instance.get('Tags', []):
+                k = tag['Key']
+                v = tag['Value']
+
+                if str(v).lower() in ignored_tag_values:
+                    continue
+
+                if k.lower() in ['backup'] and (k, v) not in found_backup_tags:
+                    found_backup_tags.append((k, v))
 
     # check out all the configs in dynamodb
     for config in configurations:
@@ -419,37 +678,9 @@ def sanity_check(context, installed_region='us-east-1', aws_account_id=None):
             findings.append("Found a snapshot configuration that couldn't be converted to a filter")
             continue
 
-        filters.append({'Name': 'instance-state-name',
-                        'Values': ['running', 'stopped']})
-
-        found_instances = None
-        for r in regions:
-            ec2 = boto3.client('ec2', region_name=r)
-            instances = ec2.describe_instances(Filters=filters)
-            res_list = instances.get('Reservations', [])
-
-            for reservation in res_list:
-                inst_list = reservation.get('Instances', [])
-
-                if len(inst_list) > 0:
-                    found_instances = True
-                    break
-
-            # Look at all the tags on instances
-            found_tag_data = ec2.describe_tags(
-                Filters=[{'Name': 'resource-type', 'Values': ['instance']}]
-            )
-
-            for tag in found_tag_data.get('Tags', []):
-                k = tag['Key']
-                v = tag['Value']
-
-                if str(v).lower() in ignored_tag_values:
-                    continue
-
-                to_add = 'tag:{}, value:{}'.format(k, v)
-                if k.lower() in ['backup'] and to_add not in found_backup_tag_values:
-                    found_backup_tag_values.append(to_add)
+        found_instances = any(
+            region_has_matching_instance(r, inventories[r], filters)
+            for r in regions if utils.configuration_targets_region(config, r))
 
         if not found_instances:
             long_config = []
@@ -458,7 +689,7 @@ def sanity_check(context, installed_region='us-east-1', aws_account_id=None):
             findings.append(
                 "{} was configured, but didn't match any instances".format(", ".join(long_config)))
 
-    if len(found_backup_tag_values) > 0 or len(found_config_tag_values) > 0:
+    if len(found_backup_tags) > 0 or len(found_config_tag_values) > 0:
         if not (bucket_exists and dynamodb_exists):
             findings.append('Configuations or tags are present, but EBS snapper not fully deployed')
 
@@ -466,16 +697,81 @@ def sanity_check(context, installed_region='us-east-1', aws_account_id=None):
         findings.append('No configurations existed for this account, but ebs-snapper was deployed')
 
     # tagged instances without any config
-    for s in found_backup_tag_values:
-        if s not in found_config_tag_values:
-            findings.append('{} was tagged on an instance, but no configuration exists'.format(s))
+    for k, v in found_backup_tags:
+        if not tag_is_configured(k, v, configurations):
+            findings.append('tag:{}, value:{} was tagged on an instance, '
+                            'but no configuration exists'.format(k, v))
 
     LOG.debug("configs: %s", str(found_config_tag_values))
-    LOG.debug("tags: %s", str(found_backup_tag_values))
+    LOG.debug("tags: %s", str(found_backup_tags))
 
     return findings
 
 
+def instance_inventory(region):
+    """Every running or stopped instance in a region, trimmed to what filters look at"""
+    ec2 = clients.get_client('ec2', region)
+    paginator = ec2.get_paginator('describe_instances')
+    page_iterator = paginator.paginate(Filters=[
+        {'Name': 'instance-state-name', 'Values': ['running', 'stopped']}
+    ])
+
+    inventory = []
+    for page in page_iterator:
+        for reservation in page.get('Reservations', []):
+            for instance in reservation.get('Instances', []):
+                inventory.append(dict((k, instance[k]) for k in INVENTORY_KEYS if k in instance))
+
+    return inventory
+
+
+def region_has_matching_instance(region, inventory, filters):
+    """Check if any instance in a region matches describe_instances filters
+
+    Filters the inventory can answer are checked locally, anything else
+    is left to EC2.
+    """
+    if all(f['Name'].startswith('tag:') or f['Name'] in LOCAL_INSTANCE_FILTERS for f in filters):
+        return any(instance_matches_filters(i, filters) for i in inventory)
+
+    ec2 = clients.get_client('ec2', region)
+    filters = filters + [{'Name': 'instance-state-name', 'Values': ['running', 'stopped']}]
+    instances = ec2.describe_instances(Filters=filters)
+    return any(len(r.get('Instances', [])) > 0 for r in instances.get('Reservations', []))
+
+
+def instance_matches_filters(instance, filters):
+    """Check an inventoried instance against describe_instances filters, like EC2 would"""
+    for f in filters:
+        if f['Name'].startswith('tag:'):
+            key = f['Name'][len('tag:'):]
+            values = [t['Value'] for t in instance.get('Tags', []) if t['Key'] == key]
+        else:
+            values = LOCAL_INSTANCE_FILTERS[f['Name']](instance)
+
+        # filters AND together, and a filter's values OR together
+        if not any(wildcard_match(str(p), v) for p in f['Values'] for v in values if v):
+            return False
+
+    return True
+
+
+def tag_is_configured(key, value, configurations):
+    """Check if some configuration matches a tag, where a configured value may be a pattern"""
+    for config in configurations:
+        patterns = config.get('match', {}).get('tag:' + key)
+        if patterns is not None and \
+                any(wildcard_match(str(p), value) for p in utils.flatten([patterns])):
+            return True
+    return False
+
+
+def wildcard_match(pattern, value):
+    """Match a value against an EC2 filter value, where * and ? are wildcards"""
+    expression = re.escape(pattern).replace('\\*', '.*').replace('\\?', '.')
+    return re.match('^' + expression + '$', value, re.DOTALL) is not None
+
+
 def md5sum(fname):
     """Calculate the MD5 sum of a file"""
     hash_md5 = hashlib.md5()
@@ -0,0 +1,313 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2016 Rackspace US, Inc.
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+"""Module for dispatching fanout work items to wherever they get done."""
+
+from __future__ import print_function
+import abc
+import json
+import logging
+import os
+import threading
+import time
+from ebs_snapper import clients, utils
+
+LOG = logging.getLogger()
+
+TRANSPORTS = ['local', 'process', 'sns', 'sqs', 'lambda']
+DEFAULT_TRANSPORT = 'sns'
+DEFAULT_LOCAL_WORKERS = 4
+
+# where each kind of work goes, for each transport that needs to be told
+TOPIC_NAMES = {
+    'snapshot': 'CreateSnapshotTopic',
+    'clean': 'CleanSnapshotTopic',
+    'replication': 'ReplicationSnapshotTopic',
+}
+QUEUE_URL_ENV_PREFIX = 'EBS_SNAPPER_QUEUE_URL_'
+FUNCTION_ENV_PREFIX = 'EBS_SNAPPER_FUNCTION_'
+
+SQS_BATCH_SIZE = 10  # most entries allowed in one SendMessageBatch
+SQS_MAX_DELAY = 900  # most DelaySeconds allowed on one SQS message
+
+
+class Dispatcher(object):
+    """Sends fanout work items (small JSON-able dicts) off to be done"""
+    __metaclass__ = abc.ABCMeta
+
+    def send_all(self, messages, stagger=0):
+        """Send every message, asking that message i not start before i * stagger seconds"""
+        delays = [int(i * stagger) for i in range(len(messages))]
+        self.send_batch(messages, delays)
+
+    @abc.abstractmethod
+    def send_batch(self, messages, delays):
+        """Send messages, each with its requested delay in seconds"""
+
+
+class LocalDispatcher(Dispatcher):
+    """Do the work right here, on a pool of threads (or processes)"""
+
+    def __init__(self, handler, workers=DEFAULT_LOCAL_WORKERS, processes=False):
+        self.handler = handler
+        self.workers = workers
+        self.processes = processes
+
+    def send_batch(self, messages, delays):
+        # nobody else is waiting on us, so there is nothing to stagger
+        if not self.processes or self.workers <= 1 or len(messages) <= 1:
+            utils.map_concurrently(self.handler, messages, self.workers)
+            return
+
+        from multiprocessing import Pool
+        pool = Pool(processes=min(self.workers, len(messages)))
+        try:
+            pool.map(self.handler, messages)
+        finally:
+            pool.close()
+            pool.join()
+
+
+class SnsDispatcher(Dispatcher):
+    """Publish one SNS message per work item"""
+
+    def __init__(self, topic_arn, region='us-east-1'):
+        self.topic_arn = topic_arn
+        self.region = region
+
+    def send_batch(self, messages, delays):
+        if any(delays):
+            LOG.info('SNS cannot delay messages, sending %s messages without stagger',
+                     len(messages))
+
+        utils.map_concurrently(self.send, messages, utils.FANOUT_WORKERS)
+
+    def send(self, message):
+        """Publish a single message"""
+        body = json.dumps(message)
+        LOG.debug('SnsDispatcher.send: %s', body)
+        utils.sns_publish(TopicArn=self.topic_arn, Message=body, Region=self.region)
+
+
+class SqsDispatcher(Dispatcher):
+    """Send work items to an SQS queue, in batches, honoring delays"""
+
+    def __init__(self, queue_url, region='us-east-1'):
+        self.queue_url = queue_url
+        self.region = region
+
+    def send_batch(self, messages, delays):
+        entries = []
+        for i, message in enumerate(messages):
+            entries.append({
+                'Id': str(i),
+                'MessageBody': json.dumps(message),
+                'DelaySeconds': min(max(delays[i], 0), SQS_MAX_DELAY),
+            })
+
+        batches = [entries[i:i + SQS_BATCH_SIZE] for i in range(0, len(entries), SQS_BATCH_SIZE)]
+        utils.map_concurrently(self.send_entries, batches, utils.FANOUT_WORKERS)
+
+    def send_entries(self, entries):
+        """Send one batch of entries, retrying any that fail once"""
+        sqs = clients.get_client('sqs', self.region)
+        response = sqs.send_message_batch(QueueUrl=self.queue_url, Entries=entries)
+        failed_ids = [x['Id'] for x in response.get('Failed', [])]
+        if len(failed_ids) <= 0:
+            return
+
+        LOG.warn('Retrying %s messages SQS did not accept', len(failed_ids))
+        retry = [x for x in entries if x['Id'] in failed_ids]
+        response = sqs.send_message_batch(QueueUrl=self.queue_url, Entries=retry)
+        if len(response.get('Failed', [])) > 0:
+            raise Exception('Could not send messages to {}: {}'.format(
+                self.queue_url, response['Failed']))
+
+
+class LambdaDispatcher(Dispatcher):
+    """Invoke a Lambda function asynchronously, once per work item"""
+
+    def __init__(self, function_name, region='us-east-1'):
+        self.function_name = function_name
+        self.region = region
+
+    def send_batch(self, messages, delays):
+        if any(delays):
+            LOG.info('Lambda cannot delay invocations, sending %s messages without stagger',
+                     len(messages))
+
+        utils.map_concurrently(self.send, messages, utils.FANOUT_WORKERS)
+
+    def send(self, message):
+        """Invoke the function with a single message as its event"""
+        body = json.dumps(message)
+        LOG.debug('LambdaDispatcher.send: %s', body)
+        client = clients.get_client('lambda', self.region)
+        client.invoke(FunctionName=self.function_name, InvocationType='Event', Payload=body)
+
+
+class RegionRun(object):
+    """How the CLI does regions itself: which ones, how many at once, and how long each gets
+
+    Each region fails on its own, and how every region went is kept in
+    results as (region, seconds, error or None) for a summary at the end.
+    """
+
+    def __init__(self, regions=None, exclude_regions=None, workers=None, region_timeout=None):
+        self.regions = regions
+        self.exclude_regions = exclude_regions or []
+        self.workers = workers
+        self.region_timeout = region_timeout  # minutes, or None for a fair share
+        self.results = []
+        self.results_lock = threading.Lock()
+
+    def select(self, regions):
+        """The regions to do, of those the fanout found"""
+        return [r for r in regions
+                if (self.regions is None or utils.region_in(r, self.regions)) and
+                not utils.region_in(r, self.exclude_regions)]
+
+    def get_workers(self, configurations):
+        """Regions to do at once, unless told, the same as the local transports"""
+        return self.workers or int(utils.get_configuration_setting(
+            configurations, 'local_workers', DEFAULT_LOCAL_WORKERS))
+
+    def prepare(self, regions, configurations, perform, context):
+        """Select regions, and build a local handler calling perform(context, message)
+
+        Every region gets its own deadline: region_timeout minutes, or else
+        its share of the time left, so waiting regions still get theirs.
+        """
+        regions = self.select(regions)
+        share = float(self.get_workers(configurations)) / max(len(regions), 1)
+
+        def handler(message):
+            """Do one region, with its own deadline, and record how it went"""
+            region = message['region']
+            if message.get('account'):
+                region = '{}/{}'.format(message['account'], region)
+
+            if self.region_timeout:
+                region_context = utils.ShellContext()
+                region_context.set_remaining_time_in_millis(min(
+                    60000 * self.region_timeout, context.get_remaining_time_in_millis()))
+            else:
+                region_context = utils.DeadlineShareContext(context, share)
+
+            started = time.time()
+            error = None
+            try:
+                perform(region_context, message)
+            except Exception as e:  # pylint: disable=broad-except
+                LOG.exception('Region %s failed', region)
+                error = str(e) or e.__class__.__name__
+
+            with self.results_lock:
+                self.results.append((region, time.time() - started, error))
+
+        return regions, handler
+
+    def failures(self):
+        """The regions that failed"""
+        return [region for region, _, error in self.results if error is not None]
+
+
+def get_transport(configurations, region=None):
+    """Find the configured transport, which may be set per region with a "default" """
+    setting = utils.get_configuration_setting(
+        configurations, 'fanout_transport', DEFAULT_TRANSPORT)
+    if isinstance(setting, dict):
+        setting = setting.get(region, setting.get('default', DEFAULT_TRANSPORT))
+
+    if setting not in TRANSPORTS:
+        raise Exception('Unknown fanout_transport {}, expected one of {}'.format(
+            setting, TRANSPORTS))
+
+    return setting
+
+
+def get_target(configurations, setting, env_prefix, kind):
+    """Find where to send kind of work, from configuration then the environment"""
+    targets = utils.get_configuration_setting(configurations, setting, {})
+    target = targets.get(kind) or os.environ.get(env_prefix + kind.upper())
+    if not target:
+        raise Exception('No {} configured for {} work'.format(setting, kind))
+
+    return target
+
+
+def get_dispatcher(kind, configurations, local_handler, transport,
+                   installed_region='us-east-1', workers=None):
+    """Build a dispatcher for kind ('snapshot', 'clean', 'replication') of work"""
+    if transport in ['local', 'process']:
+        workers = workers or int(utils.get_configuration_setting(
+            configurations, 'local_workers', DEFAULT_LOCAL_WORKERS))
+        return LocalDispatcher(local_handler, workers, processes=(transport == 'process'))
+    elif transport == 'sqs':
+        queue_url = get_target(configurations, 'fanout_queues', QUEUE_URL_ENV_PREFIX, kind)
+        return SqsDispatcher(queue_url, installed_region)
+    elif transport == 'lambda':
+        function_name = get_target(configurations, 'fanout_functions', FUNCTION_ENV_PREFIX, kind)
+        return LambdaDispatcher(function_name, installed_region)
+
+    return SnsDispatcher(utils.get_topic_arn(TOPIC_NAMES[kind], installed_region), installed_region)
+
+
+def fanout(kind, regions, configurations, local_handler, cli=False,
+           installed_region='us-east-1', payload=None, member=None, run=None):
+    """Send a {'region': ...} work item for every region, by each region's transport
+
+    A payload (see dynamo.build_payload) goes along with every work item sent
+    elsewhere, so workers don't all have to load configurations themselves.
+    In hub mode, member ({'account': ..., 'role_arn': ...}) goes along too.
+    With a RegionRun, the CLI does every region on its own threads.
+    """
+    stagger = float(utils.get_configuration_setting(configurations, 'fanout_stagger', 0))
+
+    # the CLI always does the work itself, anything else goes where it's configured
+    by_transport = {}
+    for region in regions:
+        transport = get_transport(configurations, region)
+        if cli and transport not in ['local', 'process']:
+            transport = 'local'
+
+        # a run's handler keeps its results here, so it can't go to another process
+        if run is not None:
+            transport = 'local'
+
+        message = {'region': region}
+        message.update(member or {})
+        if payload and transport not in ['local', 'process']:
+            message['configuration'] = payload
+
+        by_transport.setdefault(transport, []).append(message)
+
+    # Lambda has no /dev/shm for a process pool's queues, so only the CLI may use one
+    if not cli and 'process' in by_transport:
+        LOG.warn('The process fanout_transport only works from the CLI, using local instead')
+        by_transport.setdefault('local', []).extend(by_transport.pop('process'))
+
+    for transport, messages in by_transport.iteritems():
+        LOG.info('Dispatching %s %s messages by %s', len(messages), kind, transport)
+        workers = run.get_workers(configurations) if run is not None else None
+        dispatcher = get_dispatcher(kind, configurations, local_handler, transport,
+                                    installed_region, workers=workers)
+        dispatcher.send_all(messages, stagger)
@@ -23,11 +23,49 @@
 
 from __future__ import print_function
 import json
-import boto3
+import logging
+import os
+import time
 from boto3.dynamodb.conditions import Key
-from ebs_snapper import utils
+from botocore.exceptions import ClientError
+from ebs_snapper import clients, utils, runtime, throttle
 from ebs_snapper import EbsSnapperError
 
+LOG = logging.getLogger()
+
+
+# a reserved item per account, counting changes to that account's configurations
+VERSION_ITEM_ID = '__version__'
+
+# in hub mode, a reserved item per member account, holding the role to assume there
+MEMBER_ITEM_ID = '__member__'
+RESERVED_IDS = [VERSION_ITEM_ID, MEMBER_ITEM_ID]
+
+# most items DynamoDB takes in one BatchWriteItem
+BATCH_WRITE_SIZE = 25
+
+# fanout messages carry the configurations along up to this size, or else point to S3
+PAYLOAD_MAX_BYTES = int(os.environ.get('EBS_SNAPPER_PAYLOAD_MAX_BYTES', 200 * 1024))
+PAYLOAD_BUCKET_ENV = 'EBS_SNAPPER_PAYLOAD_BUCKET'
+PAYLOAD_KEY = 'configurations/{}/{}.json'
+
+# workers load from DynamoDB instead of using a payload older than this, in seconds
+PAYLOAD_MAX_AGE = int(os.environ.get('EBS_SNAPPER_PAYLOAD_MAX_AGE', 1800))
+
+
+def query_account(table, aws_account_id):
+    """Yield every configuration item for an account, a page at a time"""
+    params = {'KeyConditionExpression': Key('aws_account_id').eq(aws_account_id)}
+    while True:
+        results = table.query(**params)
+        for item in results.get('Items', []):
+            if item['id'] not in RESERVED_IDS:
+                yield item
+
+        if 'LastEvaluatedKey' not in results:
+            return
+        params['ExclusiveStartKey'] = results['LastEvaluatedKey']
+
 
 def list_ids(context, installed_region, aws_account_id=None):
     """Retrieve configuration from DynamoDB and return array of dictionary objects"""
@@ -35,14 +73,10 @@ def list_ids(context, installed_region, aws_account_id=None):
     if aws_account_id is None:
         aws_account_id = utils.get_owner_id(context)[0]
 
-    dynamodb = boto3.resource('dynamodb', region_name=installed_region)
+    dynamodb = clients.get_resource('dynamodb', installed_region)
     table = dynamodb.Table('ebs_snapshot_configuration')
 
-    results = table.query(
-        KeyConditionExpression=Key('aws_account_id').eq(aws_account_id)
-    )
-
-    for item in results.get('Items', []):
+    for item in query_account(table, aws_account_id):
         str_item = item.get('configuration', None)
         found_configurations[str_item] = item['id']
 
@@ -55,14 +89,10 @@ def list_configurations(context, installed_region, aws_account_id=None):
     if aws_account_id is None:
         aws_account_id = utils.get_owner_id(context)[0]
 
-    dynamodb = boto3.resource('dynamodb', region_name=installed_region)
+    dynamodb = clients.get_resource('dynamodb', installed_region)
     table = dynamodb.Table('ebs_snapshot_configuration')
 
-    results = table.query(
-        KeyConditionExpression=Key('aws_account_id').eq(aws_account_id)
-    )
-
-    for item in results.get('Items', []):
+    for item in query_account(table, aws_account_id):
         str_item = item.get('configuration', None)
         try:
             json_item = json.loads(str_item)
@@ -73,12 +103,161 @@ def list_configurations(context, installed_region, aws_account_id=None):
     return found_configurations.values()
 
 
+def get_version(installed_region, aws_account_id):
+    """Read the account's configuration version, 0 if it was never changed"""
+    dynamodb = clients.get_resource('dynamodb', installed_region)
+    table = dynamodb.Table('ebs_snapshot_configuration')
+
+    item = table.get_item(
+        Key={'aws_account_id': aws_account_id, 'id': VERSION_ITEM_ID},
+        ConsistentRead=True
+    ).get('Item', {})
+
+    return int(item.get('version', 0))
+
+
+def bump_version(table, aws_account_id):
+    """Count a change to the account's configurations, so readers reload them"""
+    table.update_item(
+        Key={'aws_account_id': aws_account_id, 'id': VERSION_ITEM_ID},
+        AttributeUpdates={'version': {'Action': 'ADD', 'Value': 1}}
+    )
+
+
+def load_configurations(context, installed_region, aws_account_id=None):
+    """list_configurations, but only reloaded when the account's version changes
+
+    A warm container trusts what it has for CONFIG_TTL seconds, then reads
+    the version item; all of the configurations are only read again (and
+    parsed) if it changed.
+    """
+    if aws_account_id is None:
+        aws_account_id = utils.get_owner_id(context)[0]
+
+    key = (installed_region, aws_account_id)
+    with runtime.STATE.configurations_lock:
+        cached = runtime.STATE.configurations.get(key)
+    if cached is not None and cached[0] > time.time():
+        return cached[2]
+
+    version = get_version(installed_region, aws_account_id)
+    if cached is not None and cached[1] == version:
+        configurations = cached[2]
+    else:
+        configurations = list_configurations(context, installed_region, aws_account_id)
+
+    with runtime.STATE.configurations_lock:
+        # settings compiled from configurations that are gone aren't needed any more
+        if cached is not None and cached[1] != version:
+            runtime.STATE.compiled.clear()
+        runtime.STATE.configurations[key] = (time.time() + runtime.CONFIG_TTL,
+                                             version, configurations)
+
+    return configurations
+
+
+def forget_configurations(installed_region, aws_account_id):
+    """Make the next load_configurations go back to DynamoDB"""
+    with runtime.STATE.configurations_lock:
+        runtime.STATE.configurations.pop((installed_region, aws_account_id), None)
+
+
+def build_payload(context, installed_region, aws_account_id=None):
+    """A versioned copy of what load_configurations loaded, for fanout messages
+
+    Returns None if there's nothing loaded to send, or it's too large for
+    a message and there's no bucket to put it in.
+    """
+    if aws_account_id is None:
+        aws_account_id = utils.get_owner_id(context)[0]
+
+    with runtime.STATE.configurations_lock:
+        cached = runtime.STATE.configurations.get((installed_region, aws_account_id))
+    if cached is None:
+        return None
+
+    payload = {
+        'account': aws_account_id,
+        'installed_region': installed_region,
+        'version': cached[1],
+        'issued': int(time.time()),
+    }
+
+    body = json.dumps(cached[2], separators=(',', ':'))
+    if len(body) <= PAYLOAD_MAX_BYTES:
+        payload['configurations'] = cached[2]
+        return payload
+
+    bucket = os.environ.get(PAYLOAD_BUCKET_ENV)
+    if not bucket:
+        LOG.info('Configurations are %s bytes and there is no bucket, not sending them', len(body))
+        return None
+
+    # versions never change, so a key per version is safe to re-use, and only put once
+    key = PAYLOAD_KEY.format(aws_account_id, cached[1])
+    s3 = clients.get_client('s3', installed_region)
+    try:
+        s3.head_object(Bucket=bucket, Key=key)
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ['404', 'NoSuchKey', 'NotFound']:
+            raise
+        s3.put_object(Bucket=bucket, Key=key, Body=body)
+    payload['s3'] = {'bucket': bucket, 'key': key}
+
+    return payload
+
+
+def accept_payload(payload):
+    """Use the configurations a fanout message carried, returns True if they were used
+
+    Anything missing, stale (too old, or older than what we already have)
+    or unreadable is ignored, and load_configurations goes to DynamoDB.
+    """
+    if not payload:
+        return False
+
+    try:
+        if time.time() - payload['issued'] > PAYLOAD_MAX_AGE:
+            LOG.warn('Ignoring configurations issued at %s, they are too old', payload['issued'])
+            return False
+
+        key = (payload['installed_region'], payload['account'])
+        version = int(payload['version'])
+        with runtime.STATE.configurations_lock:
+            cached = runtime.STATE.configurations.get(key)
+        if cached is not None and cached[1] > version:
+            return False
+
+        if cached is not None and cached[1] == version:
+            configurations = cached[2]
+        elif 'configurations' in payload:
+            configurations = payload['configurations']
+        else:
+            s3 = clients.get_client('s3', payload['installed_region'])
+            body = s3.get_object(Bucket=payload['s3']['bucket'], Key=payload['s3']['key'])
+            configurations = json.loads(body['Body'].read())
+
+        if not isinstance(configurations, list):
+            raise ValueError('configurations must be a list')
+    except Exception:  # pylint: disable=broad-except
+        LOG.exception('Ignoring configurations sent with fanout message')
+        return False
+
+    with runtime.STATE.configurations_lock:
+        if cached is not None and cached[1] != version:
+            runtime.STATE.compiled.clear()
+        runtime.STATE.configurations[key] = (time.time() + runtime.CONFIG_TTL,
+                                             version, configurations)
+
+    return True
+
+
 def get_configuration(context, installed_region, object_id, aws_account_id=None):
     """Retrieve configuration from DynamoDB and return single object"""
     if aws_account_id is None:
         aws_account_id = utils.get_owner_id(context)[0]
 
-    dynamodb = boto3.resource('dynamodb', region_name=installed_region)
+    dynamodb = clients.get_resource('dynamodb', installed_region)
     table = dynamodb.Table('ebs_snapshot_configuration')
 
     expr = Key('aws_account_id').eq(aws_account_id) & Key('id').eq(object_id)
@@ -95,13 +274,29 @@ def get_configuration(context, installed_region, object_id, aws_account_id=None)
     return None
 
 
+def validate_configuration(object_id, configuration):
+    """Raise if a configuration item shouldn't be stored"""
+    if not object_id:
+        raise Exception('must provide an object key id')
+
+    if object_id in RESERVED_IDS:
+        raise Exception('{} is reserved, use another id'.format(object_id))
+
+    # be sure they parse correctly before we go saving them
+    utils.parse_snapshot_settings(configuration)
+
+    regions = configuration.get('regions')
+    if regions is not None and not (
+            isinstance(regions, list) and all(isinstance(x, basestring) for x in regions)):
+        raise Exception('regions must be a list of region names or patterns')
+
+
 def store_configuration(installed_region, object_id, aws_account_id, configuration):
     """Function to store configuration item"""
-    dynamodb = boto3.resource('dynamodb', region_name=installed_region)
+    dynamodb = clients.get_resource('dynamodb', installed_region)
     table = dynamodb.Table('ebs_snapshot_configuration')
 
-    # be sure they parse correctly before we go saving them
-    utils.parse_snapshot_settings(configuration)
+    validate_configuration(object_id, configuration)
 
     response = table.put_item(
         Item={
@@ -110,13 +305,15 @@ def store_configuration(installed_region, object_id, aws_account_id, configurati
             'configuration': json.dumps(configuration)
         }
     )
+    bump_version(table, aws_account_id)
+    forget_configurations(installed_region, aws_account_id)
 
     return response.get('Attributes', {})
 
 
 def delete_configuration(installed_region, object_id, aws_account_id):
     """Function to delete configuration item"""
-    dynamodb = boto3.resource('dynamodb', region_name=installed_region)
+    dynamodb = clients.get_resource('dynamodb', installed_region)
     table = dynamodb.Table('ebs_snapshot_configuration')
 
     response = table.delete_item(
@@ -125,5 +322,124 @@ def delete_configuration(installed_region, object_id, aws_account_id):
             'id': object_id
         }
     )
+    bump_version(table, aws_account_id)
+    forget_configurations(installed_region, aws_account_id)
 
     return response.get('Attributes', {})
+
+
+def store_configurations(installed_region, items):
+    """Store many (aws_account_id, object_id, configuration) items with batched writes
+
+    Items must already have passed validate_configuration. A later item
+    with the same key replaces an earlier one. Returns how many were written.
+    """
+    dynamodb = clients.get_resource('dynamodb', installed_region)
+    table = dynamodb.Table('ebs_snapshot_configuration')
+
+    accounts = set()
+    batch = {}
+    written = 0
+    for aws_account_id, object_id, configuration in items:
+        # one batch can't hold the same key twice
+        if len(batch) >= BATCH_WRITE_SIZE or (aws_account_id, object_id) in batch:
+            written += write_batch(dynamodb, table.name, batch.values())
+            batch = {}
+
+        batch[(aws_account_id, object_id)] = {'PutRequest': {'Item': {
+            'aws_account_id': aws_account_id,
+            'id': object_id,
+            'configuration': json.dumps(configuration)
+        }}}
+        accounts.add(aws_account_id)
+
+    if len(batch) > 0:
+        written += write_batch(dynamodb, table.name, batch.values())
+
+    for aws_account_id in accounts:
+        bump_version(table, aws_account_id)
+        forget_configurations(installed_region, aws_account_id)
+
+    return written
+
+
+def write_batch(dynamodb, table_name, requests):
+    """BatchWriteItem, retrying whatever DynamoDB leaves unprocessed with backoff"""
+    requests = list(requests)
+    count = len(requests)
+    attempts = 0
+    while len(requests) > 0:
+        response = dynamodb.batch_write_item(RequestItems={table_name: requests})
+        requests = response.get('UnprocessedItems', {}).get(table_name, [])
+        if len(requests) <= 0:
+            break
+
+        attempts += 1
+        if attempts >= throttle.RETRY_ATTEMPTS['throttling']:
+            raise Exception('DynamoDB left {} items unprocessed'.format(len(requests)))
+
+        LOG.info('Retrying %s unprocessed items', len(requests))
+        time.sleep(throttle.backoff_delay('throttling', attempts))
+
+    return count
+
+
+def export_configurations(context, installed_region, aws_account_id=None):
+    """Yield every configuration item for an account, reading one page at a time"""
+    if aws_account_id is None:
+        aws_account_id = utils.get_owner_id(context)[0]
+
+    dynamodb = clients.get_resource('dynamodb', installed_region)
+    table = dynamodb.Table('ebs_snapshot_configuration')
+
+    for item in query_account(table, aws_account_id):
+        try:
+            configuration = json.loads(item.get('configuration', None))
+        except Exception as e:
+            raise EbsSnapperError('error loading configuration', e)
+
+        yield {'aws_account_id': aws_account_id, 'id': item['id'],
+               'configuration': configuration}
+
+
+def register_member(installed_region, aws_account_id, role_arn):
+    """Have a hub installation work on a member account, by assuming role_arn there"""
+    dynamodb = clients.get_resource('dynamodb', installed_region)
+    table = dynamodb.Table('ebs_snapshot_configuration')
+    table.put_item(Item={
+        'aws_account_id': str(aws_account_id),
+        'id': MEMBER_ITEM_ID,
+        'role_arn': role_arn
+    })
+
+
+def deregister_member(installed_region, aws_account_id):
+    """Stop a hub installation working on a member account, its configurations stay"""
+    dynamodb = clients.get_resource('dynamodb', installed_region)
+    table = dynamodb.Table('ebs_snapshot_configuration')
+    table.delete_item(Key={'aws_account_id': str(aws_account_id), 'id': MEMBER_ITEM_ID})
+
+
+def get_member(installed_region, aws_account_id):
+    """The role_arn a registered member account is reached by, or None if it isn't one"""
+    dynamodb = clients.get_resource('dynamodb', installed_region)
+    table = dynamodb.Table('ebs_snapshot_configuration')
+    item = table.get_item(Key={'aws_account_id': str(aws_account_id), 'id': MEMBER_ITEM_ID})
+    return item.get('Item', {}).get('role_arn')
+
+
+def list_members(installed_region):
+    """Every registered member account, as (aws_account_id, role_arn), a page at a time"""
+    dynamodb = clients.get_resource('dynamodb', installed_region)
+    table = dynamodb.Table('ebs_snapshot_configuration')
+
+    params = {'ScanFilter': {'id': {'AttributeValueList': [MEMBER_ITEM_ID],
+                                    'ComparisonOperator': 'EQ'}}}
+    while True:
+        results = table.scan(**params)
+        for item in results.get('Items', []):
+            yield item['aws_account_id'], item['role_arn']
+
+        if 'LastEvaluatedKey' not in results:
+            return
+        params['ExclusiveStartKey'] = results['LastEvaluatedKey']
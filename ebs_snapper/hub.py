@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2016 Rackspace US, Inc.
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+"""Module for working on many member accounts from one hub installation."""
+
+from __future__ import print_function
+import logging
+import os
+from ebs_snapper import clients, dynamo, runtime, timeout_check
+
+LOG = logging.getLogger()
+
+# set by the CloudFormation template, when this installation works for member accounts
+HUB_ENV = 'EBS_SNAPPER_HUB'
+
+
+def hub_enabled():
+    """Check if this installation works on registered member accounts, not its own"""
+    return os.environ.get(HUB_ENV, '').lower() in ['1', 'true', 'yes']
+
+
+def fanout_accounts(context, installed_region, fanout_account):
+    """Call fanout_account(member) for this account, or in hub mode for every member
+
+    member is None, or the {'account': ..., 'role_arn': ...} to send along
+    with each of that member's messages. While it runs, EC2 calls go to
+    the member, and one member failing doesn't stop the others.
+    """
+    if not hub_enabled():
+        fanout_account(None)
+        return
+
+    members = list(dynamo.list_members(installed_region))
+    LOG.info('Fanning out for %s member accounts', len(members))
+
+    failed = []
+    for aws_account_id, role_arn in members:
+        if timeout_check(context, 'fanout_accounts'):
+            break
+
+        clients.use_member(aws_account_id, role_arn)
+        try:
+            fanout_account({'account': aws_account_id, 'role_arn': role_arn})
+        except Exception:  # pylint: disable=broad-except
+            LOG.exception('Fanout failed for member account %s', aws_account_id)
+            failed.append(aws_account_id)
+        finally:
+            clients.use_member(None)
+
+    if len(failed) > 0:
+        raise Exception('Fanout failed for {} of {} member accounts: {}'.format(
+            len(failed), len(members), ', '.join(failed)))
+
+
+def member_fields():
+    """The {'account': ..., 'role_arn': ...} of the member being worked on, or {}"""
+    member = runtime.STATE.member
+    if member is None:
+        return {}
+
+    return {'account': member[0], 'role_arn': member[1]}
+
+
+def item_member(item):
+    """The member account a message or work item is for, None for this account"""
+    return item.get('account')
+
+
+def by_member(items, member_of=item_member):
+    """Group the indexes of messages or work items by the member account they're for"""
+    groups = []
+    for i, item in enumerate(items):
+        member = member_of(item)
+        for group_member, indexes in groups:
+            if group_member == member:
+                indexes.append(i)
+                break
+        else:
+            groups.append((member, [i]))
+
+    return groups
+
+
+def perform_by_member(items, perform, member_of=item_member, installed_region='us-east-1'):
+    """Like perform(items), but each member's items in turn, with EC2 calls going to it
+
+    Items without an account are done in this account. A member is reached
+    by the role it was registered with, never one an item names, and if any
+    item is for an account that isn't registered, nothing is done. Results
+    come back in the same order as items.
+    """
+    groups = by_member(items, member_of)
+    role_arns = {}
+    for aws_account_id, _ in groups:
+        if aws_account_id is None:
+            continue
+
+        role_arns[aws_account_id] = dynamo.get_member(installed_region, aws_account_id)
+        if role_arns[aws_account_id] is None:
+            raise Exception('Account {} is not a registered member'.format(aws_account_id))
+
+    results = [None] * len(items)
+    for aws_account_id, indexes in groups:
+        clients.use_member(aws_account_id, role_arns.get(aws_account_id))
+        try:
+            group_results = perform([items[i] for i in indexes])
+        finally:
+            clients.use_member(None)
+
+        for i, result in zip(indexes, group_results):
+            results[i] = result
+
+    return results
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2016 Rackspace US, Inc.
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+"""Module for streaming an inventory of volumes and snapshots, for audits and planning."""
+
+from __future__ import print_function
+import csv
+import gzip
+import json
+import logging
+import Queue
+import sys
+import threading
+import ebs_snapper
+from ebs_snapper import clients, dynamo, regional, utils
+
+LOG = logging.getLogger()
+
+FORMATS = ['ndjson', 'csv']
+FIELDS = ['kind', 'account', 'region', 'id', 'volume_id', 'instance_id', 'state', 'size_gib',
+          'created', 'delete_on', 'replication_src_region', 'replication_dst_region',
+          'replication_snapshot_id']
+REPLICATION_TAGS = ['replication_src_region', 'replication_dst_region', 'replication_snapshot_id']
+
+PAGE_SIZE = 100  # volumes or snapshots asked for at once
+QUEUE_SIZE = 1000  # rows found but not yet written, so memory stays bounded
+
+
+def volume_rows(context, region, account):
+    """A row for every volume in region, a page at a time"""
+    ec2 = clients.get_client('ec2', region)
+    pages = ec2.get_paginator('describe_volumes').paginate(
+        PaginationConfig={'PageSize': PAGE_SIZE})
+
+    for page in pages:
+        if ebs_snapper.timeout_check(context, 'volume_rows'):
+            raise Exception('Ran out of time listing volumes in {}'.format(region))
+
+        for volume in page.get('Volumes', []):
+            attachments = volume.get('Attachments', [])
+            yield {
+                'kind': 'volume',
+                'account': account,
+                'region': region,
+                'id': volume['VolumeId'],
+                'volume_id': volume['VolumeId'],
+                'instance_id': attachments[0]['InstanceId'] if attachments else None,
+                'state': volume.get('State'),
+                'size_gib': volume.get('Size'),
+                'created': timestamp(volume.get('CreateTime')),
+            }
+
+
+def snapshot_rows(context, region, account):
+    """A row for every snapshot account owns in region, a page at a time"""
+    pages = utils.build_snapshot_paginator({'OwnerIds': [account]}, region)
+
+    for page in pages:
+        if ebs_snapper.timeout_check(context, 'snapshot_rows'):
+            raise Exception('Ran out of time listing snapshots in {}'.format(region))
+
+        for snap in page.get('Snapshots', []):
+            tags = dict((t['Key'], t['Value']) for t in snap.get('Tags', []))
+            row = {
+                'kind': 'snapshot',
+                'account': account,
+                'region': region,
+                'id': snap['SnapshotId'],
+                'volume_id': snap.get('VolumeId'),
+                'state': snap.get('State'),
+                'size_gib': snap.get('VolumeSize'),
+                'created': timestamp(snap.get('StartTime')),
+                'delete_on': tags.get('DeleteOn'),
+            }
+            for key in REPLICATION_TAGS:
+                row[key] = tags.get(key)
+            yield row
+
+
+def stream_rows(context, regions, account, run, configurations):
+    """Every row of every region, found on run's workers and yielded here as they come
+
+    No more than QUEUE_SIZE rows wait to be yielded, so a slow writer holds
+    the workers up instead of everything piling up in memory. How each
+    region went is kept in run.results, as for the other subcommands.
+    """
+    rows = Queue.Queue(maxsize=QUEUE_SIZE)
+    done = object()
+
+    def perform(region_context, message):
+        """Find one region's rows"""
+        for found in [volume_rows, snapshot_rows]:
+            for row in found(region_context, message['region'], account):
+                rows.put(row)
+
+    regions, handler = run.prepare(regions, configurations, perform, context)
+
+    def produce():
+        """Do every region, then say so"""
+        try:
+            utils.map_concurrently(handler, [{'region': r} for r in regions],
+                                   run.get_workers(configurations))
+        finally:
+            rows.put(done)
+
+    producer = threading.Thread(target=produce, name='inventory')
+    producer.daemon = True  # if writing fails, don't wait on regions nobody will read
+    producer.start()
+
+    while True:
+        row = rows.get()
+        if row is done:
+            break
+        yield row
+
+    producer.join()
+
+
+def write_ndjson(stream, rows):
+    """Write rows as one JSON object per line"""
+    count = 0
+    for row in rows:
+        stream.write(json.dumps(dict((k, row.get(k)) for k in FIELDS), sort_keys=True) + '\n')
+        count += 1
+    return count
+
+
+def write_csv(stream, rows):
+    """Write rows as CSV, with a header"""
+    writer = csv.DictWriter(stream, FIELDS, restval='', lineterminator='\n')
+    writer.writeheader()
+    count = 0
+    for row in rows:
+        writer.writerow(dict((k, encode(v)) for k, v in row.iteritems()))
+        count += 1
+    return count
+
+
+def open_output(filename, compress=False):
+    """A stream to write to (- for stdout), gzipped if asked"""
+    if filename in [None, '-']:
+        if compress:
+            return gzip.GzipFile(fileobj=sys.stdout, mode='wb')
+        return sys.stdout
+
+    if compress:
+        return gzip.open(filename, 'wb')
+    return open(filename, 'wb')
+
+
+def export(context, stream, run, output_format='ndjson', installed_region='us-east-1'):
+    """Write the inventory of every region run selects to stream, returning the row count"""
+    if output_format not in FORMATS:
+        raise Exception('Unknown inventory format {}, expected one of {}'.format(
+            output_format, FORMATS))
+
+    configurations = dynamo.load_configurations(context, installed_region)
+    account = utils.get_owner_id(context)[0]
+    regions = regional.get_regions(configurations=configurations, select=run.select)
+
+    write = write_csv if output_format == 'csv' else write_ndjson
+    count = write(stream, stream_rows(context, regions, account, run, configurations))
+
+    # a partial inventory shouldn't pass for a whole one
+    failures = run.failures()
+    if len(failures) > 0:
+        raise Exception('{} of {} regions failed: {}'.format(
+            len(failures), len(run.results), ', '.join(sorted(failures))))
+
+    LOG.info('Wrote %s inventory rows from %s regions', count, len(run.results))
+    return count
+
+
+def timestamp(value):
+    """A datetime from boto3 as ISO 8601, or None"""
+    return value.isoformat() if value is not None else None
+
+
+def encode(value):
+    """A value the csv module can write, which in Python 2 means bytes"""
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
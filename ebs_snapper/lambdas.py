@@ -23,18 +23,49 @@
 
 from __future__ import print_function
 
+import functools
 import json
 import logging
-from ebs_snapper import snapshot, clean, replication, utils
+import os
+import re
+from ebs_snapper import dynamo, hub, utils, runtime
+
+# each handler imports the modules its own code path needs, to keep cold starts
+# from paying for the other handlers (see tests/test_imports.py)
 
 LOG = logging.getLogger()
 
+# regions from one batched delivery are handled this many at a time
+RECORD_WORKERS = int(os.environ.get('EBS_SNAPPER_RECORD_WORKERS', 4))
+REGION_NAME = re.compile(r'^[a-z]{2}(-gov)?-[a-z]+-[0-9]+$')
+ACCOUNT_ID = re.compile(r'^[0-9]{12}$')
+
+
+def warm_invocation(handler):
+    """Keep runtime state for the next invocation of a warm container, unless this one fails"""
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        """Configure logging once per container, and reset state on any failure"""
+        if not runtime.STATE.logging_configured:
+            utils.configure_logging(context, LOG)
+            runtime.STATE.logging_configured = True
+
+        runtime.STATE.invocations += 1
+        LOG.debug('Invocation %s of this container', runtime.STATE.invocations)
+        try:
+            return handler(event, context)
+        except Exception:
+            LOG.warn('%s failed, starting the next invocation cold', handler.__name__)
+            runtime.STATE.reset()
+            raise
+
+    return wrapper
+
 
+@warm_invocation
 def lambda_fanout_snapshot(event, context):
     """Fanout SNS messages to trigger snapshots when called by AWS Lambda."""
-
-    # baseline logging for lambda
-    utils.configure_logging(context, LOG)
+    from ebs_snapper import snapshot
 
     # for every region and every instance, send to this function
     snapshot.perform_fanout_all_regions(context)
@@ -42,11 +73,10 @@ def lambda_fanout_snapshot(event, context):
     LOG.info('Function lambda_fanout_snapshot completed')
 
 
+@warm_invocation
 def lambda_fanout_clean(event, context):
     """Fanout SNS messages to cleanup snapshots when called by AWS Lambda."""
-
-    # baseline logging for lambda
-    utils.configure_logging(context, LOG)
+    from ebs_snapper import clean
 
     # for every region, send to this function
     clean.perform_fanout_all_regions(context)
@@ -54,11 +84,10 @@ def lambda_fanout_clean(event, context):
     LOG.info('Function lambda_fanout_clean completed')
 
 
+@warm_invocation
 def lambda_fanout_replication(event, context):
     """Fanout SNS messages to replicate snapshots when called by AWS Lambda."""
-
-    # baseline logging for lambda
-    utils.configure_logging(context, LOG)
+    from ebs_snapper import replication
 
     # for every region, send to this function
     replication.perform_fanout_all_regions(context)
@@ -66,105 +95,158 @@ def lambda_fanout_replication(event, context):
     LOG.info('Function lambda_fanout_replication completed')
 
 
+@warm_invocation
 def lambda_snapshot(event, context):
     """Snapshot a single instance when called by AWS Lambda."""
+    from ebs_snapper import snapshot
 
-    # baseline logging for lambda
-    utils.configure_logging(context, LOG)
+    # call the snapshot perform method
+    perform_messages(context, fanout_messages(event, 'lambda_snapshot'),
+                     snapshot.perform_snapshot, 'lambda_snapshot')
 
-    if not (event and event.get('Records')):
-        LOG.warn('lambda_snapshot must be invoked from an SNS topic: %s', str(event))
-        return
+    LOG.info('Function lambda_snapshot completed')
 
-    records = event.get('Records')
-    for record in records:
-        sns = record.get('Sns')
-        if not sns:
-            LOG.warn('lambda_snapshot missing an SNS section: %s', str(event))
-            continue
 
-        message = sns.get('Message')
-        if not message:
-            LOG.warn('lambda_snapshot missing a message section: %s', str(event))
-            continue
+@warm_invocation
+def lambda_clean(event, context):
+    """Clean up a single region when called by AWS Lambda."""
+    from ebs_snapper import clean
 
-        message_json = json.loads(message)
+    # call the snapshot cleanup method
+    perform_messages(context, fanout_messages(event, 'lambda_clean'),
+                     clean.clean_snapshot, 'lambda_clean')
 
-        if 'region' not in message_json:
-            LOG.warn('lambda_snapshot missing specific keys: %s', str(event))
-            continue
+    LOG.info('Function lambda_clean completed')
 
-        # call the snapshot perform method
-        snapshot.perform_snapshot(
-            context,
-            message_json['region'])
 
-        LOG.info('Function lambda_snapshot completed')
+@warm_invocation
+def lambda_replication(event, context):
+    """Perform replication in a single region when called by AWS Lambda."""
+    from ebs_snapper import replication
 
+    # call the replication method
+    perform_messages(context, fanout_messages(event, 'lambda_replication'),
+                     replication.perform_replication, 'lambda_replication')
 
-def lambda_clean(event, context):
-    """Clean up a single region when called by AWS Lambda."""
+    LOG.info('Function lambda_replication completed')
 
-    # baseline logging for lambda
-    utils.configure_logging(context, LOG)
 
-    if not (event and event.get('Records')):
-        LOG.warn('lambda_clean must be invoked from an SNS topic')
-        return
+@warm_invocation
+def lambda_work_items(event, context):
+    """Perform a batch of per-volume work items from the work queue."""
+    from ebs_snapper import work
 
-    records = event.get('Records')
-    for record in records:
-        sns = record.get('Sns')
-        if not sns:
-            LOG.warn('lambda_clean missing an SNS section: %s', str(event))
-            continue
+    records = (event or {}).get('Records', [])
+    if len(records) <= 0:
+        LOG.warn('lambda_work_items must be invoked from an SQS queue: %s', str(event))
+        return
 
-        message = sns.get('Message')
-        if not message:
-            LOG.warn('lambda_clean missing a message section: %s', str(event))
-            continue
+    work.perform_work_records(context, records)
 
-        message_json = json.loads(message)
+    LOG.info('Function lambda_work_items completed, %s items', len(records))
 
-        if 'region' not in message_json:
-            LOG.warn('lambda_clean missing specific keys: %s', str(event))
-            continue
 
-        # call the snapshot cleanup method
-        clean.clean_snapshot(context, message_json['region'])
+def fanout_messages(event, name):
+    """Find the fanout messages in an SNS or SQS event, or a direct async invoke
 
-    LOG.info('Function lambda_clean completed')
+    Anything that isn't a {"region": "<region name>"} message is logged and
+    skipped, so one malformed record can't sink the others in its batch.
+    """
+    if not event or not isinstance(event, dict):
+        LOG.warn('%s must be invoked with a fanout message: %s', name, str(event))
+        return []
 
+    # invoked directly by the lambda dispatcher, the event is the message
+    if 'Records' not in event:
+        records = [{'body': json.dumps(event)}]
+    else:
+        records = event.get('Records') or []
 
-def lambda_replication(event, context):
-    """Perform replication in a single region when called by AWS Lambda."""
+    messages = []
+    for record in records:
+        if record.get('Sns'):
+            message = record['Sns'].get('Message')
+        else:
+            message = record.get('body')
 
-    # baseline logging for lambda
-    utils.configure_logging(context, LOG)
+        if not message:
+            LOG.warn('%s missing a message section: %s', name, str(record))
+            continue
 
-    if not (event and event.get('Records')):
-        LOG.warn('lambda_replication must be invoked from an SNS topic')
-        return
+        try:
+            message_json = json.loads(message)
+        except ValueError:
+            LOG.warn('%s message is not valid JSON: %s', name, message)
+            continue
 
-    records = event.get('Records')
-    for record in records:
-        sns = record.get('Sns')
-        if not sns:
-            LOG.warn('lambda_replication missing an SNS section: %s', str(event))
+        if not isinstance(message_json, dict) or 'region' not in message_json:
+            LOG.warn('%s missing specific keys: %s', name, message)
             continue
 
-        message = sns.get('Message')
-        if not message:
-            LOG.warn('lambda_replication missing a message section: %s', str(event))
+        if not REGION_NAME.match(str(message_json['region'])):
+            LOG.warn('%s message has an invalid region: %s', name, message)
             continue
 
-        message_json = json.loads(message)
+        # from a hub, messages are for a member account, reached by the role it registered
+        if 'account' in message_json and not ACCOUNT_ID.match(str(message_json['account'])):
+            LOG.warn('%s message has an invalid member account: %s', name, message)
+            continue
 
-        if 'region' not in message_json:
-            LOG.warn('lambda_replication missing specific keys: %s', str(event))
+        # a redrive can deliver the same region twice, once is enough
+        if (message_json.get('account'), message_json['region']) in \
+                [(m.get('account'), m['region']) for m in messages]:
+            LOG.info('%s skipping duplicate message: %s', name, message)
             continue
 
-        # call the snapshot cleanup method
-        replication.perform_replication(context, message_json['region'])
+        messages.append(message_json)
 
-    LOG.info('Function lambda_replication completed')
+    return messages
+
+
+def perform_messages(context, messages, perform, name):
+    """Call perform(context, region) for each message, a few regions at a time
+
+    Each region gets its share of the time left, and fails on its own. Once
+    every region has had its turn, any failures are raised together.
+    """
+    if len(messages) <= 0:
+        return
+
+    # configurations the fanout sent along save each region loading them again
+    for message in messages:
+        dynamo.accept_payload(message.get('configuration'))
+
+    # member accounts go one after the other, so count what's still to come
+    remaining = [len(messages)]
+
+    def perform_member_messages(member_messages):
+        """Do one account's regions, a few at a time"""
+        # only split the deadline if some regions would have to wait for others
+        workers = min(RECORD_WORKERS, len(member_messages))
+        share = float(workers) / remaining[0]
+        remaining[0] -= len(member_messages)
+
+        def perform_message(message):
+            """Do one region, returning None if it worked, or the region if not"""
+            region = message['region']
+            if message.get('account'):
+                region = '{}/{}'.format(message['account'], region)
+
+            record_context = context
+            if len(messages) > 1:
+                record_context = utils.DeadlineShareContext(context, share)
+
+            try:
+                perform(record_context, message['region'])
+                return None
+            except Exception:  # pylint: disable=broad-except
+                LOG.exception('%s failed in region %s', name, region)
+                return region
+
+        return utils.map_concurrently(perform_message, member_messages, workers)
+
+    results = hub.perform_by_member(messages, perform_member_messages)
+    failed = [r for r in results if r is not None]
+    if len(failed) > 0:
+        raise Exception('{} failed in {} of {} regions: {}'.format(
+            name, len(failed), len(messages), ', '.join(failed)))
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2016 Rackspace US, Inc.
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+"""Module for tracking in-flight snapshots and snapshot copies."""
+
+from __future__ import print_function
+import datetime
+import logging
+import dateutil
+from ebs_snapper import clients, utils, timeout_check
+
+LOG = logging.getLogger()
+POLL_BATCH_SIZE = 200  # snapshot ids per describe_snapshots filter
+MAX_REQUEUE_ATTEMPTS = 3
+REQUEUE_EXHAUSTED_TAG = 'requeue_exhausted'  # on a failed snapshot we gave up on
+IN_FLIGHT_STATES = ['pending', 'error']
+
+
+def in_flight_snapshot_ids(snapshot_data):
+    """Given snapshot data (e.g. from a cache), return ids that are pending or failed"""
+    return [s['SnapshotId'] for s in snapshot_data if s.get('State') in IN_FLIGHT_STATES]
+
+
+def poll_snapshots(context, region, snapshot_ids, requeue=True, now=None):
+    """Describe snapshots in batches, record their progress, and requeue any that failed"""
+    if now is None:
+        now = datetime.datetime.now(dateutil.tz.tzutc())
+
+    results = {
+        'completed': [],
+        'pending': [],
+        'error': [],
+        'missing': [],
+        'requeued': [],
+        'latency': {},
+        'progress': {},
+    }
+
+    remaining = list(set(snapshot_ids))
+    while len(remaining) > 0:
+        if timeout_check(context, 'poll_snapshots'):
+            break
+
+        batch = remaining[:POLL_BATCH_SIZE]
+        del remaining[:POLL_BATCH_SIZE]
+
+        # a filter (unlike SnapshotIds) doesn't fail the whole batch when one was deleted
+        params = {'Filters': [{'Name': 'snapshot-id', 'Values': batch}]}
+        found_ids = []
+        for page in utils.build_snapshot_paginator(params, region):
+            for snap in page.get('Snapshots', []):
+                snapshot_id = snap['SnapshotId']
+                found_ids.append(snapshot_id)
+
+                if snap['State'] == 'completed':
+                    # an upper bound, since we only see it when we look
+                    latency = now - snap['StartTime']
+                    results['latency'][snapshot_id] = latency.total_seconds()
+                    results['completed'].append(snapshot_id)
+                elif snap['State'] == 'error':
+                    results['error'].append(snapshot_id)
+                    if requeue:
+                        requeued_id = requeue_snapshot(context, region, snap)
+                        if requeued_id is not None:
+                            results['requeued'].append(requeued_id)
+                else:
+                    results['progress'][snapshot_id] = snap.get('Progress', '')
+                    results['pending'].append(snapshot_id)
+
+        results['missing'].extend([x for x in batch if x not in found_ids])
+
+    log_poll_results(region, results)
+    return results
+
+
+def log_poll_results(region, results):
+    """Log throughput numbers from a poll of in-flight snapshots"""
+    if len(results['latency']) > 0:
+        latencies = results['latency'].values()
+        LOG.info('Snapshots completed in %s: %s, latency avg %ss, max %ss',
+                 region,
+                 len(latencies),
+                 int(sum(latencies) / len(latencies)),
+                 int(max(latencies)))
+
+    for snapshot_id, progress in results['progress'].iteritems():
+        LOG.debug('Snapshot %s in %s is pending (%s)', snapshot_id, region, progress)
+
+    LOG.info('Snapshots in %s: %s completed, %s pending, %s error, %s requeued, %s missing',
+             region,
+             len(results['completed']),
+             len(results['pending']),
+             len(results['error']),
+             len(results['requeued']),
+             len(results['missing']))
+
+
+def requeue_snapshot(context, region, snapshot):
+    """Start over a failed snapshot or snapshot copy, then remove the failed one"""
+    snapshot_id = snapshot['SnapshotId']
+    tags = dict([(t['Key'], t['Value']) for t in snapshot.get('Tags', [])])
+
+    attempts = int(tags.get('requeue_count', 0))
+    if attempts >= MAX_REQUEUE_ATTEMPTS:
+        # tag it once, so it can be found, and isn't looked at again
+        if REQUEUE_EXHAUSTED_TAG not in tags:
+            LOG.warn('Snapshot %s in %s failed after %s attempts, not requeueing it',
+                     snapshot_id, region, attempts)
+            clients.get_client('ec2', region).create_tags(
+                Resources=[snapshot_id], Tags=[{'Key': REQUEUE_EXHAUSTED_TAG, 'Value': 'true'}])
+        return None
+
+    if 'replication_src_region' in tags and 'replication_snapshot_id' in tags:
+        LOG.warn('Requeueing failed copy %s of %s from %s',
+                 snapshot_id, tags['replication_snapshot_id'], tags['replication_src_region'])
+        new_snapshot_id = utils.copy_snapshot_and_tag(
+            context,
+            tags['replication_src_region'],
+            region,
+            tags.get('Name'),
+            tags['replication_snapshot_id'],
+            snapshot.get('Description', ''))
+
+        # copy limits may be hit, try again next time around
+        if new_snapshot_id is None:
+            return None
+
+        new_tags = [{'Key': 'requeue_count', 'Value': str(attempts + 1)}]
+    else:
+        LOG.warn('Requeueing failed snapshot %s of %s', snapshot_id, snapshot['VolumeId'])
+        ec2 = clients.get_client('ec2', region)
+        new_snapshot_id = ec2.create_snapshot(
+            VolumeId=snapshot['VolumeId'],
+            Description=snapshot.get('Description', '')[0:254]
+        )['SnapshotId']
+
+        new_tags = [{'Key': k, 'Value': v} for k, v in tags.iteritems()
+                    if not k.startswith('aws:') and k != 'requeue_count']
+        new_tags = new_tags[:49] + [{'Key': 'requeue_count', 'Value': str(attempts + 1)}]
+
+    ec2 = clients.get_client('ec2', region)
+    ec2.create_tags(Resources=[new_snapshot_id], Tags=new_tags)
+
+    utils.delete_snapshot(snapshot_id, region)
+    return new_snapshot_id
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2016 Rackspace US, Inc.
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+"""Module for finding the regions to work in."""
+
+from __future__ import print_function
+import functools
+import logging
+import os
+from botocore.exceptions import ClientError
+from ebs_snapper import clients, utils
+
+LOG = logging.getLogger()
+
+# which regions have instances/snapshots changes more often, so remember it for less time
+REGION_TTL = int(os.environ.get('EBS_SNAPPER_REGION_TTL', 300))
+REGION_PROBE_WORKERS = 8
+
+
+def get_regions(must_contain_instances=False, must_contain_snapshots=False, configurations=None,
+                targeted=False, select=None):
+    """Get regions, optionally filtering by regions containing instances.
+
+    When targeted, only regions some snapshot configuration applies in are
+    returned, and the others are never probed. So are the regions left out
+    by select(region_names), such as the CLI's --regions.
+    """
+    LOG.debug('get_regions(must_contain_instances=%s)', must_contain_instances)
+    region_names = filter_regions(clients.discover('all_regions', list_all_regions), configurations)
+    if targeted:
+        region_names = targeted_regions(region_names, configurations or [])
+    if select is not None:
+        region_names = select(region_names)
+
+    if not (must_contain_instances or must_contain_snapshots):
+        return region_names
+
+    # probing every region is slow, so remember the answer for a little while
+    found = clients.discover(
+        ('regions', clients.current_member(), must_contain_instances, must_contain_snapshots,
+         tuple(region_names)),
+        functools.partial(probe_regions, region_names,
+                          must_contain_instances, must_contain_snapshots),
+        ttl=REGION_TTL)
+
+    return found or []
+
+
+def list_all_regions():
+    """Every region EC2 knows about, without any caching"""
+    client = clients.get_client('ec2', 'us-east-1')
+    regions = client.describe_regions()
+    return [x['RegionName'] for x in regions['Regions']]
+
+
+def filter_regions(region_names, configurations=None):
+    """Apply the regions (allow) and ignore_regions (deny) settings to region_names"""
+    # regions on a snapshot configuration only scopes that configuration
+    settings = [x for x in configurations or [] if 'match' not in x]
+    allowed = utils.get_configuration_setting(settings, 'regions')
+    ignored = utils.get_configuration_setting(settings, 'ignore_regions', [])
+
+    return [x for x in region_names
+            if (allowed is None or utils.region_in(x, allowed)) and not utils.region_in(x, ignored)]
+
+
+def targeted_regions(region_names, configurations):
+    """The regions in region_names that at least one snapshot configuration applies in"""
+    rules = [x for x in configurations if utils.validate_snapshot_settings(x)]
+    return [r for r in region_names if any(utils.configuration_targets_region(x, r) for x in rules)]
+
+
+def probe_regions(region_names, must_contain_instances, must_contain_snapshots):
+    """Probe regions concurrently, returning those that contain instances/snapshots"""
+    if len(region_names) <= 0:
+        return []
+
+    f = functools.partial(region_matches,
+                          must_contain_instances=must_contain_instances,
+                          must_contain_snapshots=must_contain_snapshots)
+    matches = utils.map_concurrently(f, region_names, REGION_PROBE_WORKERS)
+
+    return [r for r, matched in zip(region_names, matches) if matched]
+
+
+def region_matches(region, must_contain_instances=False, must_contain_snapshots=False):
+    """Check if a region contains instances and/or snapshots, as requested"""
+    if must_contain_instances and not region_contains_instances(region):
+        return False
+
+    if must_contain_snapshots and not region_contains_snapshots(region):
+        return False
+
+    return True
+
+
+def region_contains_instances(region):
+    """Check if a region contains EC2 instances"""
+    client = clients.get_client('ec2', region)
+    try:
+        instances = client.describe_instances(
+            Filters=[{'Name': 'instance-state-name',
+                      'Values': ['running', 'stopped']}],
+            MaxResults=5
+        )
+        return 'Reservations' in instances and len(instances['Reservations']) > 0
+    except ClientError as e:
+        LOG.warn('Failed to describe instances in region %s: %s', region, str(e))
+
+        if e.response['Error']['Code'] in utils.UNSUPPORTED_REGION_EXCEPTIONS:
+            return False
+
+        raise
+
+
+def region_contains_snapshots(region):
+    """Check if a region contains snapshots instances"""
+    client = clients.get_client('ec2', region)
+    try:
+        snapshots = client.describe_snapshots(
+            OwnerIds=utils.get_owner_id(region),
+            MaxResults=5
+        )
+        return 'Snapshots' in snapshots and len(snapshots['Snapshots']) > 0
+    except ClientError as e:
+        LOG.warn('Failed to describe snapshots in region %s: %s', region, str(e))
+        if e.response['Error']['Code'] in utils.UNSUPPORTED_REGION_EXCEPTIONS:
+            return False
+
+        raise
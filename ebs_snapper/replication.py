@@ -22,44 +22,53 @@
 """Module for managing snapshot replication."""
 
 from __future__ import print_function
-from time import sleep
-import json
+from datetime import timedelta
+import datetime
+import functools
 import logging
-import boto3
-from ebs_snapper import timeout_check, dynamo, utils
+import math
+import dateutil
+from botocore.exceptions import ClientError
+from ebs_snapper import timeout_check, clients, dispatch, dynamo, hub, poller, regional, throttle
+from ebs_snapper import utils, work
 
 
 LOG = logging.getLogger()
+REPLICATION_POLICIES = ['fifo', 'small_first', 'age_weighted', 'rpo_deadline']
+DEFAULT_REPLICATION_POLICY = 'fifo'
+DEFAULT_REPLICATION_COPY_SLOTS = 5  # concurrent copies allowed per destination region
+DEFAULT_REPLICATION_RPO = timedelta(hours=24)
 
 
-def perform_fanout_all_regions(context, cli=False):
+def perform_fanout_all_regions(context, cli=False, installed_region='us-east-1', run=None):
     """For every region, send a message (lambda) or run replication (cli)"""
+    hub.fanout_accounts(context, installed_region, functools.partial(
+        perform_fanout_account, context, cli=cli, installed_region=installed_region, run=run))
 
-    sns_topic = utils.get_topic_arn('ReplicationSnapshotTopic')
-    LOG.debug('perform_fanout_all_regions using SNS topic %s', sns_topic)
 
-    # get regions with instances running or stopped
-    regions = utils.get_regions(must_contain_snapshots=True)
-    for region in regions:
-        sleep(5)  # API rate limiting help
+def perform_fanout_account(context, member, cli=False, installed_region='us-east-1', run=None):
+    """For every region of this account, or a hub's member, send a message or run replication"""
+    # get regions with snapshots
+    configurations = dynamo.load_configurations(context, installed_region)
+    regions = regional.get_regions(must_contain_snapshots=True, configurations=configurations,
+                                   select=run.select if run is not None else None)
 
-        send_fanout_message(
-            context=context,
-            region=region,
-            sns_topic=sns_topic,
-            cli=cli)
+    # the CLI may only do some regions, each with its own deadline
+    local_handler = functools.partial(perform_fanout_message, context)
+    if run is not None:
+        regions, local_handler = run.prepare(regions, configurations,
+                                             perform_fanout_message, context)
 
+    # send the configurations along, so every region works from the same ones
+    payload = None if cli else dynamo.build_payload(context, installed_region)
+    dispatch.fanout('replication', regions, configurations, local_handler,
+                    cli=cli, installed_region=installed_region, payload=payload,
+                    member=member, run=run)
 
-def send_fanout_message(context, region, sns_topic, cli=False):
-    """Send message to perform replication in region."""
 
-    message = json.dumps({'region': region})
-    LOG.debug('send_fanout_message: %s', message)
-
-    if cli:
-        perform_replication(context, region)
-    else:
-        utils.sns_publish(TopicArn=sns_topic, Message=message)
+def perform_fanout_message(context, message):
+    """Perform replication for the region in a fanout message, in this process"""
+    perform_replication(context, message['region'])
 
 
 def perform_replication(context, region, installed_region='us-east-1'):
@@ -69,13 +78,16 @@ def perform_replication(context, region, installed_region='us-east-1'):
     # TL;DR -- always try to clean up first, before making new copies.
 
     # build a list of ignore IDs, just in case they are relevant here
-    configurations = dynamo.list_configurations(context, installed_region)
+    configurations = dynamo.load_configurations(context, installed_region)
     ignore_ids = utils.build_ignore_list(configurations)
     LOG.debug('Fetched all configured ignored IDs rules from DynamoDB')
+    throttle.configure(utils.get_configuration_setting(configurations, 'api_rates'))
 
     # 1. collect snapshots from this region
     snap_cached_src_regions = []
     snap_cached_dst_regions = []
+    dst_in_flight_ids = {}
+    dst_failed_copies = {}
     src_snap_list = []
     replication_snap_list = []
     relevant_tags = ['replication_src_region', 'replication_dst_region']
@@ -96,24 +108,23 @@ def perform_replication(context, region, installed_region='us-east-1'):
             LOG.info('Caching snapshots in source region: %s', region_tag_value)
             snap_cached_src_regions.append(region_tag_value)
 
-            ec2_source = boto3.client('ec2', region_name=region_tag_value)
+            ec2_source = clients.get_client('ec2', region_tag_value)
             try:
                 response = ec2_source.describe_snapshots(
                     Filters=[{'Name': 'tag:replication_dst_region', 'Values': [region]}]
                 )
                 mysnaps = response['Snapshots']
-            except Exception as err:
-                if 'InvalidSnapshot.NotFound' in str(err):
-                    mysnaps = {'Snapshots', []}
+            except ClientError as err:
+                if err.response['Error']['Code'] == 'InvalidSnapshot.NotFound':
+                    mysnaps = []
                 else:
-                    raise err
+                    raise
 
             for snap in mysnaps:
                 src_snap_list.append(snap['SnapshotId'])
 
             LOG.info('Caching completed for source region: ' + region_tag_value + ': cache size: ' +
                      str(len(src_snap_list)))
-            sleep(1)
 
     # 1b. build snapshot cache for all destination regions
     for snapshot_regions in found_snapshots.get('replication_dst_region', []):
@@ -125,28 +136,34 @@ def perform_replication(context, region, installed_region='us-east-1'):
             LOG.info('Caching snapshots in destination region: %s', region_tag_value)
             snap_cached_dst_regions.append(region_tag_value)
 
-            ec2_source = boto3.client('ec2', region_name=region_tag_value)
+            ec2_source = clients.get_client('ec2', region_tag_value)
             try:
                 response = ec2_source.describe_snapshots(
                     Filters=[{'Name': 'tag:replication_src_region', 'Values': [region]}]
                 )
                 mysnaps = response['Snapshots']
-            except Exception as err:
-                if 'InvalidSnapshot.NotFound' in str(err):
-                    mysnaps = {'Snapshots', []}
+            except ClientError as err:
+                if err.response['Error']['Code'] == 'InvalidSnapshot.NotFound':
+                    mysnaps = []
                 else:
-                    raise err
+                    raise
 
             for snap in mysnaps:
+                # only a running copy takes a copy slot, failed ones are requeued in 3b
+                if snap.get('State') == 'pending':
+                    dst_in_flight_ids.setdefault(region_tag_value, []).append(snap['SnapshotId'])
+                elif snap.get('State') == 'error':
+                    dst_failed_copies.setdefault(region_tag_value, []).append(snap)
+
                 for tags in snap['Tags']:
                     if tags["Key"] == 'replication_snapshot_id':
                         replication_snap_list.append(tags["Value"])
 
             LOG.info('Caching completed for destination region: ' + region_tag_value +
                      ': cache size: ' + str(len(replication_snap_list)))
-            sleep(1)
 
     # 2. evaluate snapshots that were copied to this region, if source not found, delete
+    queue = work.WorkQueue(context, configurations, installed_region)
     for snapshot in found_snapshots.get('replication_src_region', []):
         snapshot_id = snapshot['SnapshotId']
         snapshot_description = snapshot['Description']
@@ -184,10 +201,10 @@ def perform_replication(context, region, installed_region='us-east-1'):
         LOG.warn('Removing this snapshot ' + snapshot_id + ' from ' + region +
                  ' since snapshot_id ' + snapshotid_tag_value +
                  ' was not found in ' + region_tag_value)
-        utils.delete_snapshot(snapshot_id, region)
-        sleep(2)
+        queue.submit(work.delete_item(snapshot_id, region))
 
-    # 3. evaluate snapshots that should be copied from this region, if dest not found, copy and tag
+    # 3. evaluate snapshots that should be copied from this region, if dest not found, queue it
+    copy_candidates = []
     for snapshot in found_snapshots.get('replication_dst_region', []):
         snapshot_id = snapshot['SnapshotId']
         snapshot_description = snapshot['Description']
@@ -221,13 +238,198 @@ def perform_replication(context, region, installed_region='us-east-1'):
                      ' was already found in ' + region_tag_value)
             continue
 
+        copy_candidates.append({
+            'snapshot': snapshot,
+            'region': region_tag_value,
+            'name': name_tag_value
+        })
+
+    # 3b. start failed copies over, ahead of new ones, while there are slots for them
+    settings = get_replication_settings(configurations)
+    destinations = set(dst_failed_copies.keys()) | set(c['region'] for c in copy_candidates)
+    dst_copies_in_flight = dict([(dst, count_pending_copies(context, dst))
+                                 for dst in destinations])
+    requeue_failed_copies(context, dst_failed_copies, dst_in_flight_ids, dst_copies_in_flight,
+                          settings['copy_slots'])
+
+    # 4. fill the available copy slots in each destination region, by policy
+    scheduled = schedule_replication_copies(copy_candidates, settings, dst_copies_in_flight)
+
+    for candidate in scheduled:
+        if timeout_check(context, 'perform_replication'):
+            break
+
+        snapshot = candidate['snapshot']
+        snapshot_id = snapshot['SnapshotId']
+        region_tag_value = candidate['region']
+
         # we need to make one in the target region
         LOG.warn('Creating a new snapshot, since snapshot_id ' + snapshot_id +
                  ' was not already found in ' + region_tag_value)
-        utils.copy_snapshot_and_tag(
-            context,
+        created_snapshot_id = queue.submit(work.copy_item(
             region,
             region_tag_value,
-            name_tag_value,
+            candidate['name'],
             snapshot_id,
-            snapshot_description)
+            snapshot['Description']))
+
+        if created_snapshot_id is not None:
+            dst_in_flight_ids.setdefault(region_tag_value, []).append(created_snapshot_id)
+
+    queue.flush()
+    if queue.queued > 0:
+        LOG.info('Queued %s snapshot deletes and copies from %s', queue.queued, region)
+
+    # 5. follow up on copies still in flight to each destination region
+    for dst_region, snapshot_ids in dst_in_flight_ids.iteritems():
+        if timeout_check(context, 'perform_replication'):
+            break
+
+        poller.poll_snapshots(context, dst_region, snapshot_ids)
+
+
+def count_pending_copies(context, dst_region):
+    """Count every copy still running into dst_region, from whichever source region"""
+    params = {
+        'Filters': [{'Name': 'tag-key', 'Values': ['replication_src_region']},
+                    {'Name': 'status', 'Values': ['pending']}],
+        'OwnerIds': utils.get_owner_id(context),
+    }
+    return sum(len(page.get('Snapshots', []))
+               for page in utils.build_snapshot_paginator(params, dst_region))
+
+
+def requeue_failed_copies(context, failed_copies, in_flight_ids, copies_in_flight, copy_slots):
+    """Requeue failed copies (by destination region) into free slots
+
+    A requeued copy is added to in_flight_ids and counted in copies_in_flight.
+    Copies that failed too often are tagged and left alone, see poller.requeue_snapshot.
+    """
+    for dst_region, snapshots in failed_copies.iteritems():
+        for snap in snapshots:
+            if timeout_check(context, 'requeue_failed_copies'):
+                return
+
+            if copies_in_flight.get(dst_region, 0) >= copy_slots:
+                LOG.info('No copy slots left in %s, deferring failed copy %s',
+                         dst_region, snap['SnapshotId'])
+                break
+
+            new_snapshot_id = poller.requeue_snapshot(context, dst_region, snap)
+            if new_snapshot_id is not None:
+                in_flight_ids.setdefault(dst_region, []).append(new_snapshot_id)
+                copies_in_flight[dst_region] = copies_in_flight.get(dst_region, 0) + 1
+
+
+def get_replication_settings(configurations):
+    """Determine the account-wide replication copy policy from configurations"""
+    policy = utils.get_configuration_setting(
+        configurations, 'replication_policy', DEFAULT_REPLICATION_POLICY)
+    if policy not in REPLICATION_POLICIES:
+        LOG.warn('Unknown replication_policy %s, using %s', policy, DEFAULT_REPLICATION_POLICY)
+        policy = DEFAULT_REPLICATION_POLICY
+
+    from pytimeparse.timeparse import timeparse
+    # a snapshot configuration's own RPO is stamped on its snapshots instead
+    settings = [x for x in configurations if 'match' not in x]
+    rpo = utils.get_configuration_setting(settings, 'replication_rpo', None)
+    max_gib = utils.get_configuration_setting(configurations, 'replication_max_gib', None)
+
+    return {
+        'policy': policy,
+        'copy_slots': int(utils.get_configuration_setting(
+            configurations, 'replication_copy_slots', DEFAULT_REPLICATION_COPY_SLOTS)),
+        'rpo': timedelta(seconds=timeparse(rpo)) if rpo else None,
+        'max_gib': int(max_gib) if max_gib else None
+    }
+
+
+def replication_priority(snapshot):
+    """Return the replication_priority tag of a snapshot (higher is sooner), default 0"""
+    for tag in snapshot.get('Tags', []):
+        if tag.get('Key') != 'replication_priority':
+            continue
+
+        try:
+            return int(tag.get('Value'))
+        except (TypeError, ValueError):
+            LOG.warn('Ignoring non-integer replication_priority on %s', snapshot['SnapshotId'])
+
+    return 0
+
+
+def replication_rpo(snapshot, default=None):
+    """Return the replication_rpo tag of a snapshot as a timedelta, or default"""
+    from pytimeparse.timeparse import timeparse
+    for tag in snapshot.get('Tags', []):
+        if tag.get('Key') != 'replication_rpo':
+            continue
+
+        seconds = timeparse(tag.get('Value') or '')
+        if seconds:
+            return timedelta(seconds=seconds)
+        LOG.warn('Ignoring unparseable replication_rpo on %s', snapshot['SnapshotId'])
+
+    return default
+
+
+def replication_sort_key(policy, snapshot, now, rpo=None):
+    """Build a sort key for a snapshot copy candidate, smallest key copies first"""
+    size = max(snapshot.get('VolumeSize', 1), 1)
+    age_seconds = (now - snapshot['StartTime']).total_seconds()
+    priority = -replication_priority(snapshot)
+
+    if policy == 'small_first':
+        return (priority, size, -age_seconds)
+    elif policy == 'age_weighted':
+        # older snapshots gain weight, so large ones can't starve forever
+        return (priority, -(age_seconds / math.sqrt(size)))
+    elif policy == 'rpo_deadline':
+        # earliest deadline first, when tied, the smaller (faster) copy wins
+        deadline = replication_rpo(snapshot, rpo or DEFAULT_REPLICATION_RPO)
+        slack = deadline.total_seconds() - age_seconds
+        return (priority, slack, size)
+
+    # fifo, just the oldest first
+    return (priority, -age_seconds)
+
+
+def schedule_replication_copies(candidates, settings, in_flight=None, now=None):
+    """Order copy candidates by policy, then pack them into each destination's free slots"""
+    if now is None:
+        now = datetime.datetime.now(dateutil.tz.tzutc())
+    in_flight = in_flight or {}
+
+    ordered = sorted(
+        candidates,
+        key=lambda c: replication_sort_key(settings['policy'], c['snapshot'], now, settings['rpo']))
+
+    free_slots = {}
+    free_gib = {}
+    scheduled = []
+    for candidate in ordered:
+        dst = candidate['region']
+        if dst not in free_slots:
+            free_slots[dst] = settings['copy_slots'] - in_flight.get(dst, 0)
+            free_gib[dst] = settings['max_gib']
+
+        if free_slots[dst] <= 0:
+            LOG.info('No copy slots left in %s, deferring snapshot %s',
+                     dst, candidate['snapshot']['SnapshotId'])
+            continue
+
+        # a smaller snapshot may still fit, so keep going rather than stopping here
+        size = candidate['snapshot'].get('VolumeSize', 0)
+        if free_gib[dst] is not None and size > free_gib[dst]:
+            LOG.info('Copy budget left in %s is %sGiB, deferring snapshot %s (%sGiB)',
+                     dst, free_gib[dst], candidate['snapshot']['SnapshotId'], size)
+            continue
+
+        free_slots[dst] -= 1
+        if free_gib[dst] is not None:
+            free_gib[dst] -= size
+        scheduled.append(candidate)
+
+    LOG.info('Scheduled %s of %s snapshot copies using the %s policy',
+             len(scheduled), len(candidates), settings['policy'])
+    return scheduled
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2016 Rackspace US, Inc.
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+"""Module for state kept across warm invocations of the same Lambda container."""
+
+from __future__ import print_function
+import logging
+import os
+import threading
+
+LOG = logging.getLogger()
+
+# warm containers re-use configuration for this long before loading it again, in seconds
+CONFIG_TTL = int(os.environ.get('EBS_SNAPPER_CONFIG_TTL', 60))
+
+# one pool for the whole container, each caller limits how much of it they use
+POOL_SIZE = int(os.environ.get('EBS_SNAPPER_POOL_SIZE', 16))
+
+
+# each cache sits next to its own lock, so one busy cache never holds up the others
+class RuntimeState(object):  # pylint: disable=too-many-instance-attributes
+    """Everything worth keeping from one invocation of a warm container to the next
+
+    Clients, control-plane lookups, configuration (and what was compiled from
+    it) and the thread pool all live here. reset() throws it all away, which
+    is what to do whenever an invocation fails, in case the failure was
+    something we remembered (expired credentials, a deleted topic, ...).
+    """
+
+    def __init__(self):
+        self.clients = {}
+        self.clients_lock = threading.Lock()
+        self.discovered = {}
+        self.discovered_lock = threading.Lock()
+        self.configurations = {}
+        self.compiled = {}
+        self.configurations_lock = threading.Lock()
+        self.pool = None
+        self.pool_lock = threading.Lock()
+        self.member = None
+        self.member_sessions = {}
+        self.logging_configured = False
+        self.invocations = 0
+
+    def get_pool(self):
+        """Return the shared thread pool, creating it on first use"""
+        with self.pool_lock:
+            if self.pool is None:
+                from multiprocessing.pool import ThreadPool
+                self.pool = ThreadPool(processes=POOL_SIZE)
+            return self.pool
+
+    def map(self, f, items, workers):
+        """Like map(f, items), on at most workers threads of the shared pool
+
+        f must not use the shared pool itself, or it could wait forever on
+        threads that are all busy waiting on it.
+        """
+        if len(items) <= 0:
+            return []
+
+        if workers <= 1:
+            return [f(x) for x in items]
+
+        pool = self.get_pool()
+        slots = threading.BoundedSemaphore(min(workers, POOL_SIZE))
+
+        def run(item):
+            """Call f, then give the slot to the next item"""
+            try:
+                return f(item)
+            finally:
+                slots.release()
+
+        results = []
+        for item in items:
+            slots.acquire()
+            results.append(pool.apply_async(run, (item,)))
+
+        return [r.get() for r in results]
+
+    def reset(self):
+        """Forget everything, so the next invocation starts like a cold one"""
+        with self.clients_lock:
+            self.clients.clear()
+            self.member = None
+            self.member_sessions.clear()
+        with self.discovered_lock:
+            self.discovered.clear()
+        with self.configurations_lock:
+            self.configurations.clear()
+            self.compiled.clear()
+        with self.pool_lock:
+            if self.pool is not None:
+                self.pool.terminate()
+                self.pool = None
+
+
+STATE = RuntimeState()
@@ -22,18 +22,26 @@
 """ebs-snapper - Commandline tool to run lambda jobs for EBS Snapper locally"""
 
 from __future__ import print_function
+import functools
 import logging
 import sys
+import time
 import traceback
 import argparse
 import json
+import tempfile
 
 import ebs_snapper
-from ebs_snapper import snapshot, clean, replication, dynamo, utils, deploy
+from ebs_snapper import snapshot, clean, replication, clients, dispatch, dynamo, utils
 
 LOG = logging.getLogger()
 CTX = utils.ShellContext()
 
+# for running against many accounts at once
+DEFAULT_ROLE_NAME = 'OrganizationAccountAccessRole'
+DEFAULT_ACCOUNT_WORKERS = 4
+DEFAULT_ACCOUNT_TIMEOUT = 90  # minutes, the same as a single account run
+
 
 def main(arv=None):
     """ebs-snapper command line interface."""
@@ -62,6 +70,20 @@ def main(arv=None):
                         nargs='?', default='us-east-1',
                         help="dynamodb & SNS region used by ebs-snapper (us-east-1 is default)")
 
+    # many accounts at once
+    parser.add_argument('--accounts', dest='accounts', metavar='FILE', default=None,
+                        help="run against each account_id[,role_arn] line of FILE (- for stdin)")
+    parser.add_argument('--role_name', dest='role_name', default=DEFAULT_ROLE_NAME,
+                        help="role to assume when a line has no role_arn "
+                             "(default {})".format(DEFAULT_ROLE_NAME))
+    parser.add_argument('--account_workers', dest='account_workers', type=int,
+                        default=DEFAULT_ACCOUNT_WORKERS,
+                        help="accounts to run at once (default {})".format(DEFAULT_ACCOUNT_WORKERS))
+    parser.add_argument('--account_timeout', dest='account_timeout', type=int,
+                        default=DEFAULT_ACCOUNT_TIMEOUT,
+                        help="minutes each account may run (default {})".format(
+                            DEFAULT_ACCOUNT_TIMEOUT))
+
     # Sub-commands & help
     subparsers = parser.add_subparsers(help='sub-command help')
 
@@ -71,6 +93,7 @@ def main(arv=None):
     '''
     parser_snapshot = subparsers.add_parser('snapshot', help=snapshot_help)
     parser_snapshot.set_defaults(func=shell_fanout_snapshot)
+    add_region_arguments(parser_snapshot)
 
     # clean subcommand (fanout)
     clean_help = '''
@@ -78,6 +101,7 @@ def main(arv=None):
     '''
     parser_clean = subparsers.add_parser('clean', help=clean_help)
     parser_clean.set_defaults(func=shell_fanout_clean)
+    add_region_arguments(parser_clean)
 
     # snapshot replication subcommand (fanout)
     snapshot_replication_help = '''
@@ -86,6 +110,43 @@ def main(arv=None):
     parser_snapshot_replication = subparsers.add_parser('replication',
                                                         help=snapshot_replication_help)
     parser_snapshot_replication.set_defaults(func=shell_fanout_snapshot_replication)
+    add_region_arguments(parser_snapshot_replication)
+
+    # daemon subcommand (the fanouts, on their schedules)
+    daemon_help = '''
+        run snapshot, clean and replication on their schedules, until stopped
+    '''
+    parser_daemon = subparsers.add_parser('daemon', help=daemon_help)
+    parser_daemon.add_argument('--snapshot_schedule', dest='snapshot_schedule', default=None,
+                               help="rate(...) or cron(...), or off (default rate(30 minutes))")
+    parser_daemon.add_argument('--clean_schedule', dest='clean_schedule', default=None,
+                               help="rate(...) or cron(...), or off (default rate(6 hours))")
+    parser_daemon.add_argument('--replication_schedule', dest='replication_schedule',
+                               default=None,
+                               help="rate(...) or cron(...), or off (default rate(30 minutes))")
+    parser_daemon.add_argument('--job_timeout', dest='job_timeout', type=int, default=90,
+                               help="minutes each run of a job may take (default 90)")
+    parser_daemon.add_argument('--status_address', dest='status_address', default='127.0.0.1',
+                               help="address for /health and /metrics (default 127.0.0.1)")
+    parser_daemon.add_argument('--status_port', dest='status_port', type=int, default=8642,
+                               help="port for /health and /metrics, 0 for none (default 8642)")
+    parser_daemon.set_defaults(func=shell_daemon)
+    add_region_arguments(parser_daemon)
+
+    # inventory subcommand (every volume and snapshot, streamed)
+    inventory_help = '''
+        list every volume and snapshot, with retention and replication tags
+    '''
+    parser_inventory = subparsers.add_parser('inventory', help=inventory_help)
+    parser_inventory.add_argument('-f', '--format', dest='inventory_format', default='ndjson',
+                                  choices=['ndjson', 'csv'],
+                                  help="ndjson (one JSON object per line) or csv (default ndjson)")
+    parser_inventory.add_argument('-o', '--output', dest='inventory_output', default='-',
+                                  metavar='FILE', help="file to write (default - for stdout)")
+    parser_inventory.add_argument('-z', '--gzip', dest='inventory_gzip', action='store_const',
+                                  const=True, default=False, help="gzip what's written")
+    parser_inventory.set_defaults(func=shell_inventory)
+    add_region_arguments(parser_inventory)
 
     # deploy subcommand
     deploy_help = '''
@@ -99,6 +160,11 @@ def main(arv=None):
                                action='store_const', const=True, default=False)
     parser_deploy.add_argument('-o', '--no_stack', dest='no_stack',
                                action='store_const', const=True, default=False)
+    parser_deploy.add_argument('--hub', dest='hub', action='store_const', const=True,
+                               default=None,
+                               help="work on registered member accounts instead of this one")
+    parser_deploy.add_argument('--no_hub', dest='hub', action='store_const', const=False,
+                               help="work on this account only")
     parser_deploy.set_defaults(func=shell_deploy)
 
     # configure subcommand (get, set, delete)
@@ -126,6 +192,18 @@ def main(arv=None):
     action_group.add_argument('-d', '--delete', dest='conf_action', action='store_const',
                               const='del',
                               help="Delete configuration item")
+    action_group.add_argument('-i', '--import', dest='conf_import', metavar='FILE',
+                              help="Import configuration items from NDJSON (- for stdin)")
+    action_group.add_argument('-x', '--export', dest='conf_export', metavar='FILE',
+                              help="Export configuration items as NDJSON (- for stdout)")
+    action_group.add_argument('-r', '--register', dest='conf_register', metavar='ROLE_ARN',
+                              help="Register the account as a hub member, reached by ROLE_ARN")
+    action_group.add_argument('--deregister', dest='conf_action', action='store_const',
+                              const='deregister',
+                              help="Deregister the account as a hub member")
+    action_group.add_argument('--members', dest='conf_action', action='store_const',
+                              const='members',
+                              help="List hub member accounts")
     action_group.set_defaults(conf_action=None)
 
     # configure parameters
@@ -141,7 +219,10 @@ def main(arv=None):
         # baseline logging for shell, ensure boto stays quiet
         utils.configure_logging(CTX, LOG, args.loglevel)
 
-        args.func(args)
+        if args.accounts:
+            shell_multi_account(args)
+        else:
+            args.func(args)
     except Exception:  # pylint: disable=broad-except
         print('Unexpected error. Please report this traceback.', file=sys.stderr)
 
@@ -150,36 +231,129 @@ def main(arv=None):
         sys.exit(1)
 
 
+def add_region_arguments(subparser):
+    """Arguments for which regions a subcommand does, and how many at once"""
+    subparser.add_argument('--regions', dest='regions', default=None,
+                           help="comma separated regions (or patterns like us-*) to do")
+    subparser.add_argument('--exclude_regions', '--exclude-regions', dest='exclude_regions',
+                           default=None,
+                           help="comma separated regions (or patterns) to skip")
+    subparser.add_argument('--workers', dest='workers', type=int, default=None,
+                           help="regions to do at once (default local_workers, or 4)")
+    subparser.add_argument('--region_timeout', dest='region_timeout', type=int, default=None,
+                           help="minutes each region may take (default a fair share)")
+
+
+def build_region_run(args):
+    """A RegionRun for the region arguments of a subcommand"""
+    def split(value):
+        """A comma separated argument as a list, or None"""
+        if value is None:
+            return None
+        return [x.strip() for x in value.split(',') if x.strip()]
+
+    return dispatch.RegionRun(
+        regions=split(args.regions),
+        exclude_regions=split(args.exclude_regions),
+        workers=args.workers,
+        region_timeout=args.region_timeout)
+
+
+def print_region_summary(run):
+    """Print how each region went, and raise if any failed"""
+    if len(run.results) <= 0:
+        print('No regions were done')
+        return
+
+    print('region,result,seconds')
+    for region, elapsed, error in sorted(run.results):
+        print('{},{},{:.1f}'.format(region, 'failed' if error else 'ok', elapsed))
+
+    # only once every region has had its turn
+    failures = run.failures()
+    if len(failures) > 0:
+        raise Exception('{} of {} regions failed: {}'.format(
+            len(failures), len(run.results), ', '.join(sorted(failures))))
+
+
 def shell_fanout_snapshot(*args):
-    """Print fanout JSON messages, instead of sending them like lambda version."""
-    # for every region and every instance, send to this function
-    snapshot.perform_fanout_all_regions(CTX, cli=True)
+    """Take any snapshots that are due, doing regions here instead of sending messages"""
+    run = build_region_run(args[0])
+    snapshot.perform_fanout_all_regions(CTX, cli=True, run=run)
+    print_region_summary(run)
     LOG.info('Function shell_fanout_snapshot completed')
 
 
 def shell_fanout_clean(*args):
-    """Print fanout JSON messages, instead of sending them like lambda version."""
-    # for every region, send to this function
-    clean.perform_fanout_all_regions(CTX, cli=True)
+    """Clean up expired snapshots, doing regions here instead of sending messages"""
+    run = build_region_run(args[0])
+    clean.perform_fanout_all_regions(CTX, cli=True, run=run)
+    print_region_summary(run)
     LOG.info('Function shell_fanout_clean completed')
 
 
 def shell_fanout_snapshot_replication(*args):
-    """Print fanout JSON messages, instead of sending them like lambda version."""
-    # for every region and every instance, send to this function
-    replication.perform_fanout_all_regions(CTX, cli=True)
+    """Replicate snapshots, doing regions here instead of sending messages"""
+    run = build_region_run(args[0])
+    replication.perform_fanout_all_regions(CTX, cli=True, run=run)
+    print_region_summary(run)
     LOG.info('Function shell_fanout_snapshot_replication completed')
 
 
+def shell_daemon(*args):
+    """Run the fanout jobs on their schedules in this process, until stopped."""
+    # only a long-lived process needs the scheduler and status server
+    from ebs_snapper import daemon
+
+    jobs = daemon.build_jobs({
+        'snapshot': args[0].snapshot_schedule,
+        'clean': args[0].clean_schedule,
+        'replication': args[0].replication_schedule,
+    })
+    snapper = daemon.Daemon(
+        jobs,
+        installed_region=args[0].conf_toolregion,
+        job_timeout=args[0].job_timeout,
+        build_run=functools.partial(build_region_run, args[0]))
+    daemon.serve(snapper, args[0].status_address, args[0].status_port)
+
+    LOG.info('Function shell_daemon completed')
+
+
+def shell_inventory(*args):
+    """Stream every volume and snapshot, region by region, to stdout or a file."""
+    # only an export needs the writers
+    from ebs_snapper import inventory
+
+    stream = inventory.open_output(args[0].inventory_output, args[0].inventory_gzip)
+    try:
+        inventory.export(
+            CTX,
+            stream,
+            build_region_run(args[0]),
+            output_format=args[0].inventory_format,
+            installed_region=args[0].conf_toolregion)
+    finally:
+        if stream is not sys.stdout:
+            stream.close()
+        sys.stdout.flush()
+
+    LOG.info('Function shell_inventory completed')
+
+
 def shell_deploy(*args):
     """Deploy this tool to a given account."""
+    # packaging and upload machinery, only loaded when deploying
+    from ebs_snapper import deploy
+
     # call the snapshot cleanup method
     deploy.deploy(
         CTX,
         aws_account_id=args[0].aws_account_id,
         no_build=args[0].no_build,
         no_upload=args[0].no_upload,
-        no_stack=args[0].no_stack
+        no_stack=args[0].no_stack,
+        hub=args[0].hub
     )
 
     LOG.info('Function shell_deploy completed')
@@ -197,11 +371,18 @@ def shell_configure(*args):
 
     object_id = args[0].object_id
     action = args[0].conf_action
+    if args[0].conf_import:
+        action = 'import'
+    elif args[0].conf_export:
+        action = 'export'
+    elif args[0].conf_register:
+        action = 'register'
     installed_region = args[0].conf_toolregion
     extra = args[0].extra
 
     if action == 'check':
         LOG.debug('Sanity checking configurations for %s', aws_account_id)
+        from ebs_snapper import deploy
         findings = deploy.sanity_check(
             CTX,
             installed_region,
@@ -260,8 +441,162 @@ def shell_configure(*args):
             installed_region,
             object_id=object_id,
             aws_account_id=aws_account_id))
+    elif action == 'import':
+        count = import_configurations(installed_region, aws_account_id, args[0].conf_import)
+        print('Imported {} configurations'.format(count), file=sys.stderr)
+    elif action == 'export':
+        count = export_configurations(installed_region, aws_account_id, args[0].conf_export)
+        print('Exported {} configurations'.format(count), file=sys.stderr)
+    elif action == 'register':
+        dynamo.register_member(installed_region, aws_account_id, args[0].conf_register)
+        print('Registered {} as a member, reached by {}'.format(
+            aws_account_id, args[0].conf_register))
+    elif action == 'deregister':
+        dynamo.deregister_member(installed_region, aws_account_id)
+        print('Deregistered {} as a member'.format(aws_account_id))
+    elif action == 'members':
+        print("aws_account_id,role_arn")
+        for member_account_id, role_arn in dynamo.list_members(installed_region):
+            print("{},{}".format(member_account_id, role_arn))
     else:
         # should never get here, from argparse
         raise Exception('invalid parameters', args)
 
     LOG.info('Function shell_configure completed')
+
+
+def read_configuration_lines(stream, aws_account_id):
+    """Yield (line number, aws_account_id, id, configuration) for each NDJSON line"""
+    for line_no, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+
+        try:
+            item = json.loads(line)
+            yield (line_no,
+                   str(item.get('aws_account_id') or aws_account_id),
+                   item['id'],
+                   item['configuration'])
+        except Exception as e:
+            raise Exception('line {}: not a configuration item: {}'.format(line_no, e))
+
+
+def import_configurations(installed_region, aws_account_id, filename):
+    """Validate every item in an NDJSON file, then store them all with batched writes"""
+    if filename == '-':
+        # the file is read twice, so stdin is spooled somewhere we can rewind
+        stream = tempfile.TemporaryFile()
+        for line in sys.stdin:
+            stream.write(line)
+    else:
+        stream = open(filename, 'r')
+
+    try:
+        # nothing is written unless every item is good
+        stream.seek(0)
+        for line_no, _, object_id, configuration in read_configuration_lines(
+                stream, aws_account_id):
+            try:
+                dynamo.validate_configuration(object_id, configuration)
+            except Exception as e:
+                raise Exception('line {}: {}: {}'.format(line_no, object_id, e))
+
+        stream.seek(0)
+        items = ((account, object_id, configuration) for _, account, object_id, configuration
+                 in read_configuration_lines(stream, aws_account_id))
+        return dynamo.store_configurations(installed_region, items)
+    finally:
+        stream.close()
+
+
+def export_configurations(installed_region, aws_account_id, filename):
+    """Write every configuration item for an account as NDJSON, a page at a time"""
+    stream = sys.stdout if filename == '-' else open(filename, 'w')
+    count = 0
+    try:
+        for item in dynamo.export_configurations(CTX, installed_region, aws_account_id):
+            stream.write(json.dumps(item, sort_keys=True) + '\n')
+            count += 1
+    finally:
+        if stream is not sys.stdout:
+            stream.close()
+
+    return count
+
+
+def read_accounts(filename, role_name):
+    """Read (account id, role arn) pairs from account_id[,role_arn] lines"""
+    stream = sys.stdin if filename == '-' else open(filename, 'r')
+    try:
+        accounts = []
+        for line in stream:
+            line = line.split('#', 1)[0].strip()
+            if not line:
+                continue
+
+            fields = [x.strip() for x in line.split(',')]
+            role_arn = fields[1] if len(fields) > 1 and fields[1] else \
+                clients.role_arn_for(fields[0], role_name)
+            accounts.append((fields[0], role_arn))
+
+        return accounts
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+
+
+def shell_multi_account(args):
+    """Run a subcommand against many accounts, a process per account, reporting as each ends"""
+    multi_account_funcs = [shell_fanout_snapshot, shell_fanout_clean,
+                           shell_fanout_snapshot_replication, shell_deploy]
+    if args.func not in multi_account_funcs and \
+            not (args.func == shell_configure and args.conf_action == 'check'):
+        raise Exception('--accounts works with snapshot, clean, replication, '
+                        'configure --check and deploy')
+
+    accounts = read_accounts(args.accounts, args.role_name)
+    if len(accounts) <= 0:
+        raise Exception('No accounts found in {}'.format(args.accounts))
+
+    # every account deploys the same package, so build it once, before the processes start
+    if args.func == shell_deploy and not args.no_build:
+        from ebs_snapper import deploy
+        deploy.build()
+        args.no_build = True
+
+    # a fresh process for every account, so credentials and caches never cross over
+    from multiprocessing import Pool
+    pool = Pool(processes=max(min(args.account_workers, len(accounts)), 1), maxtasksperchild=1)
+    failures = []
+    try:
+        for aws_account_id, error, elapsed in pool.imap_unordered(
+                functools.partial(run_account, args), accounts):
+            if error is None:
+                print('{}: completed in {:.1f}s'.format(aws_account_id, elapsed))
+            else:
+                print('{}: failed in {:.1f}s: {}'.format(aws_account_id, elapsed, error))
+                failures.append(aws_account_id)
+            sys.stdout.flush()
+    finally:
+        pool.close()
+        pool.join()
+
+    LOG.info('Function shell_multi_account completed')
+    if len(failures) > 0:
+        raise Exception('{} of {} accounts failed: {}'.format(
+            len(failures), len(accounts), ', '.join(failures)))
+
+
+def run_account(args, account):
+    """Run a subcommand against one account, returning (account id, error or None, seconds)"""
+    aws_account_id, role_arn = account
+    started = time.time()
+    try:
+        clients.use_account(aws_account_id, role_arn)
+        CTX.set_remaining_time_in_millis(60000 * args.account_timeout)
+        args.aws_account_id = aws_account_id
+        args.func(args)
+        return aws_account_id, None, time.time() - started
+    except Exception as e:  # pylint: disable=broad-except
+        LOG.exception('Account %s failed', aws_account_id)
+        return aws_account_id, str(e) or e.__class__.__name__, time.time() - started
@@ -22,27 +22,29 @@
 """Module for doing EBS snapshots."""
 
 from __future__ import print_function
-from time import sleep
+import functools
 import json
 import logging
 from datetime import timedelta
 import datetime
 import dateutil
-import boto3
 
-from ebs_snapper import utils, dynamo, timeout_check
-from ebs_snapper.utils import MockContext
+from ebs_snapper import utils, clients, dispatch, dynamo, hub, poller, regional, throttle, work
+from ebs_snapper import timeout_check
+from ebs_snapper.utils import DaemonContext, MockContext
 
 
 LOG = logging.getLogger()
+DEFAULT_REGION_PENDING_LIMIT = 100  # pending snapshots we allow ourselves per region
+DEFAULT_VOLUME_PENDING_LIMIT = 1  # pending snapshots we allow ourselves per volume
 
 
 def ensure_cloudwatch_rule_for_replication(context, installed_region='us-east-1'):
     """Be sure replication is running, or not running, based on configs"""
-    client = boto3.client('events', region_name=installed_region)
+    client = clients.get_client('events', installed_region)
     cw_rule_name = utils.find_replication_cw_event_rule(context)
     current_state = client.describe_rule(Name=cw_rule_name)
-    configurations = dynamo.list_configurations(context, installed_region)
+    configurations = dynamo.load_configurations(context, installed_region)
     replication = False
     for cfg in configurations:
         if 'replication' in cfg and cfg['replication'] == 'yes':
@@ -56,38 +58,41 @@ def ensure_cloudwatch_rule_for_replication(context, installed_region='us-east-1'
         client.disable_rule(Name=cw_rule_name)
 
 
-def perform_fanout_all_regions(context, cli=False, installed_region='us-east-1'):
+def perform_fanout_all_regions(context, cli=False, installed_region='us-east-1', run=None):
     """For every region, send a message (lambda) or run snapshots (cli)"""
 
-    sns_topic = utils.get_topic_arn('CreateSnapshotTopic')
-    LOG.debug('perform_fanout_all_regions using SNS topic %s', sns_topic)
-
-    # configure replication based on extant configs for snapshots
-    if type(context) is not MockContext:  # don't do in unit tests
+    # configure replication based on extant configs for snapshots, a hub always replicates,
+    # and a daemon has no stack or rule to configure (nor do unit tests)
+    if type(context) not in (MockContext, DaemonContext) and not hub.hub_enabled():
         ensure_cloudwatch_rule_for_replication(context, installed_region)
 
-    # get regions with instances running or stopped
-    regions = utils.get_regions(must_contain_instances=True)
-    for region in regions:
-        sleep(5)  # API rate limiting help
+    hub.fanout_accounts(context, installed_region, functools.partial(
+        perform_fanout_account, context, cli=cli, installed_region=installed_region, run=run))
 
-        send_fanout_message(
-            context=context,
-            region=region,
-            sns_topic=sns_topic,
-            cli=cli)
 
+def perform_fanout_account(context, member, cli=False, installed_region='us-east-1', run=None):
+    """For every region of this account, or a hub's member, send a message or run snapshots"""
+    # get regions with instances running or stopped, that some configuration applies in
+    configurations = dynamo.load_configurations(context, installed_region)
+    regions = regional.get_regions(must_contain_instances=True, configurations=configurations,
+                                   targeted=True, select=run.select if run is not None else None)
 
-def send_fanout_message(context, region, sns_topic, cli=False):
-    """Send message to perform snapshots for all instance_id's in region."""
+    # the CLI may only do some regions, each with its own deadline
+    local_handler = functools.partial(perform_fanout_message, context)
+    if run is not None:
+        regions, local_handler = run.prepare(regions, configurations,
+                                             perform_fanout_message, context)
 
-    message = json.dumps({'region': region})
-    LOG.debug('send_fanout_message: %s', message)
+    # send the configurations along, so every region works from the same ones
+    payload = None if cli else dynamo.build_payload(context, installed_region)
+    dispatch.fanout('snapshot', regions, configurations, local_handler,
+                    cli=cli, installed_region=installed_region, payload=payload,
+                    member=member, run=run)
 
-    if cli:
-        perform_snapshot(context, region)
-    else:
-        utils.sns_publish(TopicArn=sns_topic, Message=message)
+
+def perform_fanout_message(context, message):
+    """Perform snapshots for the region in a fanout message, in this process"""
+    perform_snapshot(context, message['region'])
 
 
 def perform_snapshot(context, region, installed_region='us-east-1'):
@@ -95,8 +100,9 @@ def perform_snapshot(context, region, installed_region='us-east-1'):
     LOG.info('Reviewing snapshots in region %s', region)
 
     # fetch these, in case we need to figure out what applies to an instance
-    configurations = dynamo.list_configurations(context, installed_region)
+    configurations = dynamo.load_configurations(context, installed_region)
     LOG.debug('Fetched all possible configuration rules from DynamoDB')
+    throttle.configure(utils.get_configuration_setting(configurations, 'api_rates'))
 
     # build a list of any IDs (anywhere) that we should ignore
     ignore_ids = utils.build_ignore_list(configurations)
@@ -106,6 +112,7 @@ def perform_snapshot(context, region, installed_region='us-east-1'):
     all_instances = cache_data['instance_id_to_data']
     instance_configs = cache_data['instance_id_to_config']
     volume_snap_recent = cache_data['volume_id_to_most_recent_snapshot_date']
+    due_volumes = []
 
     for instance_id in set(all_instances.keys()):
         # before we go do some work
@@ -118,19 +125,14 @@ def perform_snapshot(context, region, installed_region='us-east-1'):
         snapshot_settings = instance_configs[instance_id]
 
         # parse out snapshot settings
-        retention, frequency = utils.parse_snapshot_settings(snapshot_settings)
+        retention, frequency = utils.compile_snapshot_settings(snapshot_settings)
 
         # grab the data about this instance id, if we don't already have it
         instance_data = all_instances[instance_id]
 
-        ami_id = instance_data['ImageId']
         LOG.info('Reviewing snapshots in region %s on instance %s', region, instance_id)
 
         for dev in instance_data.get('BlockDeviceMappings', []):
-            # before we go make a bunch more API calls
-            if timeout_check(context, 'perform_snapshot'):
-                break
-
             # we probably should have been using volume keys from one of the
             # caches here, but since we're not, we're going to have to check here too
             LOG.debug('Considering device %s', dev)
@@ -145,27 +147,80 @@ def perform_snapshot(context, region, installed_region='us-east-1'):
 
             # snapshot due?
             if should_perform_snapshot(frequency, now, volume_id, recent):
-                LOG.debug('Performing snapshot for %s, calculating tags', volume_id)
+                LOG.debug('Snapshot due for %s', volume_id)
             else:
                 LOG.debug('NOT Performing snapshot for %s', volume_id)
                 continue
 
-            # perform actual snapshot and create tag: retention + now() as a Y-M-D
-            delete_on_dt = now + retention
-            delete_on = delete_on_dt.strftime('%Y-%m-%d')
+            due_volumes.append({
+                'instance_id': instance_id,
+                'volume_id': volume_id,
+                'recent': recent,
+                'retention': retention,
+            })
+
+    # most overdue first, so whatever isn't admitted now is first in line next time
+    due_volumes.sort(key=lambda d: (d['recent'] is not None, d['recent']))
+    admission = SnapshotAdmission(
+        cache_data['snapshot_id_to_data'].values(),
+        region_limit=int(utils.get_configuration_setting(
+            configurations, 'snapshot_pending_limit', DEFAULT_REGION_PENDING_LIMIT)),
+        volume_limit=int(utils.get_configuration_setting(
+            configurations, 'snapshot_pending_per_volume', DEFAULT_VOLUME_PENDING_LIMIT)))
+
+    queue = work.WorkQueue(context, configurations, installed_region)
+    created_snapshot_ids = []
+    for due in due_volumes:
+        # before we go make a bunch more API calls
+        if timeout_check(context, 'perform_snapshot'):
+            break
+
+        instance_id = due['instance_id']
+        volume_id = due['volume_id']
+        if not admission.admit(volume_id):
+            continue
 
-            volume_data = utils.get_volume(volume_id, region=region)
-            expected_tags = utils.calculate_relevant_tags(
-                instance_data.get('Tags', None),
-                volume_data.get('Tags', None))
+        LOG.debug('Performing snapshot for %s, calculating tags', volume_id)
+        snapshot_settings = instance_configs[instance_id]
+        instance_data = all_instances[instance_id]
 
-            utils.snapshot_and_tag(
-                instance_id,
-                ami_id,
-                volume_id,
-                delete_on,
-                region,
-                additional_tags=expected_tags)
+        # perform actual snapshot and create tag: retention + now() as a Y-M-D
+        now = datetime.datetime.now(dateutil.tz.tzutc())
+        delete_on_dt = now + due['retention']
+        delete_on = delete_on_dt.strftime('%Y-%m-%d')
+
+        volume_data = utils.get_volume(volume_id, region=region)
+        expected_tags = utils.calculate_relevant_tags(
+            instance_data.get('Tags', None),
+            volume_data.get('Tags', None))
+
+        # stamp the configured priority and RPO, so replication can order copies by them
+        for key in ['replication_priority', 'replication_rpo']:
+            if key in snapshot_settings:
+                expected_tags = [x for x in expected_tags if x['Key'] != key]
+                expected_tags.append({'Key': key, 'Value': str(snapshot_settings[key])})
+
+        created_snapshot_ids.append(queue.submit(work.snapshot_item(
+            instance_id,
+            instance_data['ImageId'],
+            volume_id,
+            delete_on,
+            region,
+            tags=expected_tags)))
+
+    queue.flush()
+    if queue.queued > 0:
+        LOG.info('Queued %s snapshots of volumes in %s', queue.queued, region)
+
+    if admission.deferred > 0:
+        LOG.warn('Deferred %s due snapshots in %s to the next run, %s pending (%s left)',
+                 admission.deferred, region, admission.region_pending, admission.remaining())
+
+    # follow up on anything still in flight from earlier runs, plus what we just started
+    in_flight_ids = poller.in_flight_snapshot_ids(cache_data['snapshot_id_to_data'].values())
+    in_flight_ids.extend([x for x in created_snapshot_ids if x is not None])
+    if len(in_flight_ids) > 0:
+        poller.poll_snapshots(context, region, in_flight_ids)
 
 
 def should_perform_snapshot(frequency, now, volume_id, recent=None):
@@ -224,3 +279,44 @@ def can_serialize_json(key, value):
         return True
     except:
         return False
+
+
+class SnapshotAdmission(object):
+    """Admit new snapshots only within the pending snapshot limits of a region"""
+
+    def __init__(self, snapshot_data, region_limit=DEFAULT_REGION_PENDING_LIMIT,
+                 volume_limit=DEFAULT_VOLUME_PENDING_LIMIT):
+        self.region_limit = region_limit
+        self.volume_limit = volume_limit
+        self.deferred = 0
+
+        # count what the cached inventory says is still pending
+        self.volume_pending = {}
+        for snap in snapshot_data:
+            if snap.get('State') != 'pending':
+                continue
+
+            vid = snap['VolumeId']
+            self.volume_pending[vid] = self.volume_pending.get(vid, 0) + 1
+        self.region_pending = sum(self.volume_pending.values())
+
+    def admit(self, volume_id):
+        """True if a new snapshot of volume_id fits in the budget, and count it if so"""
+        if self.volume_pending.get(volume_id, 0) >= self.volume_limit:
+            LOG.info('Not snapshotting %s, it already has a pending snapshot', volume_id)
+            self.deferred += 1
+            return False
+
+        if self.region_pending >= self.region_limit:
+            LOG.debug('Not snapshotting %s, %s snapshots are pending in the region',
+                      volume_id, self.region_pending)
+            self.deferred += 1
+            return False
+
+        self.volume_pending[volume_id] = self.volume_pending.get(volume_id, 0) + 1
+        self.region_pending += 1
+        return True
+
+    def remaining(self):
+        """How many more snapshots may be started in this region"""
+        return max(self.region_limit - self.region_pending, 0)
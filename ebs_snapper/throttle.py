@@ -0,0 +1,350 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2016 Rackspace US, Inc.
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+"""Module for pacing and retrying AWS API calls with shared token buckets."""
+
+from __future__ import print_function
+import logging
+import os
+import random
+import threading
+import time
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+LOG = logging.getLogger()
+
+# (tokens per second, burst) for each class of operation, per service and region
+DEFAULT_RATES = {
+    'read': (20.0, 40),
+    'write': (5.0, 10),
+    'copy': (1.0, 5),
+    'publish': (10.0, 20),
+}
+OPERATION_CLASS_PREFIXES = [
+    ('Describe', 'read'),
+    ('List', 'read'),
+    ('Get', 'read'),
+    ('Query', 'read'),
+    ('Scan', 'read'),
+    ('CopySnapshot', 'copy'),
+    ('Publish', 'publish'),
+    ('SendMessage', 'publish'),
+    ('Invoke', 'publish'),
+]
+RATE_ENV_PREFIX = 'EBS_SNAPPER_RATE_'
+
+# adaptive rates, halve when throttled, recover 5% of the configured rate per success
+THROTTLE_DECREASE = 0.5
+SUCCESS_INCREASE = 0.05
+MIN_RATE_FRACTION = 0.05
+TOKEN_EPSILON = 1e-9
+
+# errors we retry ourselves, by class, and how many attempts each class gets
+THROTTLING_ERRORS = [
+    'Throttling', 'ThrottlingException', 'ThrottledException', 'RequestThrottledException',
+    'RequestLimitExceeded', 'RequestThrottled', 'TooManyRequestsException',
+    'ProvisionedThroughputExceededException', 'TransactionInProgressException',
+    'SlowDown', 'PriorRequestNotComplete', 'BandwidthLimitExceeded',
+]
+CAPACITY_ERRORS = [
+    'ResourceLimitExceeded', 'SnapshotCreationPerVolumeRateExceeded',
+    'ConcurrentSnapshotLimitExceeded', 'InsufficientCapacity',
+]
+TRANSIENT_ERRORS = [
+    'InternalError', 'InternalFailure', 'InternalServerError', 'ServiceUnavailable',
+    'ServiceUnavailableException', 'Unavailable', 'RequestTimeout', 'RequestTimeoutException',
+    'IDPCommunicationError', 'EC2ThrottledException',
+]
+RETRY_ATTEMPTS = {'throttling': 8, 'transient': 4, 'capacity': 2}
+RETRY_BASE_DELAY = {'throttling': 1.0, 'transient': 0.25, 'capacity': 5.0}
+RETRY_MAX_DELAY = 20.0
+
+_BUCKETS = {}
+_OVERRIDES = {}
+_LOCK = threading.Lock()
+
+
+class TokenBucket(object):
+    """Thread-safe token bucket, refilled continuously at rate tokens per second
+
+    The rate adapts: it is halved whenever the service throttles us, and
+    creeps back up towards the configured base rate with every success.
+    """
+
+    def __init__(self, rate, burst, clock=time):
+        self.base_rate = float(rate)
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.clock = clock
+        self.updated = clock.time()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        """Add tokens for the time elapsed since the last refill"""
+        now = self.clock.time()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, tokens=1.0):
+        """Take tokens from the bucket, blocking until they are available"""
+        while True:
+            with self.lock:
+                self._refill()
+                # a refill can fall short by a rounding error, too small a wait for the clock
+                if self.tokens >= tokens - TOKEN_EPSILON:
+                    self.tokens -= tokens
+                    return
+
+                wait = (tokens - self.tokens) / self.rate
+
+            # sleep outside the lock, so other threads can check in meanwhile
+            self.clock.sleep(wait)
+
+    def set_rate(self, rate, burst=None):
+        """Change the configured rate (and optionally burst) of this bucket
+
+        Any backoff carries over: a bucket at half its old rate runs at half
+        the new one, and an unchanged setting leaves the bucket alone.
+        """
+        with self.lock:
+            if float(rate) == self.base_rate and (burst is None or float(burst) == self.burst):
+                return
+
+            self._refill()
+            health = self.rate / self.base_rate
+            self.base_rate = float(rate)
+            self.rate = self.base_rate * health
+            if burst is not None:
+                self.burst = float(burst)
+                self.tokens = min(self.tokens, self.burst)
+
+    def throttled(self):
+        """Back off after the service throttled us (multiplicative decrease)"""
+        with self.lock:
+            self._refill()
+            self.rate = max(self.rate * THROTTLE_DECREASE, self.base_rate * MIN_RATE_FRACTION)
+            self.tokens = min(self.tokens, 0.0)
+
+    def succeeded(self):
+        """Recover towards the configured rate after a success (additive increase)"""
+        if self.rate >= self.base_rate:
+            return
+
+        with self.lock:
+            self.rate = min(self.rate + self.base_rate * SUCCESS_INCREASE, self.base_rate)
+
+    def health(self):
+        """Fraction of the configured rate this bucket is currently allowed"""
+        return self.rate / self.base_rate
+
+
+def operation_class(operation_name):
+    """Classify an API operation name into one of the rate classes"""
+    for prefix, op_class in OPERATION_CLASS_PREFIXES:
+        if operation_name.startswith(prefix):
+            return op_class
+
+    return 'write'
+
+
+def parse_rate(value):
+    """Parse a rate setting like '20' or '20,40' (rate, burst) into a tuple"""
+    if isinstance(value, (list, tuple)):
+        parts = list(value)
+    else:
+        parts = str(value).split(',')
+
+    rate = float(parts[0])
+    burst = float(parts[1]) if len(parts) > 1 else max(rate, 1.0)
+
+    # a bucket that never refills would block every call for good
+    if rate <= 0 or burst <= 0:
+        raise ValueError('rate and burst must be above zero, not {}'.format(value))
+    return rate, burst
+
+
+def get_rate(service, op_class):
+    """Find the (rate, burst) for a service and operation class
+
+    Lookup order is configuration (e.g. "ec2:write"), then environment
+    variables EBS_SNAPPER_RATE_EC2_WRITE or EBS_SNAPPER_RATE_WRITE, and
+    finally the built-in defaults.
+    """
+    for key in ['{}:{}'.format(service, op_class), op_class]:
+        if key in _OVERRIDES:
+            return _OVERRIDES[key]
+
+    for key in ['{}_{}'.format(service, op_class), op_class]:
+        env_name = RATE_ENV_PREFIX + key.upper().replace('-', '_')
+        env_value = os.environ.get(env_name)
+        if env_value:
+            try:
+                return parse_rate(env_value)
+            except (TypeError, ValueError):
+                LOG.warn('Ignoring unparseable API rate %s in %s', env_value, env_name)
+
+    return DEFAULT_RATES.get(op_class, DEFAULT_RATES['write'])
+
+
+def configure(rates):
+    """Apply rate settings from configuration, e.g. {"ec2:write": "5,10", "read": 20}"""
+    with _LOCK:
+        _OVERRIDES.clear()
+        for key, value in (rates or {}).iteritems():
+            try:
+                _OVERRIDES[key] = parse_rate(value)
+            except (TypeError, ValueError):
+                LOG.warn('Ignoring unparseable API rate %s for %s', value, key)
+
+        # existing buckets pick up the new settings
+        for (service, _, op_class), bucket in _BUCKETS.iteritems():
+            bucket.set_rate(*get_rate(service, op_class))
+
+
+def get_bucket(service, region, op_class):
+    """Return the shared bucket for a (service, region, operation class)"""
+    key = (service, region, op_class)
+    with _LOCK:
+        if key not in _BUCKETS:
+            rate, burst = get_rate(service, op_class)
+            _BUCKETS[key] = TokenBucket(rate, burst)
+
+        return _BUCKETS[key]
+
+
+def acquire(service, region, operation_name):
+    """Wait for budget to make one call of operation_name to service in region"""
+    get_bucket(service, region, operation_class(operation_name)).acquire()
+
+
+def classify_error_code(code):
+    """Classify an AWS error code as throttling, capacity, transient, or None"""
+    if code in THROTTLING_ERRORS:
+        return 'throttling'
+    elif code in CAPACITY_ERRORS:
+        return 'capacity'
+    elif code in TRANSIENT_ERRORS:
+        return 'transient'
+
+    return None
+
+
+def classify_error(error):
+    """Classify a ClientError (or anything else) as throttling, capacity, transient, or None"""
+    if isinstance(error, ClientError):
+        return classify_error_code(error.response.get('Error', {}).get('Code'))
+
+    return None
+
+
+def classify_response(response=None, caught_exception=None):
+    """Classify the outcome of one HTTP attempt made by botocore"""
+    if caught_exception is not None:
+        # connection resets, timeouts, and the like
+        return 'transient'
+
+    if response is None:
+        return None
+
+    http_response, parsed = response
+    error_class = classify_error_code(parsed.get('Error', {}).get('Code'))
+    if error_class is None and http_response.status_code >= 500:
+        return 'transient'
+
+    return error_class
+
+
+def backoff_delay(error_class, attempts):
+    """Exponential backoff with full jitter, for the given error class and attempt"""
+    ceiling = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY[error_class] * (2 ** (attempts - 1)))
+    return random.uniform(0, ceiling)
+
+
+def worker_count(service, region, default, op_class='read'):
+    """Size a worker pool for a region, shrinking it while that region throttles us"""
+    health = get_bucket(service, region, op_class).health()
+    return max(1, int(round(default * health)))
+
+
+def client_config(**kwargs):
+    """The botocore client configuration shared by every client we create"""
+    # botocore's own retries are off, _needs_retry makes every retry decision
+    return Config(retries={'max_attempts': 0}, **kwargs)
+
+
+def _before_call(model=None, context=None, **kwargs):
+    """botocore before-call handler, pace every API call through its bucket"""
+    if model is None:
+        return
+
+    region = (context or {}).get('client_region') or 'global'
+    acquire(model.service_model.service_name, region, model.name)
+
+
+def _after_call(model=None, context=None, http_response=None, **kwargs):
+    """botocore after-call handler, let a bucket recover after a success"""
+    if model is None or http_response is None or http_response.status_code >= 400:
+        return
+
+    region = (context or {}).get('client_region') or 'global'
+    op_class = operation_class(model.name)
+    get_bucket(model.service_model.service_name, region, op_class).succeeded()
+
+
+def _needs_retry(response=None, operation=None, attempts=None, caught_exception=None,
+                 request_dict=None, **kwargs):
+    """botocore needs-retry handler, returns seconds to sleep before a retry (or None)"""
+    error_class = classify_response(response, caught_exception)
+    if error_class is None or operation is None:
+        return None
+
+    service = operation.service_model.service_name
+    region = (request_dict or {}).get('context', {}).get('client_region') or 'global'
+    if error_class == 'throttling':
+        get_bucket(service, region, operation_class(operation.name)).throttled()
+
+    if attempts >= RETRY_ATTEMPTS[error_class]:
+        LOG.warn('Giving up on %s.%s in %s after %s attempts (%s)',
+                 service, operation.name, region, attempts, error_class)
+        return None
+
+    delay = backoff_delay(error_class, attempts)
+    LOG.info('Retrying %s.%s in %s after %s error, attempt %s, in %.2fs',
+             service, operation.name, region, error_class, attempts, delay)
+    return delay
+
+
+def install(session=None):
+    """Pace and retry every client created from session (default boto3 session) from now on"""
+    if session is None:
+        if boto3.DEFAULT_SESSION is None:
+            boto3.setup_default_session()
+        session = boto3.DEFAULT_SESSION
+
+    session.events.register('before-call', _before_call, unique_id='ebs-snapper-throttle')
+    session.events.register('after-call', _after_call, unique_id='ebs-snapper-recover')
+    session.events.register('needs-retry', _needs_retry, unique_id='ebs-snapper-retry')
+
+    # pylint: disable=protected-access
+    session._session.set_default_client_config(client_config())
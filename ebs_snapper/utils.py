@@ -24,20 +24,18 @@
 from __future__ import print_function
 import logging
 import collections
+import json
 import os
 import random
+import time
 import datetime
 from datetime import timedelta
-from multiprocessing.pool import ThreadPool
+import fnmatch
 import functools
-from time import sleep
 from botocore.exceptions import ClientError
 import dateutil
-import boto3
-from crontab import CronTab
-from pytimeparse.timeparse import timeparse
 import ebs_snapper
-from ebs_snapper import timeout_check
+from ebs_snapper import timeout_check, clients, runtime, throttle
 
 LOG = logging.getLogger()
 AWS_TAGS = [
@@ -50,9 +48,18 @@ AWS_TAGS = [
     "Billing1", "Billing2", "Billing3", "Billing4", "Billing5"
 ]
 SNAP_DESC_TEMPLATE = "Created from {0} by EbsSnapper({3}) for {1} from {2}"
+PRIORITIZED_SNAPSHOT_TAGS = ['replication_dst_region', 'replication_priority',
+                             'replication_rpo']
 ALLOWED_SNAPSHOT_DELETE_FAILURES = ['InvalidSnapshot.InUse', 'InvalidSnapshot.NotFound']
 UNSUPPORTED_REGION_EXCEPTIONS = ['AuthFailure', 'OptInRequired']
 
+# set by the CloudFormation template, so Lambda doesn't have to look these up at all
+TOPIC_ARN_ENV_PREFIX = 'EBS_SNAPPER_TOPIC_ARN_'
+REPLICATION_RULE_ENV = 'EBS_SNAPPER_REPLICATION_RULE'
+
+# SNS publishes are I/O bound, so fanout sends this many at once
+FANOUT_WORKERS = int(os.environ.get('EBS_SNAPPER_FANOUT_WORKERS', 8))
+
 
 def configure_logging(context, logger, level=logging.INFO, boto_level=logging.WARNING):
     """Configure default logging"""
@@ -67,6 +74,14 @@ def get_owner_id(context, region=None):
     """Get overall owner account id using a bunch of tricks"""
     LOG.debug('get_owner_id')
 
+    # a record's share of an invocation is still the same invocation
+    if isinstance(context, DeadlineShareContext):
+        context = context.parent
+
+    # in hub mode, the member being worked on
+    if clients.current_member() is not None:
+        return [clients.current_member()]
+
     # see if Lambda context is non-None
     try:
         # are we mocking? MockContext
@@ -79,10 +94,19 @@ def get_owner_id(context, region=None):
     except:
         pass
 
+    # maybe our environment already knows?
+    if os.environ.get(clients.OWNER_ID_ENV):
+        return [os.environ[clients.OWNER_ID_ENV]]
+
+    return clients.discover(('owner_id', region), functools.partial(find_owner_id, region))
+
+
+def find_owner_id(region=None):
+    """Look up the owner account id from AWS, without any caching"""
     # maybe STS can tell us?
     try:
         LOG.debug('get_owner_id: STS')
-        sts_client = boto3.client('sts')
+        sts_client = clients.get_client('sts')
         account_id = sts_client.get_caller_identity()["Account"]
         return [str(account_id)]
     except:
@@ -91,7 +115,7 @@ def get_owner_id(context, region=None):
     # maybe we can look at another user's arn?
     try:
         LOG.debug('get_owner_id: STS another user')
-        iam_client = boto3.client('iam')
+        iam_client = clients.get_client('iam')
         return [iam_client.list_users(MaxItems=1)["Users"][0]["Arn"].split(':')[4]]
     except:
         pass
@@ -99,7 +123,7 @@ def get_owner_id(context, region=None):
     # maybe we have API keys from boto3?
     try:
         LOG.debug('get_owner_id: IAM')
-        iam_client = boto3.client('iam')
+        iam_client = clients.get_client('iam')
         return [iam_client.get_user()['User']['Arn'].split(':')[4]]
     except:
         pass
@@ -119,12 +143,18 @@ def get_owner_id(context, region=None):
         regions = [region]
     else:
         LOG.debug('get_owner_id: EC2 all regions')
-        regions = get_regions(must_contain_instances=True)
+        regions = [x['RegionName'] for x in
+                   clients.get_client('ec2', 'us-east-1').describe_regions()['Regions']]
 
     owners = []
     for r in regions:
-        client = boto3.client('ec2', region_name=r)
-        instances = client.describe_instances()
+        client = clients.get_client('ec2', r)
+        try:
+            instances = client.describe_instances()
+        except ClientError as e:
+            if e.response['Error']['Code'] in UNSUPPORTED_REGION_EXCEPTIONS:
+                continue
+            raise
         owners.extend([x['OwnerId'] for x in instances['Reservations']])
 
     return list(set(owners))
@@ -153,68 +183,70 @@ def ignore_retention_enabled(configurations):
     return False
 
 
-def get_regions(must_contain_instances=False, must_contain_snapshots=False):
-    """Get regions, optionally filtering by regions containing instances."""
-    LOG.debug('get_regions(must_contain_instances=%s)', must_contain_instances)
-    client = boto3.client('ec2', region_name='us-east-1')
-    regions = client.describe_regions()
-    region_names = [x['RegionName'] for x in regions['Regions']]
+def get_configuration_setting(configurations, key, default=None):
+    """Given a bunch of configs, return the first value found for an account-wide setting"""
+    for config in configurations:
+        if key in config:
+            return config[key]
 
-    if must_contain_instances and must_contain_snapshots:
-        return [x for x in region_names if
-                region_contains_instances(x) and region_contains_snapshots(x)]
-    elif must_contain_instances:
-        return [x for x in region_names if region_contains_instances(x)]
-    elif must_contain_snapshots:
-        return [x for x in region_names if region_contains_snapshots(x)]
+    return default
 
-    return region_names
 
+def region_in(region, patterns):
+    """Check if region matches any of a list of region names or glob patterns"""
+    if isinstance(patterns, basestring):
+        patterns = [patterns]
 
-def region_contains_instances(region):
-    """Check if a region contains EC2 instances"""
-    client = boto3.client('ec2', region_name=region)
-    try:
-        instances = client.describe_instances(
-            Filters=[{'Name': 'instance-state-name',
-                      'Values': ['running', 'stopped']}]
-        )
-        return 'Reservations' in instances and len(instances['Reservations']) > 0
-    except ClientError as e:
-        LOG.warn('Failed to describe instances in region %s: %s', region, str(e))
+    return any(fnmatch.fnmatchcase(region, p) for p in patterns)
 
-        if e.response['Error']['Code'] in UNSUPPORTED_REGION_EXCEPTIONS:
-            return False
 
-        raise
+def configuration_targets_region(config, region):
+    """Check if a snapshot configuration applies in region, by its optional regions list"""
+    return config.get('regions') is None or region_in(region, config['regions'])
 
 
-def region_contains_snapshots(region):
-    """Check if a region contains snapshots instances"""
-    client = boto3.client('ec2', region_name=region)
-    try:
-        snapshots = client.describe_snapshots(
-            OwnerIds=get_owner_id(region),
-            MaxResults=5
-        )
-        return 'Snapshots' in snapshots and len(snapshots['Snapshots']) > 0
-    except ClientError as e:
-        LOG.warn('Failed to describe snapshots in region %s: %s', region, str(e))
-        if e.response['Error']['Code'] in UNSUPPORTED_REGION_EXCEPTIONS:
-            return False
+def configurations_for_region(configurations, region):
+    """Drop the snapshot configurations that don't apply in region, keeping everything else"""
+    return [x for x in configurations
+            if 'match' not in x or configuration_targets_region(x, region)]
 
-        raise
+
+def map_concurrently(f, items, workers):
+    """Like map(f, items), on a pool of up to workers threads"""
+    if len(items) <= 0:
+        return []
+
+    if workers <= 1:
+        return [f(x) for x in items]
+
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(processes=min(workers, len(items)))
+    try:
+        return pool.map(f, items)
+    finally:
+        pool.close()
+        pool.join()
 
 
 def get_topic_arn(topic_name, default_region='us-east-1'):
     """Search for an SNS topic containing topic_name."""
+    env_arn = os.environ.get(TOPIC_ARN_ENV_PREFIX + topic_name.upper())
+    if env_arn:
+        return env_arn
 
-    client = boto3.client('sns', region_name=default_region)
-    topics = client.list_topics()
-    for topic in topics['Topics']:
-        splits = topic['TopicArn'].split(':')
-        if splits[5] == topic_name:
-            return topic['TopicArn']
+    return clients.discover(('topic_arn', topic_name, default_region),
+                            functools.partial(find_topic_arn, topic_name, default_region))
+
+
+def find_topic_arn(topic_name, default_region='us-east-1'):
+    """Page through every SNS topic looking for topic_name, without any caching"""
+    client = clients.get_client('sns', default_region)
+    paginator = client.get_paginator('list_topics')
+    for page in paginator.paginate():
+        for topic in page.get('Topics', []):
+            splits = topic['TopicArn'].split(':')
+            if splits[5] == topic_name:
+                return topic['TopicArn']
 
     raise Exception('Could not find an SNS topic {}'.format(topic_name))
 
@@ -235,7 +267,7 @@ def convert_configurations_to_boto_filter(configuration):
 
 def sns_publish(TopicArn, Message, Region='us-east-1'):
     """Wrapper around SNS client so we can mock and unit test and assert it"""
-    client = boto3.client('sns', region_name=Region)
+    client = clients.get_client('sns', Region)
     client.publish(TopicArn=TopicArn, Message=Message)
 
 
@@ -253,6 +285,10 @@ def parse_snapshot_settings(snapshot_settings):
         if k not in snapshot_settings['snapshot']:
             raise Exception('missing required snapshot setting {}'.format(k))
 
+    # only needed once there's a configuration to parse, so not at cold start
+    from crontab import CronTab
+    from pytimeparse.timeparse import timeparse
+
     ret_s = snapshot_settings['snapshot']['retention']
     retention = timeparse('7 days')
     try:
@@ -271,6 +307,20 @@ def parse_snapshot_settings(snapshot_settings):
         raise Exception('Could not identify expression', f_expr)
 
 
+def compile_snapshot_settings(snapshot_settings):
+    """parse_snapshot_settings, remembering the result while the settings are unchanged"""
+    key = json.dumps(snapshot_settings['snapshot'], sort_keys=True)
+    with runtime.STATE.configurations_lock:
+        if key in runtime.STATE.compiled:
+            return runtime.STATE.compiled[key]
+
+    compiled = parse_snapshot_settings(snapshot_settings)
+    with runtime.STATE.configurations_lock:
+        runtime.STATE.compiled[key] = compiled
+
+    return compiled
+
+
 def validate_snapshot_settings(snapshot_settings):
     """Validate snapshot settings JSON"""
     if 'match' not in snapshot_settings or 'snapshot' not in snapshot_settings:
@@ -294,7 +344,7 @@ def validate_snapshot_settings(snapshot_settings):
 
 def get_instance(instance_id, region):
     """find and return the data about a single instance"""
-    ec2 = boto3.client('ec2', region_name=region)
+    ec2 = clients.get_client('ec2', region)
     instance_data = ec2.describe_instances(InstanceIds=[instance_id])
     if 'Reservations' not in instance_data:
         raise Exception('Response missing reservations {}'.format(instance_data))
@@ -361,12 +411,11 @@ def get_snapshots_by_volumes(volume_list, region):
 
 def build_snapshot_paginator(params, region):
     """Utility function to make pagination of snapshots easier"""
-    ec2 = boto3.client('ec2', region_name=region)
+    ec2 = clients.get_client('ec2', region)
 
     params['PaginationConfig'] = {'PageSize': 100}
 
     paginator = ec2.get_paginator('describe_snapshots')
-    sleep(1)  # help w/ API limits
     return paginator.paginate(**params)
 
 
@@ -386,16 +435,16 @@ def snapshot_and_tag(instance_id, ami_id, volume_id, delete_on, region, addition
     max_tags = 49
     full_tags = [{'Key': 'DeleteOn', 'Value': delete_on}]
     if additional_tags is not None:
-        repl_tags = [x for x in additional_tags if x.get('Key') == 'replication_dst_region']
+        repl_tags = [x for x in additional_tags if x.get('Key') in PRIORITIZED_SNAPSHOT_TAGS]
         if len(repl_tags) > 0:
-            # append the replication tag if it exists, only accept 48 from caller
+            # append the replication tags if they exist, accept fewer from caller
             full_tags.extend(repl_tags)
-            max_tags = max_tags - 1
+            max_tags = max_tags - len(repl_tags)
 
         # we only get 50 tags, so restrict additional_tags to max_tags
         full_tags.extend(additional_tags[:max_tags])
 
-    ec2 = boto3.client('ec2', region_name=region)
+    ec2 = clients.get_client('ec2', region)
 
     snapshot = ec2.create_snapshot(
         VolumeId=volume_id,
@@ -410,20 +459,21 @@ def snapshot_and_tag(instance_id, ami_id, volume_id, delete_on, region, addition
     LOG.debug('Finished snapshot in %s of volume %s, valid until %s',
               region, volume_id, delete_on)
 
+    return snapshot['SnapshotId']
+
 
 def delete_snapshot(snapshot_id, region):
     """Simple wrapper around deletes so we can mock them"""
-    ec2 = boto3.client('ec2', region_name=region)
+    ec2 = clients.get_client('ec2', region)
     try:
         ec2.delete_snapshot(SnapshotId=snapshot_id)
-    except Exception as e:
+    except ClientError as e:
         LOG.warn('Failed to remove snapshot %s in region %s: %s',
                  snapshot_id, region, str(e))
 
         # if an error is okay, we'll emit the log but not blow up
-        for allowed_err in ALLOWED_SNAPSHOT_DELETE_FAILURES:
-            if allowed_err in str(e):
-                return 0
+        if e.response['Error']['Code'] in ALLOWED_SNAPSHOT_DELETE_FAILURES:
+            return 0
 
         # an error that isn't whitelisted, throw an Exception
         raise
@@ -440,7 +490,7 @@ def get_volumes(instance_ids, region):
         {'Name': 'attachment.instance-id', 'Values': instance_ids}
     ]
 
-    ec2 = boto3.client('ec2', region_name=region)
+    ec2 = clients.get_client('ec2', region)
     vol_paginator = ec2.get_paginator('describe_volumes')
     operation_parameters = {'Filters': filters_for_instances}
 
@@ -459,7 +509,7 @@ def get_volumes(instance_ids, region):
 
 def get_volume(volume_id, region):
     """find and return the data about a single instance"""
-    ec2 = boto3.client('ec2', region_name=region)
+    ec2 = clients.get_client('ec2', region)
     volume_data = ec2.describe_volumes(VolumeIds=[volume_id])
     if 'Volumes' not in volume_data:
         raise Exception('Response missing volumes {}'.format(volume_data))
@@ -473,7 +523,7 @@ def get_volume(volume_id, region):
 
 def get_instance_by_volume(volume_id, region):
     """Get instance from volume id"""
-    ec2 = boto3.client('ec2', region_name=region)
+    ec2 = clients.get_client('ec2', region)
 
     try:
         found_volumes = ec2.describe_volumes(VolumeIds=[volume_id])
@@ -490,8 +540,8 @@ def get_instance_by_volume(volume_id, region):
 def get_snapshot_settings_by_instance(instance_id, configurations, region):
     """Given an instance, find the snapshot config that applies"""
 
-    client = boto3.client('ec2', region_name=region)
-    for config in configurations:
+    client = clients.get_client('ec2', region)
+    for config in configurations_for_region(configurations, region):
         if not validate_snapshot_settings(config):
             continue
 
@@ -558,6 +608,7 @@ def calculate_relevant_tags(instance_tags, volume_tags, max_results=50):
 
 def is_crontab_expression(expr):
     """True IFF expr is of type CronTab or can be used to create a CronTab"""
+    from crontab import CronTab
     try:
         return isinstance(expr, CronTab) or CronTab(expr) is not None
     except:
@@ -568,6 +619,7 @@ def is_crontab_expression(expr):
 
 def is_timedelta_expression(expr):
     """True IFF expr is of type timedelta or can be used to create a timedelta"""
+    from pytimeparse.timeparse import timeparse
     try:
         return isinstance(expr, timedelta) or timeparse(expr) is not None
     except:
@@ -594,8 +646,10 @@ def build_cache_maps(context, configurations, region, installed_region):
     }
 
     # build an EC2 client, we're going to need it
-    ec2 = boto3.client('ec2', region_name=region)
+    ec2 = clients.get_client('ec2', region)
 
+    # rules scoped to other regions never cost an API call here
+    configurations = configurations_for_region(configurations, region)
     if len(configurations) <= 0:
         LOG.info('No configurations found in %s, not building cache', region)
         return cache_data
@@ -673,10 +727,8 @@ def build_cache_maps(context, configurations, region, installed_region):
 
     if len(chunked_work) > 0:
         f = functools.partial(chunk_volume_work, region)
-        pool = ThreadPool(processes=4)
-        results = pool.map(f, chunked_work)
-        pool.close()
-        pool.join()
+        # fewer workers while this region is throttling us
+        results = runtime.STATE.map(f, chunked_work, throttle.worker_count('ec2', region, 4))
 
         keys = ['volume_id_to_most_recent_snapshot_date',
                 'volume_id_to_snapshot_count',
@@ -713,6 +765,10 @@ def chunk_volume_work(region, volume_list):
             pre_ct += 1
             volume_id_to_snapshot_count[vid] = pre_ct
 
+            # a failed snapshot doesn't count as a recent one, so it will be retaken
+            if snap.get('State') == 'error':
+                continue
+
             pre_date = volume_id_to_most_recent_snapshot_date.get(vid, None)
             cur_date = snap['StartTime']
             if pre_date is None:
@@ -762,14 +818,13 @@ def build_replication_cache(context, tags, configurations, region, installed_reg
 def copy_snapshot_and_tag(context, source_region, dest_region, name_tag, snapshot_id,
                           snapshot_description):
     """Copy a snapshot to another region and tag it as such"""
-    ec2 = boto3.client('ec2', region_name=dest_region)
+    ec2 = clients.get_client('ec2', dest_region)
     try:
         result = ec2.copy_snapshot(
             SourceRegion=source_region,
             SourceSnapshotId=snapshot_id,
             Description=snapshot_description,
         )
-        sleep(1)
         created_snapshot_id = result['SnapshotId']
         tags = [
             {'Key': 'replication_src_region', 'Value': source_region},
@@ -780,25 +835,37 @@ def copy_snapshot_and_tag(context, source_region, dest_region, name_tag, snapsho
         ec2.create_tags(Resources=[created_snapshot_id], Tags=tags)
 
         return created_snapshot_id
-    except Exception as e:
-        if 'Too many snapshot copies in progress.' in str(e):
-            LOG.warn('Too many snapshots already in progress, cannot copy %s to %s from %s',
+    except ClientError as e:
+        # e.g. too many snapshot copies in progress, it'll be copied on a later run
+        if throttle.classify_error(e) == 'capacity':
+            LOG.warn('No capacity to copy %s from %s to %s right now: %s',
                      snapshot_id,
                      source_region,
-                     dest_region)
+                     dest_region,
+                     str(e))
         else:
-            raise e
+            raise
 
     return None
 
 
 def find_replication_cw_event_rule(context, default_region='us-east-1'):
     """Find and return information about the replication cloudwatch event rule"""
+    if os.environ.get(REPLICATION_RULE_ENV):
+        return os.environ[REPLICATION_RULE_ENV]
 
-    # describe cloudformation stack
     aws_account = get_owner_id(context)
-    stack_name = 'ebs-snapper-{}'.format(aws_account[0])
-    cf_client = boto3.client('cloudformation', region_name=default_region)
+    return clients.discover(
+        ('replication_rule', aws_account[0], default_region),
+        functools.partial(describe_replication_cw_event_rule, aws_account[0], default_region))
+
+
+def describe_replication_cw_event_rule(aws_account_id, default_region='us-east-1'):
+    """Find the replication rule in our CloudFormation stack, without any caching"""
+
+    # describe cloudformation stack
+    stack_name = 'ebs-snapper-{}'.format(aws_account_id)
+    cf_client = clients.get_client('cloudformation', default_region)
 
     # get replication rule name
     stack_data = cf_client.describe_stack_resources(StackName=stack_name)
@@ -851,5 +918,33 @@ class ShellContext(NonLambdaContext):
     """Context for when we're running in the shell"""
 
 
+class DaemonContext(NonLambdaContext):
+    """Context for when we're running as a daemon, with no stack or Lambda functions"""
+
+
 class MockContext(NonLambdaContext):
     """Context object when we're running tests"""
+
+
+# stands in for a Lambda context, which timeout_check only asks for the time left
+class DeadlineShareContext(object):  # pylint: disable=too-few-public-methods
+    """Context for one of several records handled at once in a single invocation
+
+    The record sees the 1 minute safety margin, plus its share of whatever
+    time was left beyond that when it started, so timeout_check stops it in
+    time for the other records to still get theirs.
+    """
+
+    def __init__(self, parent, share):
+        self.parent = parent
+        self.invoked_function_arn = getattr(parent, 'invoked_function_arn', None)
+
+        margin = 60000  # same 1 minute timeout_check wants left
+        spare = max(parent.get_remaining_time_in_millis() - margin, 0)
+        budget = margin + int(spare * min(max(share, 0.0), 1.0))
+        self.finish_time = time.time() + budget / 1000.0
+
+    def get_remaining_time_in_millis(self):
+        """Return the lesser of this record's share and the whole invocation's time left"""
+        own = max(int((self.finish_time - time.time()) * 1000), 0)
+        return min(own, self.parent.get_remaining_time_in_millis())
@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2016 Rackspace US, Inc.
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+"""Module for per-volume work items, done inline or through a work queue."""
+
+from __future__ import print_function
+import json
+import logging
+import os
+import uuid
+from ebs_snapper import clients, dispatch, hub, utils
+
+LOG = logging.getLogger()
+
+WORK_ITEM_TYPES = ['snapshot', 'delete', 'copy']
+WORK_ITEM_MODES = ['inline', 'queue']
+DEFAULT_WORK_ITEM_MODE = 'inline'
+WORK_QUEUE_ENV = 'EBS_SNAPPER_WORK_QUEUE_URL'
+
+# items are sent in SQS batches, and a consumer works on this many at once
+WORK_ITEM_WORKERS = int(os.environ.get('EBS_SNAPPER_WORK_ITEM_WORKERS', 4))
+
+
+def snapshot_item(instance_id, ami_id, volume_id, delete_on, region, tags=None):
+    """Build a work item to snapshot one volume"""
+    return {
+        'type': 'snapshot',
+        'item_id': uuid.uuid4().hex,
+        'region': region,
+        'instance_id': instance_id,
+        'ami_id': ami_id,
+        'volume_id': volume_id,
+        'delete_on': delete_on,
+        'tags': tags or [],
+    }
+
+
+def delete_item(snapshot_id, region):
+    """Build a work item to delete one snapshot"""
+    return {
+        'type': 'delete',
+        'item_id': uuid.uuid4().hex,
+        'region': region,
+        'snapshot_id': snapshot_id,
+    }
+
+
+def copy_item(source_region, dest_region, name_tag, snapshot_id, snapshot_description):
+    """Build a work item to copy one snapshot to another region"""
+    return {
+        'type': 'copy',
+        'item_id': uuid.uuid4().hex,
+        'region': dest_region,
+        'source_region': source_region,
+        'name_tag': name_tag,
+        'snapshot_id': snapshot_id,
+        'description': snapshot_description,
+    }
+
+
+def get_work_queue_url(configurations):
+    """The work queue to send items to, or None if work should be done inline"""
+    mode = utils.get_configuration_setting(configurations, 'work_item_mode',
+                                           DEFAULT_WORK_ITEM_MODE)
+    if mode not in WORK_ITEM_MODES:
+        LOG.warn('Unknown work_item_mode %s, using %s', mode, DEFAULT_WORK_ITEM_MODE)
+        mode = DEFAULT_WORK_ITEM_MODE
+
+    if mode == 'inline':
+        return None
+
+    queue_url = utils.get_configuration_setting(configurations, 'work_queue_url') or \
+        os.environ.get(WORK_QUEUE_ENV)
+    if not queue_url:
+        LOG.warn('work_item_mode is queue, but no work queue is configured, working inline')
+
+    return queue_url or None
+
+
+class WorkQueue(object):
+    """Does work items right away, or collects them and sends them to the work queue"""
+
+    def __init__(self, context, configurations, installed_region='us-east-1'):
+        self.context = context
+        self.queue_url = get_work_queue_url(configurations)
+        self.installed_region = installed_region
+        self.pending = []
+        self.queued = 0
+
+    def submit(self, item):
+        """Do (inline) or queue an item, returns the result of doing it or None if queued"""
+        if self.queue_url is None:
+            return perform_work_item(self.context, item, idempotent=False)
+
+        # in hub mode, whoever does the item has to work in the same member account
+        self.pending.append(dict(item, **hub.member_fields()))
+        if len(self.pending) >= dispatch.SQS_BATCH_SIZE:
+            self.flush()
+
+        return None
+
+    def flush(self):
+        """Send anything still waiting to the work queue"""
+        if len(self.pending) <= 0:
+            return
+
+        dispatch.SqsDispatcher(self.queue_url, self.installed_region).send_all(self.pending)
+        self.queued += len(self.pending)
+        self.pending = []
+
+
+def perform_work_item(context, item, idempotent=True):
+    """Do a single work item, and if idempotent, safely even if it was done before"""
+    if item.get('type') not in WORK_ITEM_TYPES:
+        raise Exception('Unknown work item type {}'.format(item.get('type')))
+
+    if item['type'] == 'snapshot':
+        tags = item['tags']
+        if idempotent:
+            existing = find_snapshot_by_item(item)
+            if existing is not None:
+                LOG.info('Work item %s already created snapshot %s', item['item_id'], existing)
+                return existing
+
+            # the item id is tagged first, so it survives the tag limit
+            tags = [{'Key': 'work_item_id', 'Value': item['item_id']}] + tags
+
+        return utils.snapshot_and_tag(
+            item['instance_id'],
+            item['ami_id'],
+            item['volume_id'],
+            item['delete_on'],
+            item['region'],
+            additional_tags=tags)
+
+    elif item['type'] == 'delete':
+        # a snapshot that is already gone counts as deleted
+        return utils.delete_snapshot(item['snapshot_id'], item['region'])
+
+    existing = find_copy_by_item(item) if idempotent else None
+    if existing is not None:
+        LOG.info('Snapshot %s was already copied to %s as %s',
+                 item['snapshot_id'], item['region'], existing)
+        return existing
+
+    created_snapshot_id = utils.copy_snapshot_and_tag(
+        context,
+        item['source_region'],
+        item['region'],
+        item['name_tag'],
+        item['snapshot_id'],
+        item['description'])
+
+    # no capacity to copy right now, so let the queue try again later
+    if created_snapshot_id is None and idempotent:
+        raise Exception('Could not copy {} to {} yet'.format(item['snapshot_id'], item['region']))
+
+    return created_snapshot_id
+
+
+def find_snapshot_by_item(item):
+    """Find a snapshot already created for a snapshot work item, or None"""
+    ec2 = clients.get_client('ec2', item['region'])
+    snapshots = ec2.describe_snapshots(Filters=[
+        {'Name': 'volume-id', 'Values': [item['volume_id']]},
+        {'Name': 'tag:work_item_id', 'Values': [item['item_id']]},
+    ]).get('Snapshots', [])
+
+    return snapshots[0]['SnapshotId'] if len(snapshots) > 0 else None
+
+
+def find_copy_by_item(item):
+    """Find a copy already made in the destination region for a copy work item, or None"""
+    ec2 = clients.get_client('ec2', item['region'])
+    snapshots = ec2.describe_snapshots(Filters=[
+        {'Name': 'tag:replication_snapshot_id', 'Values': [item['snapshot_id']]},
+    ]).get('Snapshots', [])
+
+    return snapshots[0]['SnapshotId'] if len(snapshots) > 0 else None
+
+
+def record_region(record, default='us-east-1'):
+    """The region of the SQS queue a record came from, from its eventSourceARN"""
+    parts = (record.get('eventSourceARN') or '').split(':')
+    if len(parts) > 3 and parts[3]:
+        return parts[3]
+
+    return record.get('awsRegion') or default
+
+
+def perform_work_records(context, records, queue_url=None, region='us-east-1'):
+    """Do the work items in a batch of SQS records, a few at a time
+
+    Each item succeeds or fails on its own. When some fail, the ones that
+    succeeded are deleted from the queue and an exception is raised, so
+    only the failures come back (and end up in the dead-letter queue if
+    they keep failing). The queue is found in the region the records came
+    from, or else region.
+    """
+    def perform_record(record):
+        """Do one record, returning True if it worked"""
+        try:
+            perform_work_item(context, json.loads(record['body']))
+            return True
+        except Exception:  # pylint: disable=broad-except
+            LOG.exception('Work item failed: %s', record.get('body'))
+            return False
+
+    def record_member(record):
+        """The member account a record's item is for, if it's from a hub"""
+        try:
+            return hub.item_member(json.loads(record['body']))
+        except Exception:  # pylint: disable=broad-except
+            return None
+
+    results = hub.perform_by_member(
+        records,
+        lambda member_records: utils.map_concurrently(
+            perform_record, member_records, WORK_ITEM_WORKERS),
+        member_of=record_member)
+    failed = [r for r, ok in zip(records, results) if not ok]
+    if len(failed) <= 0:
+        return
+
+    succeeded = [r for r, ok in zip(records, results) if ok]
+    queue_url = queue_url or os.environ.get(WORK_QUEUE_ENV)
+    if queue_url and len(succeeded) > 0:
+        sqs = clients.get_client('sqs', record_region(succeeded[0], region))
+        sqs.delete_message_batch(QueueUrl=queue_url, Entries=[
+            {'Id': str(i), 'ReceiptHandle': r['receiptHandle']} for i, r in enumerate(succeeded)
+        ])
+
+    raise Exception('{} of {} work items failed'.format(len(failed), len(records)))
@@ -23,8 +23,7 @@ setup(
         'botocore',
         'boto3',
         'pytimeparse',
-        'crontab',
-        'lambda_uploader'
+        'crontab'
     ],
     tests_require=[
         'moto',
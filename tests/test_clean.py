@@ -25,7 +25,7 @@ import json
 import datetime
 import boto3
 from moto import mock_ec2, mock_sns, mock_dynamodb2, mock_iam, mock_sts
-from ebs_snapper import clean, utils, mocks, dynamo
+from ebs_snapper import clean, regional, utils, mocks, dynamo
 from ebs_snapper import AWS_MOCK_ACCOUNT
 import dateutil
 
@@ -47,40 +47,25 @@ def test_perform_fanout_all_regions_clean(mocker):
     mocks.create_sns_topic('CleanSnapshotTopic')
     mocks.create_dynamodb()
 
-    expected_regions = utils.get_regions()
+    expected_regions = regional.get_regions()
     for r in expected_regions:  # must have an instance in the region to clean it
         mocks.create_instances(region=r)
     expected_sns_topic = utils.get_topic_arn('CleanSnapshotTopic', 'us-east-1')
 
     ctx = utils.MockContext()
-    mocker.patch('ebs_snapper.clean.send_fanout_message')
+    mocker.patch('ebs_snapper.utils.sns_publish')
 
     # fan out, and be sure we touched every region
     clean.perform_fanout_all_regions(ctx)
-    for r in expected_regions:
-        clean.send_fanout_message.assert_any_call(  # pylint: disable=E1103
-            ctx,
-            cli=False,
-            region=r,
-            topic_arn=expected_sns_topic)
-
-
-@mock_ec2
-@mock_sns
-@mock_iam
-@mock_sts
-def test_send_fanout_message_clean(mocker):
-    """Test for method of the same name."""
-
-    mocks.create_sns_topic('testing-topic')
-    expected_sns_topic = utils.get_topic_arn('testing-topic', 'us-east-1')
-    ctx = utils.MockContext()
-
-    mocker.patch('ebs_snapper.utils.sns_publish')
-    clean.send_fanout_message(ctx, region='us-west-2', topic_arn=expected_sns_topic)
-    utils.sns_publish.assert_any_call(  # pylint: disable=E1103
-        TopicArn=expected_sns_topic,
-        Message=json.dumps({'region': 'us-west-2'}))
+    sent = utils.sns_publish.call_args_list  # pylint: disable=E1103
+    assert set((c[1]['TopicArn'], c[1]['Region']) for c in sent) == \
+        set([(expected_sns_topic, 'us-east-1')])
+
+    # every region gets a message, carrying the configurations along
+    messages = [json.loads(c[1]['Message']) for c in sent]
+    assert set(expected_regions) <= set(m['region'] for m in messages)
+    for m in messages:
+        assert m['configuration']['configurations'] == []
 
 
 @mock_ec2
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2016 Rackspace US, Inc.
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+"""Module for testing clients module."""
+
+import os
+import boto3
+from moto import mock_sts
+from ebs_snapper import clients, utils
+
+
+def test_get_client():
+    """Test that clients are shared per service and region"""
+    clients.reset_clients()
+
+    client = clients.get_client('ec2', 'us-west-2')
+    assert clients.get_client('ec2', 'us-west-2') is client
+    assert clients.get_client('ec2', 'us-east-1') is not client
+    assert clients.get_client('sns', 'us-west-2') is not client
+    assert client.meta.config.max_pool_connections == clients.MAX_POOL_CONNECTIONS
+
+    clients.reset_clients()
+    assert clients.get_client('ec2', 'us-west-2') is not client
+
+
+def test_discover(mocker):
+    """Test that control-plane lookups are remembered, but misses are not"""
+    lookup = mocker.MagicMock(return_value='arn:aws:sns:us-east-1:123456789012:topic')
+
+    assert clients.discover('some-key', lookup) == lookup.return_value
+    assert clients.discover('some-key', lookup) == lookup.return_value
+    assert lookup.call_count == 1
+
+    # expired values are looked up again
+    assert clients.discover('other-key', lookup, ttl=-1) == lookup.return_value
+    assert clients.discover('other-key', lookup, ttl=-1) == lookup.return_value
+    assert lookup.call_count == 3
+
+    missing = mocker.MagicMock(return_value=None)
+    clients.discover('missing-key', missing)
+    clients.discover('missing-key', missing)
+    assert missing.call_count == 2
+
+
+@mock_sts
+def test_use_account():
+    """Test that switching accounts forgets everything about the last one."""
+    shared = clients.get_client('sts')
+    role_arn = clients.role_arn_for('123456789012', 'OrganizationAccountAccessRole')
+    assert role_arn == 'arn:aws:iam::123456789012:role/OrganizationAccountAccessRole'
+
+    try:
+        clients.use_account('123456789012', role_arn)
+        assert utils.get_owner_id(utils.ShellContext()) == ['123456789012']
+        assert clients.get_client('sts') is not shared
+
+        # the role is assumed again before its credentials run out
+        credentials = boto3.DEFAULT_SESSION._session.get_credentials()  # pylint: disable=W0212
+        assert credentials.method == 'assume-role'
+        assert credentials.refresh_needed(refresh_in=clients.ROLE_SESSION_SECONDS + 60)
+    finally:
+        clients.use_account(None)
+
+    assert clients.OWNER_ID_ENV not in os.environ
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2016 Rackspace US, Inc.
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+"""Module for testing daemon module."""
+
+import calendar
+import datetime
+import json
+import urllib2
+import boto3
+import pytest
+from moto import mock_ec2, mock_dynamodb2, mock_iam, mock_sts
+from ebs_snapper import daemon, dynamo, mocks, snapshot
+from ebs_snapper import AWS_MOCK_ACCOUNT
+
+
+def test_parse_schedule():
+    """Test that rate and cron schedules give the next run after a time."""
+    assert daemon.parse_schedule('rate(1 minute)')(1000) == 1060
+    assert daemon.parse_schedule('rate(30 minutes)')(1000) == 2800
+    assert daemon.parse_schedule('rate(6 hours)')(1000) == 1000 + 6 * 3600
+    assert daemon.parse_schedule('rate(2 days)')(1000) == 1000 + 2 * 86400
+
+    # CloudWatch style, ? and all
+    now = calendar.timegm(datetime.datetime(2017, 3, 1, 10, 30).timetuple())
+    noon = calendar.timegm(datetime.datetime(2017, 3, 1, 12, 0).timetuple())
+    assert daemon.parse_schedule('cron(0 12 * * ? *)')(now) == noon
+
+    for expression in ['rate(0 minutes)', 'rate(5 fortnights)', 'every 5 minutes']:
+        with pytest.raises(Exception):
+            daemon.parse_schedule(expression)
+
+
+def test_build_jobs():
+    """Test that jobs get default schedules, and can be turned off."""
+    jobs = daemon.build_jobs({'clean': 'off', 'replication': 'rate(1 hour)'})
+    assert [(j.name, j.schedule) for j in jobs] == [
+        ('snapshot', 'rate(30 minutes)'), ('replication', 'rate(1 hour)')]
+
+    with pytest.raises(Exception):
+        daemon.build_jobs(dict((name, 'off') for name in daemon.JOB_NAMES))
+
+
+def test_run_due():
+    """Test that due jobs run, one failing doesn't stop the next, and both are rescheduled."""
+    calls = []
+
+    def failing(context, **kwargs):
+        """Fail, after recording the call"""
+        calls.append(('failing', kwargs['installed_region']))
+        raise Exception('no access')
+
+    def working(context, **kwargs):
+        """Work, after recording the call"""
+        calls.append(('working', kwargs['installed_region']))
+
+    jobs = [daemon.Job('snapshot', failing, 'rate(30 minutes)', now=0),
+            daemon.Job('clean', working, 'rate(6 hours)', now=1)]
+    snapper = daemon.Daemon(jobs, installed_region='us-west-2')
+    snapper.run_due()
+
+    assert calls == [('failing', 'us-west-2'), ('working', 'us-west-2')]
+    assert [(j.runs, j.failures, j.last.error) for j in jobs] == [
+        (1, 1, 'no access'), (1, 0, None)]
+    assert jobs[0].next_run == jobs[0].last.started + 1800
+    assert jobs[1].next_run == jobs[1].last.started + 6 * 3600
+
+    # nothing is due yet, so nothing runs
+    snapper.run_due()
+    assert len(calls) == 2
+
+    status = snapper.status()
+    assert status['healthy'] and status['running'] is None
+    assert status['jobs']['snapshot']['last_error'] == 'no access'
+    assert 'ebs_snapper_job_failures_total{job="snapshot"} 1' in snapper.metrics().splitlines()
+
+    snapper.stop()
+    assert not snapper.healthy()
+
+
+@mock_ec2
+@mock_dynamodb2
+@mock_iam
+@mock_sts
+def test_run_job_snapshot(mocker):
+    """Test that a real snapshot fan out runs, without a stack's CloudWatch rule to toggle."""
+    region = 'us-west-2'
+    instance_id = mocks.create_instances(region, count=1)[0]
+    client = boto3.client('ec2', region_name=region)
+    client.create_tags(Resources=[instance_id], Tags=[{'Key': 'backup', 'Value': 'yes'}])
+
+    mocks.create_dynamodb('us-east-1')
+    dynamo.store_configuration('us-east-1', 'daily', AWS_MOCK_ACCOUNT, {
+        'match': {'tag:backup': 'yes'},
+        'snapshot': {'retention': '3 days', 'minimum': 2, 'frequency': '1 day'},
+        'regions': [region]
+    })
+
+    mocker.spy(snapshot, 'ensure_cloudwatch_rule_for_replication')
+    jobs = daemon.build_jobs({'clean': 'off', 'replication': 'off'})
+    snapper = daemon.Daemon(jobs, installed_region='us-east-1')
+    snapper.run_job(jobs[0])
+
+    assert jobs[0].last.error is None and jobs[0].failures == 0
+    assert not snapshot.ensure_cloudwatch_rule_for_replication.called  # pylint: disable=E1103
+    snapshots = client.describe_snapshots(OwnerIds=[AWS_MOCK_ACCOUNT])['Snapshots']
+    assert len(snapshots) == 1
+
+
+def test_status_server():
+    """Test that /health and /metrics are served, and anything else isn't found."""
+    snapper = daemon.Daemon(daemon.build_jobs({}))
+    server = daemon.start_status_server(snapper, '127.0.0.1', 0)
+    try:
+        url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+        health = json.loads(urllib2.urlopen(url + '/health').read())
+        assert health['healthy']
+        assert sorted(health['jobs']) == sorted(daemon.JOB_NAMES)
+
+        metrics = urllib2.urlopen(url + '/metrics').read()
+        assert 'ebs_snapper_job_runs_total{job="clean"} 0' in metrics.splitlines()
+
+        with pytest.raises(urllib2.HTTPError):
+            urllib2.urlopen(url + '/nothing')
+
+        # once stopping, it's no longer healthy
+        snapper.stop()
+        with pytest.raises(urllib2.HTTPError) as e:
+            urllib2.urlopen(url + '/health')
+        assert e.value.code == 503
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2016 Rackspace US, Inc.
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+"""Module for testing deploy module."""
+
+import os
+import zipfile
+import boto3
+from moto import mock_ec2, mock_dynamodb2, mock_s3, mock_iam, mock_sts
+from ebs_snapper import deploy, dynamo, mocks, utils
+from ebs_snapper import AWS_MOCK_ACCOUNT
+
+SOURCE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_build_package(tmpdir):
+    """Test for method of the same name."""
+    zip_filename = str(tmpdir.join('ebs_snapper.zip'))
+    deploy.build_package(zip_filename, source_dir=SOURCE_DIR)
+
+    names = zipfile.ZipFile(zip_filename).namelist()
+    assert 'lambdas.pyc' in names
+    assert 'ebs_snapper/__init__.pyc' in names
+    assert 'ebs_snapper/utils.pyc' in names
+
+    # only precompiled runtime modules, no tooling, tests or sources
+    assert 'ebs_snapper/deploy.pyc' not in names
+    assert 'ebs_snapper/shell.pyc' not in names
+    assert 'ebs_snapper/mocks.pyc' not in names
+    assert [n for n in names if not n.endswith('.pyc')] == []
+    assert [n for n in names if n.startswith('tests')] == []
+
+    # building again from the same code gives the same zip, so deploys can skip it
+    with open(zip_filename, 'rb') as f:
+        first = f.read()
+    deploy.build_package(zip_filename, source_dir=SOURCE_DIR)
+    with open(zip_filename, 'rb') as f:
+        assert f.read() == first
+
+
+def test_build(mocker):
+    """Test that the layer is only built again when its requirements changed."""
+    mocker.patch('ebs_snapper.deploy.build_package')
+    mocker.patch('ebs_snapper.deploy.build_layer')
+    mocker.patch('ebs_snapper.deploy.layer_is_current', return_value=True)
+
+    deploy.build(use_layer=True)
+    deploy.build_package.assert_called_once_with(  # pylint: disable=E1103
+        deploy.FUNCTION_ZIP, bundle_requirements=False)
+    deploy.build_layer.assert_not_called()  # pylint: disable=E1103
+
+    deploy.layer_is_current.return_value = False  # pylint: disable=E1103
+    deploy.build(use_layer=True)
+    deploy.build_layer.assert_called_once_with(deploy.LAYER_ZIP)  # pylint: disable=E1103
+
+    # without layers, the requirements go in the function package
+    deploy.build(use_layer=False)
+    deploy.build_package.assert_called_with(  # pylint: disable=E1103
+        deploy.FUNCTION_ZIP, bundle_requirements=True)
+
+
+def test_runtime_requirements(tmpdir):
+    """Test for method of the same name."""
+    requirements = tmpdir.join('requirements.txt')
+    requirements.write('boto3==1.7.4\n# a comment\nboto==2.47.0\nlambda-uploader==1.1.0\n\n'
+                       'crontab==0.21.3  # inline\n')
+
+    assert deploy.runtime_requirements(str(requirements)) == ['boto3==1.7.4', 'crontab==0.21.3']
+
+    # only runtime requirements version the layer
+    first = deploy.requirements_hash(str(requirements))
+    requirements.write('boto3==1.7.4\ncrontab==0.21.3\nboto==2.48.0\n')
+    assert deploy.requirements_hash(str(requirements)) == first
+    requirements.write('boto3==1.7.5\ncrontab==0.21.3\n')
+    assert deploy.requirements_hash(str(requirements)) != first
+
+
+def test_layer_is_current(tmpdir):
+    """Test for method of the same name."""
+    tmpdir.join('requirements.txt').write('boto3==1.7.4\n')
+    layer_zip = str(tmpdir.join('layer.zip'))
+    assert not deploy.layer_is_current(layer_zip, source_dir=str(tmpdir))
+
+    zf = zipfile.ZipFile(layer_zip, 'w')
+    zf.writestr('python/placeholder.py', '')
+    zf.comment = deploy.requirements_hash(str(tmpdir.join('requirements.txt')))
+    zf.close()
+    assert deploy.layer_is_current(layer_zip, source_dir=str(tmpdir))
+
+    tmpdir.join('requirements.txt').write('boto3==1.7.5\n')
+    assert not deploy.layer_is_current(layer_zip, source_dir=str(tmpdir))
+
+
+@mock_ec2
+@mock_dynamodb2
+@mock_s3
+@mock_iam
+@mock_sts
+def test_sanity_check(mocker):
+    """Test that configurations are checked against one inventory per region."""
+    for region, backup in [('us-east-1', 'daily'), ('us-west-2', 'weekly')]:
+        instance_ids = mocks.create_instances(region=region)
+        boto3.client('ec2', region_name=region).create_tags(
+            Resources=instance_ids, Tags=[{'Key': 'backup', 'Value': backup}])
+
+    mocks.create_dynamodb('us-east-1')
+    snapshot = {'retention': '4 days', 'minimum': 4, 'frequency': '1 day'}
+    matches = [('daily', {'tag:backup': 'dai*'}), ('monthly', {'tag:backup': 'monthly'})]
+    for object_id, match in matches:
+        dynamo.store_configuration('us-east-1', object_id, AWS_MOCK_ACCOUNT,
+                                   {'match': match, 'snapshot': snapshot})
+
+    mocker.spy(deploy, 'instance_inventory')
+    findings = deploy.sanity_check(utils.MockContext(), 'us-east-1', AWS_MOCK_ACCOUNT)
+
+    assert "tag:backup, value:monthly was configured, but didn't match any instances" in findings
+    assert 'tag:backup, value:weekly was tagged on an instance, but no configuration exists' in \
+        findings
+    assert not [f for f in findings if 'dai' in f]
+
+    regions = [c[0][0] for c in deploy.instance_inventory.call_args_list]  # pylint: disable=E1103
+    assert len(regions) == len(set(regions))  # one inventory per region
+
+
+def test_tag_is_configured():
+    """Test for method of the same name."""
+    configurations = [
+        {'match': {'tag:backup': 'dai*'}},
+        {'match': {'tag:backup': ['weekly', 'monthly']}},
+        {'api_rates': '5'},
+    ]
+    assert deploy.tag_is_configured('backup', 'daily', configurations)
+    assert deploy.tag_is_configured('backup', 'monthly', configurations)
+    assert not deploy.tag_is_configured('backup', 'yearly', configurations)
+    assert not deploy.tag_is_configured('Backup', 'daily', configurations)
+    assert not deploy.tag_is_configured('backup', 'daily', [])
+
+
+def test_instance_matches_filters():
+    """Test for method of the same name."""
+    instance = {'InstanceId': 'i-abc12345', 'InstanceType': 't2.micro',
+                'Tags': [{'Key': 'Name', 'Value': 'legacy_server_name_1'}]}
+    assert deploy.instance_matches_filters(instance, [
+        {'Name': 'instance-id', 'Values': ['i-nope', 'i-abc12345']},
+        {'Name': 'tag:Name', 'Values': ['legacy_server_name_*']},
+    ])
+    assert not deploy.instance_matches_filters(instance, [
+        {'Name': 'instance-id', 'Values': ['i-abc12345']},
+        {'Name': 'tag:Name', 'Values': ['other_?']},
+    ])
+    assert not deploy.instance_matches_filters(instance, [{'Name': 'tag:backup', 'Values': ['*']}])
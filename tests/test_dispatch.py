@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2016 Rackspace US, Inc.
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+"""Module for testing dispatch module."""
+
+import json
+import boto3
+from moto import mock_sns, mock_sqs, mock_iam, mock_sts
+from ebs_snapper import dispatch, utils, mocks
+
+
+def test_local_dispatcher():
+    """Test that the local dispatcher does the work itself, with no AWS at all"""
+    seen = []
+    dispatcher = dispatch.LocalDispatcher(seen.append, workers=4)
+    dispatcher.send_all([{'region': 'us-east-1'}, {'region': 'us-west-2'}], stagger=30)
+
+    assert sorted(x['region'] for x in seen) == ['us-east-1', 'us-west-2']
+
+    # a run's worker count wins over the configured one
+    configurations = [{'local_workers': 8}]
+    assert dispatch.get_dispatcher('snapshot', configurations, seen.append, 'local').workers == 8
+    assert dispatch.get_dispatcher('snapshot', configurations, seen.append, 'local',
+                                   workers=2).workers == 2
+
+
+@mock_sns
+@mock_iam
+@mock_sts
+def test_sns_dispatcher(mocker):
+    """Test for method of the same name."""
+    mocks.create_sns_topic('testing-topic')
+    expected_sns_topic = utils.get_topic_arn('testing-topic', 'us-east-1')
+
+    mocker.patch('ebs_snapper.utils.sns_publish')
+    dispatch.SnsDispatcher(expected_sns_topic).send_all([{'region': 'us-west-2'}])
+    utils.sns_publish.assert_any_call(  # pylint: disable=E1103
+        TopicArn=expected_sns_topic,
+        Message=json.dumps({'region': 'us-west-2'}),
+        Region='us-east-1')
+
+
+@mock_sqs
+def test_sqs_dispatcher():
+    """Test that SQS messages are sent in batches, staggered"""
+    client = boto3.client('sqs', region_name='us-east-1')
+    queue_url = client.create_queue(QueueName='testing-queue')['QueueUrl']
+
+    messages = [{'region': 'region-{}'.format(i)} for i in range(25)]
+    dispatch.SqsDispatcher(queue_url).send_all(messages, stagger=0)
+
+    received = []
+    for _ in range(10):
+        response = client.receive_message(QueueUrl=queue_url, MaxNumberOfMessages=10)
+        received.extend([json.loads(x['Body']) for x in response.get('Messages', [])])
+
+    assert sorted(x['region'] for x in received) == sorted(x['region'] for x in messages)
+
+
+def test_fanout_transports(mocker):
+    """Test that each region goes by its configured transport"""
+    mocker.patch('ebs_snapper.dispatch.SqsDispatcher.send_batch')
+    mocker.patch('ebs_snapper.dispatch.LambdaDispatcher.send_batch')
+    configurations = [{
+        'fanout_transport': {'us-east-1': 'sqs', 'default': 'lambda'},
+        'fanout_queues': {'snapshot': 'https://queue.amazonaws.com/123456789012/snapshots'},
+        'fanout_functions': {'snapshot': 'some-function'},
+        'fanout_stagger': 10,
+    }]
+
+    dispatch.fanout('snapshot', ['us-east-1', 'us-west-2', 'eu-west-1'], configurations, None)
+    dispatch.SqsDispatcher.send_batch.assert_called_once_with(  # pylint: disable=E1103
+        [{'region': 'us-east-1'}], [0])
+    dispatch.LambdaDispatcher.send_batch.assert_called_once_with(  # pylint: disable=E1103
+        [{'region': 'us-west-2'}, {'region': 'eu-west-1'}], [0, 10])
+
+    # the CLI does everything itself
+    handler = mocker.MagicMock()
+    dispatch.fanout('snapshot', ['us-east-1', 'us-west-2'], configurations, handler, cli=True)
+    handler.assert_any_call({'region': 'us-east-1'})
+    handler.assert_any_call({'region': 'us-west-2'})
+
+    # a process pool can't start in Lambda, so outside the CLI it's threads instead
+    local = mocker.patch('ebs_snapper.dispatch.LocalDispatcher')
+    dispatch.fanout('snapshot', ['us-east-1'], [{'fanout_transport': 'process'}], handler)
+    assert local.call_args[1]['processes'] is False
+    local.return_value.send_all.assert_called_once_with([{'region': 'us-east-1'}], 0)
+
+
+def test_fanout_payload(mocker):
+    """Test that a payload goes with messages sent elsewhere, not local ones"""
+    mocker.patch('ebs_snapper.dispatch.SqsDispatcher.send_batch')
+    configurations = [{
+        'fanout_transport': {'us-east-1': 'sqs', 'default': 'local'},
+        'fanout_queues': {'snapshot': 'https://queue.amazonaws.com/123456789012/snapshots'},
+    }]
+    payload = {'account': '123456789012', 'version': 3, 'configurations': configurations}
+
+    handler = mocker.MagicMock()
+    dispatch.fanout('snapshot', ['us-east-1', 'us-west-2'], configurations, handler,
+                    payload=payload)
+    dispatch.SqsDispatcher.send_batch.assert_called_once_with(  # pylint: disable=E1103
+        [{'region': 'us-east-1', 'configuration': payload}], [0])
+    handler.assert_called_once_with({'region': 'us-west-2'})
+
+
+def test_region_run(mocker):
+    """Test that a run picks regions, gives each a deadline, and keeps failures apart"""
+    run = dispatch.RegionRun(regions=['us-*', 'eu-west-1'], exclude_regions=['us-gov-*'],
+                             workers=2, region_timeout=10)
+    regions = ['us-east-1', 'us-gov-west-1', 'eu-west-1', 'ap-south-1']
+    assert run.select(regions) == ['us-east-1', 'eu-west-1']
+
+    deadlines = {}
+
+    def perform(context, message):
+        """Fail in one region, and remember the deadline each one got"""
+        deadlines[message['region']] = context.get_remaining_time_in_millis()
+        if message['region'] == 'eu-west-1':
+            raise Exception('no access')
+
+    ctx = utils.MockContext()
+    ctx.set_remaining_time_in_millis(60000 * 90)
+    regions, handler = run.prepare(regions, [{'local_workers': 8}], perform, ctx)
+    assert regions == ['us-east-1', 'eu-west-1']
+
+    # a run only ever does the work on local threads
+    mocker.patch('ebs_snapper.dispatch.SqsDispatcher.send_batch')
+    configurations = [{'fanout_transport': 'sqs', 'fanout_queues': {'snapshot': 'q'}}]
+    dispatch.fanout('snapshot', regions, configurations, handler, run=run)
+    assert not dispatch.SqsDispatcher.send_batch.called  # pylint: disable=E1103
+
+    assert sorted(deadlines) == sorted(regions)
+    assert all(x <= 60000 * 10 for x in deadlines.values())
+    assert sorted(r for r, _, _ in run.results) == sorted(regions)
+    assert run.failures() == ['eu-west-1']
@@ -22,11 +22,12 @@
 """Module for testing snapshot module."""
 
 from __future__ import print_function
+import json
 import pytest
 from moto import mock_dynamodb2
-from moto import mock_ec2, mock_sts, mock_iam
+from moto import mock_ec2, mock_sts, mock_iam, mock_s3
 import boto3
-from ebs_snapper import dynamo, mocks, utils
+from ebs_snapper import dynamo, mocks, utils, runtime
 from ebs_snapper import EbsSnapperError, AWS_MOCK_ACCOUNT
 
 
@@ -125,6 +126,209 @@ def test_configurations():
     assert fetched_configurations == []
 
 
+@mock_dynamodb2
+def test_load_configurations():
+    """Test that warm containers re-use configuration until it changes."""
+    region = 'us-east-1'
+    mocks.create_dynamodb(region)
+    ctx = utils.MockContext()
+
+    config_data = {
+        "match": {"instance-id": "i-abc12345"},
+        "snapshot": {"retention": "6 days", "minimum": 6, "frequency": "13 hours"}
+    }
+    dynamo.store_configuration(region, 'foo', AWS_MOCK_ACCOUNT, config_data)
+    assert dynamo.load_configurations(ctx, region) == [config_data]
+
+    # a change behind our back waits for the TTL
+    dynamodb = boto3.resource('dynamodb', region_name=region)
+    dynamodb.Table('ebs_snapshot_configuration').delete_item(
+        Key={'aws_account_id': AWS_MOCK_ACCOUNT, 'id': 'foo'})
+    assert dynamo.load_configurations(ctx, region) == [config_data]
+
+    # but our own changes are seen right away
+    dynamo.store_configuration(region, 'bar', AWS_MOCK_ACCOUNT, config_data)
+    assert dynamo.load_configurations(ctx, region) == [config_data]
+    dynamo.delete_configuration(region, 'bar', AWS_MOCK_ACCOUNT)
+    assert dynamo.load_configurations(ctx, region) == []
+
+    # other containers see the version change once their TTL is up
+    runtime.STATE.configurations[(region, AWS_MOCK_ACCOUNT)] = (0, 0, [config_data])
+    assert dynamo.load_configurations(ctx, region) == []
+
+
+@mock_dynamodb2
+def test_configuration_version():
+    """Test that changes bump the version, and the version item isn't a configuration."""
+    region = 'us-east-1'
+    mocks.create_dynamodb(region)
+    ctx = utils.MockContext()
+    assert dynamo.get_version(region, AWS_MOCK_ACCOUNT) == 0
+
+    config_data = {
+        "match": {"instance-id": "i-abc12345"},
+        "snapshot": {"retention": "6 days", "minimum": 6, "frequency": "13 hours"}
+    }
+    dynamo.store_configuration(region, 'foo', AWS_MOCK_ACCOUNT, config_data)
+    dynamo.store_configuration(region, 'bar', AWS_MOCK_ACCOUNT, config_data)
+    dynamo.delete_configuration(region, 'bar', AWS_MOCK_ACCOUNT)
+    assert dynamo.get_version(region, AWS_MOCK_ACCOUNT) == 3
+
+    assert dynamo.list_configurations(ctx, region) == [config_data]
+    assert list(dynamo.list_ids(ctx, region)) == ['foo']
+
+    with pytest.raises(Exception):
+        dynamo.store_configuration(region, dynamo.VERSION_ITEM_ID, AWS_MOCK_ACCOUNT, config_data)
+
+
+@mock_dynamodb2
+def test_members():
+    """Test that members are registered alongside, but apart from, configurations."""
+    region = 'us-east-1'
+    mocks.create_dynamodb(region)
+    ctx = utils.MockContext()
+    role_arn = 'arn:aws:iam::{}:role/ebs-snapper-member'.format(AWS_MOCK_ACCOUNT)
+
+    config_data = {
+        "match": {"instance-id": "i-abc12345"},
+        "snapshot": {"retention": "6 days", "minimum": 6, "frequency": "13 hours"}
+    }
+    dynamo.store_configuration(region, 'foo', AWS_MOCK_ACCOUNT, config_data)
+    dynamo.register_member(region, AWS_MOCK_ACCOUNT, role_arn)
+    dynamo.register_member(region, '111111111111', 'arn:aws:iam::111111111111:role/other')
+
+    assert sorted(dynamo.list_members(region)) == sorted([
+        (AWS_MOCK_ACCOUNT, role_arn),
+        ('111111111111', 'arn:aws:iam::111111111111:role/other')])
+    assert list(dynamo.list_ids(ctx, region)) == ['foo']
+    assert dynamo.list_configurations(ctx, region) == [config_data]
+
+    dynamo.deregister_member(region, '111111111111')
+    assert list(dynamo.list_members(region)) == [(AWS_MOCK_ACCOUNT, role_arn)]
+
+    with pytest.raises(Exception):
+        dynamo.store_configuration(region, dynamo.MEMBER_ITEM_ID, AWS_MOCK_ACCOUNT, config_data)
+
+
+def test_list_configurations_paginated(mocker):
+    """Test that every page of configurations is read."""
+    pages = [
+        {'Items': [{'id': 'a', 'configuration': '{"a": 1}'},
+                   {'id': dynamo.VERSION_ITEM_ID, 'version': 2}],
+         'LastEvaluatedKey': {'id': 'a'}},
+        {'Items': [{'id': 'b', 'configuration': '{"b": 2}'}]},
+    ]
+    table = mocker.Mock()
+    table.query.side_effect = pages
+
+    items = list(dynamo.query_account(table, AWS_MOCK_ACCOUNT))
+    assert [x['id'] for x in items] == ['a', 'b']
+    assert table.query.call_args_list[1][1]['ExclusiveStartKey'] == {'id': 'a'}
+
+
+@mock_dynamodb2
+def test_store_and_export_configurations():
+    """Test that configurations are written in batches and exported back out."""
+    region = 'us-east-1'
+    mocks.create_dynamodb(region)
+    ctx = utils.MockContext()
+
+    config_data = {
+        "match": {"instance-id": "i-abc12345"},
+        "snapshot": {"retention": "6 days", "minimum": 6, "frequency": "13 hours"}
+    }
+    items = [(AWS_MOCK_ACCOUNT, 'config{}'.format(i), config_data)
+             for i in range(dynamo.BATCH_WRITE_SIZE + 5)]
+    # a repeated key in the same batch goes out in the next one
+    items.append((AWS_MOCK_ACCOUNT, 'config0', config_data))
+
+    assert dynamo.store_configurations(region, iter(items)) == len(items)
+    assert dynamo.get_version(region, AWS_MOCK_ACCOUNT) == 1
+
+    exported = list(dynamo.export_configurations(ctx, region, AWS_MOCK_ACCOUNT))
+    assert len(exported) == dynamo.BATCH_WRITE_SIZE + 5
+    assert exported[0]['aws_account_id'] == AWS_MOCK_ACCOUNT
+    assert all(x['configuration'] == config_data for x in exported)
+
+    with pytest.raises(Exception):
+        dynamo.validate_configuration(dynamo.VERSION_ITEM_ID, config_data)
+    with pytest.raises(Exception):
+        dynamo.validate_configuration('foo', {'match': {}})
+
+
+def test_write_batch_unprocessed(mocker):
+    """Test that unprocessed items are retried, and given up on eventually."""
+    mocker.patch('time.sleep')
+    requests = [{'PutRequest': {'Item': {'id': str(i)}}} for i in range(3)]
+    dynamodb = mocker.Mock()
+    dynamodb.batch_write_item.side_effect = [
+        {'UnprocessedItems': {'t': requests[1:]}},
+        {'UnprocessedItems': {}},
+    ]
+
+    assert dynamo.write_batch(dynamodb, 't', requests) == 3
+    assert dynamodb.batch_write_item.call_args_list[1][1]['RequestItems'] == {'t': requests[1:]}
+
+    dynamodb.batch_write_item.side_effect = None
+    dynamodb.batch_write_item.return_value = {'UnprocessedItems': {'t': requests}}
+    with pytest.raises(Exception):
+        dynamo.write_batch(dynamodb, 't', requests)
+
+
+@mock_dynamodb2
+@mock_s3
+def test_configuration_payload(monkeypatch, mocker):
+    """Test that fanout payloads carry configurations to workers, inline or through S3."""
+    region = 'us-east-1'
+    mocks.create_dynamodb(region)
+    ctx = utils.MockContext()
+    config_data = {
+        "match": {"instance-id": "i-abc12345"},
+        "snapshot": {"retention": "6 days", "minimum": 6, "frequency": "13 hours"}
+    }
+    dynamo.store_configuration(region, 'foo', AWS_MOCK_ACCOUNT, config_data)
+
+    # nothing loaded, nothing to send
+    assert dynamo.build_payload(ctx, region) is None
+    dynamo.load_configurations(ctx, region)
+    payload = dynamo.build_payload(ctx, region)
+    assert payload['version'] == 1
+    assert payload['configurations'] == [config_data]
+
+    # a worker uses it without going to DynamoDB at all
+    runtime.STATE.reset()
+    assert dynamo.accept_payload(json.loads(json.dumps(payload)))
+    boto3.resource('dynamodb', region_name=region).Table('ebs_snapshot_configuration').delete()
+    assert dynamo.load_configurations(ctx, region) == [config_data]
+
+    # stale or broken payloads are ignored
+    assert not dynamo.accept_payload(dict(payload, issued=0))
+    assert not dynamo.accept_payload(dict(payload, version=0))
+    assert not dynamo.accept_payload({'version': 2})
+    assert not dynamo.accept_payload(None)
+
+    # too large for a message, so it goes through S3
+    monkeypatch.setattr(dynamo, 'PAYLOAD_MAX_BYTES', 10)
+    assert dynamo.build_payload(ctx, region) is None
+    boto3.client('s3', region_name=region).create_bucket(Bucket='ebs-snapper-bucket')
+    monkeypatch.setenv(dynamo.PAYLOAD_BUCKET_ENV, 'ebs-snapper-bucket')
+    payload = dynamo.build_payload(ctx, region)
+    assert 'configurations' not in payload
+    assert payload['s3'] == {'bucket': 'ebs-snapper-bucket',
+                             'key': 'configurations/{}/1.json'.format(AWS_MOCK_ACCOUNT)}
+
+    runtime.STATE.reset()
+    assert dynamo.accept_payload(payload)
+    assert dynamo.load_configurations(ctx, region) == [config_data]
+
+    # the same version isn't put again
+    s3 = boto3.client('s3', region_name=region)
+    mocker.spy(s3, 'put_object')
+    mocker.patch('ebs_snapper.clients.get_client', return_value=s3)
+    assert dynamo.build_payload(ctx, region)['s3'] == payload['s3']
+    assert s3.put_object.call_count == 0
+
+
 @mock_ec2
 @mock_dynamodb2
 @mock_iam
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2016 Rackspace US, Inc.
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+"""Module for testing hub module."""
+
+import pytest
+from moto import mock_dynamodb2
+from ebs_snapper import clients, hub, dynamo, mocks, runtime, utils
+
+MEMBERS = [('111111111111', 'arn:aws:iam::111111111111:role/ebs-snapper-member'),
+           ('222222222222', 'arn:aws:iam::222222222222:role/ebs-snapper-member')]
+
+
+@mock_dynamodb2
+def test_fanout_accounts(monkeypatch):
+    """Test that a hub fans out for each member, with EC2 work going to it."""
+    mocks.create_dynamodb('us-east-1')
+    for aws_account_id, role_arn in MEMBERS:
+        dynamo.register_member('us-east-1', aws_account_id, role_arn)
+
+    seen = []
+
+    def fanout_account(member):
+        """Record who it's for, and who EC2 would be working on"""
+        seen.append((member, clients.current_member()))
+
+    # not a hub, so just this account
+    hub.fanout_accounts(utils.MockContext(), 'us-east-1', fanout_account)
+    assert seen == [(None, None)]
+
+    del seen[:]
+    monkeypatch.setenv(hub.HUB_ENV, 'true')
+    hub.fanout_accounts(utils.MockContext(), 'us-east-1', fanout_account)
+    assert sorted(seen) == sorted(
+        ({'account': a, 'role_arn': r}, a) for a, r in MEMBERS)
+    assert clients.current_member() is None
+
+    # one member failing doesn't stop the other
+    def failing_fanout_account(member):
+        """Fail for the first member only"""
+        seen.append(member['account'])
+        if member['account'] == MEMBERS[0][0]:
+            raise Exception('no access')
+
+    del seen[:]
+    with pytest.raises(Exception):
+        hub.fanout_accounts(utils.MockContext(), 'us-east-1', failing_fanout_account)
+    assert sorted(seen) == [a for a, _ in MEMBERS]
+    assert clients.current_member() is None
+
+
+@mock_dynamodb2
+def test_perform_by_member():
+    """Test that items are done a member at a time, and results keep their order."""
+    mocks.create_dynamodb('us-east-1')
+    for aws_account_id, role_arn in MEMBERS:
+        dynamo.register_member('us-east-1', aws_account_id, role_arn)
+
+    # a role an item names is never used, only the registered one
+    items = [
+        {'region': 'us-east-1', 'account': MEMBERS[0][0], 'role_arn': MEMBERS[0][1]},
+        {'region': 'us-west-2'},
+        {'region': 'us-west-2', 'account': MEMBERS[0][0], 'role_arn': 'arn:aws:iam::9:role/x'},
+        {'region': 'eu-west-1', 'account': MEMBERS[1][0]},
+    ]
+
+    def perform(group):
+        """Return which member (and role) each item was done in"""
+        assert len(set(x.get('account') for x in group)) == 1
+        return [(x['region'], runtime.STATE.member) for x in group]
+
+    assert hub.perform_by_member(items, perform) == [
+        ('us-east-1', MEMBERS[0]),
+        ('us-west-2', None),
+        ('us-west-2', MEMBERS[0]),
+        ('eu-west-1', MEMBERS[1]),
+    ]
+    assert clients.current_member() is None
+
+    # nothing is done for an account that was never registered
+    done = []
+    with pytest.raises(Exception):
+        hub.perform_by_member(items + [{'region': 'us-east-1', 'account': '333333333333'}],
+                              done.extend)
+    assert done == []
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2016 Rackspace US, Inc.
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+"""Module for measuring import time, so Lambda cold starts stay fast.
+
+Run it directly (python tests/test_imports.py) to report what each entry
+point costs to import, module by module.
+"""
+
+from __future__ import print_function
+import json
+import os
+import subprocess
+import sys
+import pytest
+
+# modules an entry point must not load until the code path that needs them runs
+ENTRY_POINTS = {
+    'ebs_snapper.lambdas': [
+        'ebs_snapper.deploy', 'ebs_snapper.daemon', 'ebs_snapper.inventory',
+        'lambda_uploader',
+        'ebs_snapper.snapshot', 'ebs_snapper.clean', 'ebs_snapper.replication',
+        'crontab', 'pytimeparse', 'multiprocessing.pool',
+    ],
+    'ebs_snapper.shell': [
+        'ebs_snapper.deploy', 'ebs_snapper.daemon', 'ebs_snapper.inventory',
+        'lambda_uploader',
+        'crontab', 'pytimeparse', 'multiprocessing.pool',
+    ],
+}
+
+# milliseconds each entry point may take to import, beyond importing boto3 itself
+IMPORT_BUDGET_MS = {
+    'ebs_snapper.lambdas': 150,
+    'ebs_snapper.shell': 300,
+}
+
+# slower machines may scale every budget, e.g. IMPORT_BUDGET_SCALE=2
+IMPORT_BUDGET_SCALE = float(os.environ.get('IMPORT_BUDGET_SCALE', 1))
+
+MEASURE = r'''
+import json, sys, time
+try:
+    import __builtin__ as builtins
+except ImportError:
+    import builtins
+
+original = builtins.__import__
+costs = {}
+nested = []
+
+
+def timed_import(name, *args, **kwargs):
+    fromlist = kwargs.get('fromlist', args[2] if len(args) > 2 else None)
+    before = len(sys.modules)
+    nested.append(0.0)
+    start = time.time()
+    try:
+        return original(name, *args, **kwargs)
+    finally:
+        total = time.time() - start
+        inner = nested.pop()
+        if nested:
+            nested[-1] += total
+        if len(sys.modules) > before:
+            label = name if not fromlist else '{}.{}'.format(name, ','.join(fromlist))
+            costs[label] = costs.get(label, 0.0) + (total - inner) * 1000
+
+builtins.__import__ = timed_import
+start = time.time()
+__import__(sys.argv[1])
+total = (time.time() - start) * 1000
+builtins.__import__ = original
+
+print(json.dumps({'total': total, 'costs': costs, 'modules': sorted(sys.modules)}))
+'''
+
+
+def measure(module, runs=3):
+    """Import module in fresh interpreters, keeping the fastest run"""
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    results = []
+    for _ in range(runs):
+        output = subprocess.check_output([sys.executable, '-c', MEASURE, module], cwd=root)
+        results.append(json.loads(output.decode('utf-8')))
+
+    return min(results, key=lambda r: r['total'])
+
+
+@pytest.mark.parametrize('module', sorted(ENTRY_POINTS))
+def test_entry_point_imports(module):
+    """Test that entry points load only what they need, within their budget."""
+    result = measure(module)
+
+    loaded = [m for m in ENTRY_POINTS[module] if m in result['modules']]
+    assert loaded == []
+
+    cost = result['total'] - measure('boto3')['total']
+    assert cost <= IMPORT_BUDGET_MS[module] * IMPORT_BUDGET_SCALE, \
+        'importing {} took {:.0f}ms beyond boto3'.format(module, cost)
+
+
+def report(top=15):
+    """Print each entry point's import time, and its most expensive modules"""
+    baseline = measure('boto3')['total']
+    print('boto3: {:.1f}ms'.format(baseline))
+    for module in sorted(ENTRY_POINTS):
+        result = measure(module)
+        print('{}: {:.1f}ms ({:.1f}ms beyond boto3, budget {}ms)'.format(
+            module, result['total'], result['total'] - baseline,
+            IMPORT_BUDGET_MS[module] * IMPORT_BUDGET_SCALE))
+        costs = sorted(result['costs'].items(), key=lambda x: x[1], reverse=True)
+        for name, cost in costs[:top]:
+            print('  {:8.1f}ms  {}'.format(cost, name))
+
+
+if __name__ == '__main__':
+    report()
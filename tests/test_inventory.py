@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2016 Rackspace US, Inc.
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+"""Module for testing inventory module."""
+
+import csv
+import gzip
+import json
+import os
+import StringIO
+import tempfile
+import boto3
+import pytest
+from moto import mock_ec2, mock_dynamodb2, mock_iam, mock_sts
+from ebs_snapper import inventory, dispatch, dynamo, utils, mocks
+from ebs_snapper import AWS_MOCK_ACCOUNT
+
+
+def setup_inventory():
+    """Make a configured account with a volume in two regions, one snapshot tagged"""
+    mocks.create_dynamodb('us-east-1')
+    dynamo.store_configuration('us-east-1', 'some_unique_id', AWS_MOCK_ACCOUNT, {
+        'match': {'tag:backup': 'yes'},
+        'snapshot': {'retention': '4 days', 'minimum': 5, 'frequency': '12 hours'}
+    })
+
+    snapshots = {}
+    for region in ['us-east-1', 'us-west-2']:
+        client = boto3.client('ec2', region_name=region)
+        volume = client.create_volume(Size=8, AvailabilityZone=region + 'a')
+        snap = client.create_snapshot(VolumeId=volume['VolumeId'])
+        snapshots[region] = snap['SnapshotId']
+
+    boto3.client('ec2', region_name='us-west-2').create_tags(
+        Resources=[snapshots['us-west-2']],
+        Tags=[{'Key': 'DeleteOn', 'Value': '2017-03-05'},
+              {'Key': 'replication_dst_region', 'Value': 'us-east-1'}])
+
+    return snapshots
+
+
+@mock_ec2
+@mock_dynamodb2
+@mock_iam
+@mock_sts
+def test_export_ndjson():
+    """Test that every volume and snapshot of the selected regions comes out, one per line."""
+    snapshots = setup_inventory()
+    run = dispatch.RegionRun(regions=['us-east-1', 'us-west-2'], workers=2)
+    stream = StringIO.StringIO()
+
+    ctx = utils.MockContext()
+    assert inventory.export(ctx, stream, run) == 4
+
+    rows = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert sorted((r['kind'], r['region']) for r in rows) == [
+        ('snapshot', 'us-east-1'), ('snapshot', 'us-west-2'),
+        ('volume', 'us-east-1'), ('volume', 'us-west-2')]
+    assert all(sorted(r) == sorted(inventory.FIELDS) for r in rows)
+
+    tagged = [r for r in rows if r['id'] == snapshots['us-west-2']][0]
+    assert tagged['delete_on'] == '2017-03-05'
+    assert tagged['replication_dst_region'] == 'us-east-1'
+    assert tagged['account'] == AWS_MOCK_ACCOUNT and tagged['size_gib'] == 8
+    assert sorted(r for r, _, _ in run.results) == ['us-east-1', 'us-west-2']
+
+
+@mock_ec2
+@mock_dynamodb2
+@mock_iam
+@mock_sts
+def test_export_csv_gzip():
+    """Test that a CSV inventory can be gzipped to a file."""
+    setup_inventory()
+    run = dispatch.RegionRun(regions=['us-west-2'])
+    filename = os.path.join(tempfile.mkdtemp(), 'inventory.csv.gz')
+
+    stream = inventory.open_output(filename, compress=True)
+    try:
+        inventory.export(utils.MockContext(), stream, run, output_format='csv')
+    finally:
+        stream.close()
+
+    with gzip.open(filename, 'rb') as f:
+        rows = list(csv.DictReader(f))
+    assert sorted(r['kind'] for r in rows) == ['snapshot', 'volume']
+    assert set(r['region'] for r in rows) == set(['us-west-2'])
+    assert [r['delete_on'] for r in rows if r['kind'] == 'snapshot'] == ['2017-03-05']
+
+    with pytest.raises(Exception):
+        inventory.export(utils.MockContext(), StringIO.StringIO(), run, output_format='xml')
+
+
+def test_stream_rows_bounded(mocker):
+    """Test that rows stream through a bounded queue, and a failed region is kept apart."""
+    mocker.patch('ebs_snapper.inventory.QUEUE_SIZE', 2)
+
+    def rows(context, region, account):
+        """Lots of rows, or a failure in one region"""
+        if region == 'eu-west-1':
+            raise Exception('no access')
+        for i in range(50):
+            yield {'kind': 'volume', 'region': region, 'id': i}
+
+    mocker.patch('ebs_snapper.inventory.volume_rows', rows)
+    mocker.patch('ebs_snapper.inventory.snapshot_rows', rows)
+    run = dispatch.RegionRun(workers=3)
+    ctx = utils.MockContext()
+    ctx.set_remaining_time_in_millis(60000 * 10)
+
+    found = list(inventory.stream_rows(ctx, ['us-east-1', 'us-west-2', 'eu-west-1'],
+                                       AWS_MOCK_ACCOUNT, run, []))
+    assert len(found) == 2 * 2 * 50
+    assert run.failures() == ['eu-west-1']
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2016 Rackspace US, Inc.
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+"""Module for testing lambdas module."""
+
+import json
+import time
+import pytest
+from ebs_snapper import lambdas, runtime, utils
+
+
+def test_fanout_messages():
+    """Test for method of the same name."""
+    def sns(message):
+        """An SNS record carrying message"""
+        return {'Sns': {'Message': message}}
+
+    event = {'Records': [
+        sns(json.dumps({'region': 'us-east-1'})),
+        {'body': json.dumps({'region': 'us-west-2'})},
+        sns('not json'),
+        sns(json.dumps(['us-east-2'])),
+        sns(json.dumps({'place': 'us-east-2'})),
+        sns(json.dumps({'region': 'us-east-1; rm -rf'})),
+        sns(json.dumps({'region': 'us-east-1'})),
+        {'Sns': {}},
+        # from a hub, the same region can come up again for another account
+        sns(json.dumps({'region': 'us-east-1', 'account': '111111111111',
+                        'role_arn': 'arn:aws:iam::111111111111:role/ebs-snapper-member'})),
+        sns(json.dumps({'region': 'us-east-1', 'account': 'not-an-account', 'role_arn': 'x'})),
+        sns(json.dumps({'region': 'us-east-1', 'account': '222222222222'})),
+    ]}
+    messages = lambdas.fanout_messages(event, 'test')
+    assert [(m.get('account'), m['region']) for m in messages] == \
+        [(None, 'us-east-1'), (None, 'us-west-2'), ('111111111111', 'us-east-1'),
+         ('222222222222', 'us-east-1')]
+
+    # invoked directly
+    assert lambdas.fanout_messages({'region': 'us-gov-west-1'}, 'test') == \
+        [{'region': 'us-gov-west-1'}]
+
+    assert lambdas.fanout_messages(None, 'test') == []
+    assert lambdas.fanout_messages({'Records': None}, 'test') == []
+
+
+def test_perform_messages_isolates_failures():
+    """Test that one failing region doesn't stop the rest."""
+    ctx = utils.MockContext()
+    done = []
+
+    def perform(context, region):
+        """Fail in one region only"""
+        if region == 'us-west-1':
+            raise Exception('bad region')
+        # each region only gets part of the time, but still the safety margin
+        assert 60000 <= context.get_remaining_time_in_millis() <= ctx.get_remaining_time_in_millis()
+        done.append(region)
+
+    messages = [{'region': r} for r in ['us-east-1', 'us-west-1', 'us-west-2']]
+    with pytest.raises(Exception) as excinfo:
+        lambdas.perform_messages(ctx, messages, perform, 'test')
+
+    assert 'us-west-1' in str(excinfo.value)
+    assert sorted(done) == ['us-east-1', 'us-west-2']
+
+    # a single region keeps the whole invocation's context
+    seen = []
+    lambdas.perform_messages(ctx, [{'region': 'us-east-1'}],
+                             lambda c, r: seen.append(c), 'test')
+    assert seen == [ctx]
+
+
+def test_warm_invocation():
+    """Test that state survives a good invocation, and not a bad one."""
+    runtime.STATE.discovered['owner'] = (time.time() + 60, ['123'])
+
+    @lambdas.warm_invocation
+    def handler(event, context):
+        """Fail when asked to"""
+        if event.get('fail'):
+            raise Exception('failed')
+
+    handler({}, utils.MockContext())
+    assert runtime.STATE.logging_configured
+    assert 'owner' in runtime.STATE.discovered
+
+    with pytest.raises(Exception):
+        handler({'fail': True}, utils.MockContext())
+    assert 'owner' not in runtime.STATE.discovered
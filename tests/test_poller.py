@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2016 Rackspace US, Inc.
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+"""Module for testing poller module."""
+
+from datetime import datetime, timedelta
+import dateutil
+import boto3
+from moto import mock_ec2, mock_iam, mock_sts
+from ebs_snapper import poller, clients, utils
+
+
+def setup_module(module):
+    import logging
+    logging.getLogger('botocore').setLevel(logging.WARNING)
+    logging.getLogger('boto3').setLevel(logging.WARNING)
+    logging.basicConfig(level=logging.INFO)
+
+
+def test_in_flight_snapshot_ids():
+    """Test for method of the same name."""
+    snapshots = [
+        {'SnapshotId': 'snap-1', 'State': 'completed'},
+        {'SnapshotId': 'snap-2', 'State': 'pending'},
+        {'SnapshotId': 'snap-3', 'State': 'error'},
+    ]
+    assert poller.in_flight_snapshot_ids(snapshots) == ['snap-2', 'snap-3']
+
+
+@mock_ec2
+@mock_iam
+@mock_sts
+def test_poll_snapshots():
+    """Test for method of the same name."""
+    region = 'us-west-2'
+    ctx = utils.MockContext()
+    client = boto3.client('ec2', region_name=region)
+
+    volume = client.create_volume(Size=100, AvailabilityZone=region + 'a')
+    snapshot_ids = [client.create_snapshot(VolumeId=volume['VolumeId'])['SnapshotId']
+                    for _ in range(3)]
+
+    # add something that was deleted along the way
+    gone_id = client.create_snapshot(VolumeId=volume['VolumeId'])['SnapshotId']
+    client.delete_snapshot(SnapshotId=gone_id)
+
+    results = poller.poll_snapshots(ctx, region, snapshot_ids + [gone_id])
+    assert sorted(results['completed']) == sorted(snapshot_ids)
+    assert sorted(results['latency'].keys()) == sorted(snapshot_ids)
+    assert results['missing'] == [gone_id]
+    assert results['error'] == []
+
+
+@mock_ec2
+@mock_iam
+@mock_sts
+def test_poll_snapshots_requeue(mocker):
+    """Test that failed snapshots and copies are started over"""
+    region = 'us-west-2'
+    ctx = utils.MockContext()
+    client = boto3.client('ec2', region_name=region)
+    volume = client.create_volume(Size=100, AvailabilityZone=region + 'a')
+    now = datetime.now(dateutil.tz.tzutc())
+
+    failed = [
+        # a failed snapshot
+        {'SnapshotId': 'snap-failed1', 'State': 'error', 'VolumeId': volume['VolumeId'],
+         'StartTime': now - timedelta(hours=1), 'Description': 'failed snapshot',
+         'Tags': [{'Key': 'DeleteOn', 'Value': '2016-01-01'}]},
+        # a failed copy
+        {'SnapshotId': 'snap-failed2', 'State': 'error', 'VolumeId': 'vol-ffffffff',
+         'StartTime': now - timedelta(hours=1), 'Description': 'failed copy',
+         'Tags': [{'Key': 'replication_src_region', 'Value': 'us-east-1'},
+                  {'Key': 'replication_snapshot_id', 'Value': 'snap-source'}]},
+        # a failed snapshot that was already retried too many times
+        {'SnapshotId': 'snap-failed3', 'State': 'error', 'VolumeId': volume['VolumeId'],
+         'StartTime': now - timedelta(hours=1), 'Description': 'failed again',
+         'Tags': [{'Key': 'requeue_count', 'Value': str(poller.MAX_REQUEUE_ATTEMPTS)}]},
+        # a pending snapshot
+        {'SnapshotId': 'snap-pending', 'State': 'pending', 'VolumeId': volume['VolumeId'],
+         'StartTime': now, 'Progress': '45%', 'Description': 'pending', 'Tags': []},
+    ]
+    mocker.patch('ebs_snapper.utils.build_snapshot_paginator', return_value=[
+        {'Snapshots': failed}])
+    mocker.patch('ebs_snapper.utils.copy_snapshot_and_tag', return_value='snap-newcopy')
+    mocker.patch('ebs_snapper.utils.delete_snapshot')
+    mocker.patch('ebs_snapper.clients.get_client')
+
+    results = poller.poll_snapshots(ctx, region, [x['SnapshotId'] for x in failed])
+    assert sorted(results['error']) == ['snap-failed1', 'snap-failed2', 'snap-failed3']
+    assert results['pending'] == ['snap-pending']
+    assert results['progress'] == {'snap-pending': '45%'}
+    assert len(results['requeued']) == 2
+    assert 'snap-newcopy' in results['requeued']
+
+    utils.copy_snapshot_and_tag.assert_called_once_with(  # pylint: disable=E1103
+        ctx, 'us-east-1', region, None, 'snap-source', 'failed copy')
+    utils.delete_snapshot.assert_any_call('snap-failed1', region)  # pylint: disable=E1103
+    utils.delete_snapshot.assert_any_call('snap-failed2', region)  # pylint: disable=E1103
+    assert utils.delete_snapshot.call_count == 2  # pylint: disable=E1103
+
+    # the one we gave up on is tagged, once
+    ec2 = clients.get_client.return_value  # pylint: disable=E1103
+    ec2.create_tags.assert_any_call(
+        Resources=['snap-failed3'], Tags=[{'Key': 'requeue_exhausted', 'Value': 'true'}])
+    ec2.create_tags.reset_mock()
+    failed[2]['Tags'].append({'Key': 'requeue_exhausted', 'Value': 'true'})
+    assert poller.requeue_snapshot(ctx, region, failed[2]) is None
+    ec2.create_tags.assert_not_called()
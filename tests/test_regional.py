@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2016 Rackspace US, Inc.
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+"""Module for testing regional module."""
+
+import boto3
+from moto import mock_ec2, mock_iam, mock_sts
+from ebs_snapper import clients, dispatch, mocks, regional, utils
+
+
+@mock_ec2
+@mock_iam
+@mock_sts
+def test_get_regions_with_instances_or_snapshots():
+    """Test for method of the same name."""
+    client_uswest2 = boto3.client('ec2', region_name='us-west-2')
+
+    # toss an instance in us-west-2
+    client_uswest2.run_instances(ImageId='ami-123abc', MinCount=1, MaxCount=5)
+
+    # be sure we get us-west-2 *only*
+    assert ['us-west-2'] == regional.get_regions(
+        must_contain_instances=True,
+        must_contain_snapshots=False)
+
+    # now say we don't filter by instances, be sure we get a lot of regions
+    found_regions = regional.get_regions(
+        must_contain_instances=False,
+        must_contain_snapshots=False)
+    expected_regions = ['eu-west-1', 'sa-east-1', 'us-east-1',
+                        'ap-northeast-1', 'us-west-2', 'us-west-1']
+    for expected_region in expected_regions:
+        assert expected_region in found_regions
+
+    # now take a snapshot
+    client_uswest1 = boto3.client('ec2', region_name='us-west-1')
+    volume_results = client_uswest1.create_volume(Size=100, AvailabilityZone='us-west-1a')
+    client_uswest1.create_snapshot(VolumeId=volume_results['VolumeId'])
+    clients.reset_discovery()
+
+    # be sure that snapshot filter works and only returns the snapshot region
+    assert ['us-west-1'] == regional.get_regions(
+        must_contain_instances=False,
+        must_contain_snapshots=True)
+
+    # now filter by both, should be nothing returned
+    found_regions = regional.get_regions(must_contain_instances=True, must_contain_snapshots=True)
+    assert len(found_regions) == 0
+
+    # now snap in us-west-2 where we have an instance as well
+    volume_results2 = client_uswest2.create_volume(Size=100, AvailabilityZone='us-west-2a')
+    client_uswest2.create_snapshot(VolumeId=volume_results2['VolumeId'])
+    clients.reset_discovery()
+    found_regions = regional.get_regions(must_contain_instances=True, must_contain_snapshots=True)
+    assert found_regions == ['us-west-2']
+
+
+@mock_ec2
+@mock_iam
+@mock_sts
+def test_region_contains_instances():
+    """Test for method of the same name."""
+    client = boto3.client('ec2', region_name='us-west-2')
+
+    # toss an instance in us-west-2
+    client.run_instances(ImageId='ami-123abc', MinCount=1, MaxCount=5)
+
+    # be sure we get us-west-2
+    assert regional.region_contains_instances('us-west-2')
+
+    # be sure we don't get us-east-1
+    assert not regional.region_contains_instances('us-east-1')
+
+
+@mock_ec2
+@mock_iam
+@mock_sts
+def test_region_contains_snapshots():
+    """Test for method of the same name."""
+    client = boto3.client('ec2', region_name='us-west-2')
+
+    # toss a volume in us-west-2 and snapshot it
+    volume_results = client.create_volume(Size=100, AvailabilityZone='us-west-1a')
+    client.create_snapshot(VolumeId=volume_results['VolumeId'])
+
+    # be sure we get us-west-2
+    assert regional.region_contains_snapshots('us-west-2')
+
+    # be sure we don't get us-east-1
+    assert not regional.region_contains_snapshots('us-east-1')
+
+
+def test_filter_regions():
+    """Test for method of the same name."""
+    regions = ['us-east-1', 'us-west-2', 'eu-west-1']
+    assert regional.filter_regions(regions) == regions
+    assert regional.filter_regions(regions, [{'regions': ['us-west-2', 'eu-west-1']}]) == \
+        ['us-west-2', 'eu-west-1']
+    assert regional.filter_regions(regions, [{'ignore_regions': ['eu-west-1']}]) == \
+        ['us-east-1', 'us-west-2']
+    assert regional.filter_regions(regions, [{'regions': ['us-west-2', 'eu-west-1'],
+                                              'ignore_regions': ['eu-west-1']}]) == ['us-west-2']
+    assert regional.filter_regions(regions, [{'regions': ['us-*']}]) == ['us-east-1', 'us-west-2']
+
+    # on a snapshot configuration, regions only scopes that configuration
+    rule = {'match': {'tag:backup': 'yes'}, 'regions': ['us-west-2'],
+            'snapshot': {'retention': '4 days', 'minimum': 4, 'frequency': '1 day'}}
+    assert regional.filter_regions(regions, [rule]) == regions
+
+
+def test_targeted_regions():
+    """Test that configurations scoped to regions only apply there."""
+    regions = ['us-east-1', 'us-west-2', 'eu-west-1']
+    snapshot = {'retention': '4 days', 'minimum': 4, 'frequency': '1 day'}
+    west = {'match': {'tag:backup': 'west'}, 'snapshot': snapshot, 'regions': ['us-west-*']}
+    europe = {'match': {'tag:backup': 'eu'}, 'snapshot': snapshot, 'regions': ['eu-*']}
+    everywhere = {'match': {'tag:backup': 'yes'}, 'snapshot': snapshot}
+    settings = {'snapshot': snapshot, 'api_rates': {'read': 20}}
+
+    assert regional.targeted_regions(regions, [west, settings]) == ['us-west-2']
+    assert regional.targeted_regions(regions, [west, europe]) == ['us-west-2', 'eu-west-1']
+    assert regional.targeted_regions(regions, [west, everywhere]) == regions
+    assert regional.targeted_regions(regions, [settings]) == []
+
+    assert utils.configurations_for_region([west, europe, everywhere, settings], 'eu-west-1') == \
+        [europe, everywhere, settings]
+
+
+@mock_ec2
+@mock_iam
+@mock_sts
+def test_get_regions_cached(mocker):
+    """Test that regions are probed once, and only the allowed ones"""
+    mocks.create_instances(region='us-west-2')
+    mocker.spy(regional, 'region_contains_instances')
+    configurations = [{'regions': ['us-west-2', 'us-east-1']}]
+
+    assert regional.get_regions(must_contain_instances=True, configurations=configurations) == \
+        ['us-west-2']
+    assert regional.region_contains_instances.call_count == 2  # pylint: disable=E1103
+
+    assert regional.get_regions(must_contain_instances=True, configurations=configurations) == \
+        ['us-west-2']
+    assert regional.region_contains_instances.call_count == 2  # pylint: disable=E1103
+
+
+@mock_ec2
+@mock_iam
+@mock_sts
+def test_get_regions_selected(mocker):
+    """Test that regions a CLI run leaves out are never probed"""
+    mocks.create_instances(region='us-west-2')
+    mocks.create_instances(region='us-east-1')
+    mocker.spy(regional, 'region_contains_instances')
+    run = dispatch.RegionRun(regions=['us-west-*'], exclude_regions=['us-west-1'])
+
+    assert regional.get_regions(must_contain_instances=True, select=run.select) == ['us-west-2']
+    calls = regional.region_contains_instances.call_args_list  # pylint: disable=E1103
+    assert [c[0][0] for c in calls] == ['us-west-2']
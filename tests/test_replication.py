@@ -21,9 +21,12 @@
 #
 """Module for testing replication module."""
 
+from datetime import datetime, timedelta
+import json
+import dateutil
 import boto3
 from moto import mock_ec2, mock_sns, mock_dynamodb2, mock_sts, mock_iam
-from ebs_snapper import replication, dynamo, utils, mocks
+from ebs_snapper import replication, poller, dynamo, utils, mocks
 from ebs_snapper import AWS_MOCK_ACCOUNT
 
 
@@ -44,6 +47,7 @@ def test_perform_fanout_all_regions_replication(mocker):
 
     # make a dummy SNS topic
     mocks.create_sns_topic('ReplicationSnapshotTopic')
+    mocks.create_dynamodb('us-east-1')
     expected_sns_topic = utils.get_topic_arn('ReplicationSnapshotTopic', 'us-east-1')
 
     dummy_regions = ['us-west-2', 'us-east-1']
@@ -58,16 +62,19 @@ def test_perform_fanout_all_regions_replication(mocker):
 
     # patch the final message sender method
     ctx = utils.MockContext()
-    mocker.patch('ebs_snapper.replication.send_fanout_message')
+    mocker.patch('ebs_snapper.utils.sns_publish')
     replication.perform_fanout_all_regions(ctx)
 
     # fan out, and be sure we touched every instance we created before
-    for r in dummy_regions:
-        replication.send_fanout_message.assert_any_call(
-            context=ctx,
-            region=r,
-            sns_topic=expected_sns_topic,
-            cli=False)  # pylint: disable=E1103
+    sent = utils.sns_publish.call_args_list  # pylint: disable=E1103
+    assert set((c[1]['TopicArn'], c[1]['Region']) for c in sent) == \
+        set([(expected_sns_topic, 'us-east-1')])
+
+    # every region gets a message, carrying the configurations along
+    messages = [json.loads(c[1]['Message']) for c in sent]
+    assert set(dummy_regions) <= set(m['region'] for m in messages)
+    for m in messages:
+        assert m['configuration']['configurations'] == []
 
 
 @mock_ec2
@@ -110,7 +117,7 @@ def test_perform_replication(mocker):
     )
 
     # trigger replication, assert that we copied a snapshot to region_b
-    mocker.patch('ebs_snapper.utils.copy_snapshot_and_tag')
+    mocker.patch('ebs_snapper.utils.copy_snapshot_and_tag', return_value=None)
     replication.perform_replication(ctx, region_a)
     utils.copy_snapshot_and_tag.assert_any_call(  # pylint: disable=E1103
         ctx,
@@ -148,3 +155,100 @@ def test_perform_replication(mocker):
         replica_snapshot['SnapshotId'],
         region_b
     )
+
+
+def test_requeue_failed_copies(mocker):
+    """Test that failed copies are started over into free slots, taking them up."""
+    ctx = utils.MockContext()
+    failed = {'us-east-1': [{'SnapshotId': 'snap-failed1'}, {'SnapshotId': 'snap-failed2'}]}
+    in_flight_ids = {}
+    mocker.patch('ebs_snapper.poller.requeue_snapshot', return_value='snap-new')
+
+    # every pending copy into the destination counts, whichever region it came from
+    mocker.patch('ebs_snapper.utils.build_snapshot_paginator', return_value=[
+        {'Snapshots': [{'SnapshotId': 'snap-pending'}]}])
+    in_flight = {'us-east-1': replication.count_pending_copies(ctx, 'us-east-1')}
+    assert in_flight == {'us-east-1': 1}
+    params = utils.build_snapshot_paginator.call_args[0][0]  # pylint: disable=E1103
+    assert {'Name': 'status', 'Values': ['pending']} in params['Filters']
+
+    # two slots, so only one failed copy fits beside the pending one
+    replication.requeue_failed_copies(ctx, failed, in_flight_ids, in_flight, 2)
+    assert in_flight_ids == {'us-east-1': ['snap-new']}
+    assert in_flight == {'us-east-1': 2}
+    poller.requeue_snapshot.assert_called_once_with(  # pylint: disable=E1103
+        ctx, 'us-east-1', {'SnapshotId': 'snap-failed1'})
+
+    # one given up on takes no slot
+    poller.requeue_snapshot.return_value = None  # pylint: disable=E1103
+    in_flight = {}
+    replication.requeue_failed_copies(ctx, failed, {}, in_flight, 2)
+    assert in_flight == {}
+
+
+def test_schedule_replication_copies():
+    """Test for method of the same name."""
+    now = datetime.now(dateutil.tz.tzutc())
+
+    def candidate(snapshot_id, size, hours_old, region='us-east-1', priority=None, rpo=None):
+        """Build a copy candidate like perform_replication does"""
+        tags = [{'Key': 'replication_dst_region', 'Value': region}]
+        if priority is not None:
+            tags.append({'Key': 'replication_priority', 'Value': str(priority)})
+        if rpo is not None:
+            tags.append({'Key': 'replication_rpo', 'Value': rpo})
+
+        return {
+            'snapshot': {'SnapshotId': snapshot_id, 'VolumeSize': size, 'Tags': tags,
+                         'StartTime': now - timedelta(hours=hours_old)},
+            'region': region,
+            'name': None
+        }
+
+    candidates = [
+        candidate('snap-huge', 4000, 10),
+        candidate('snap-small', 8, 1),
+        candidate('snap-medium', 100, 5),
+    ]
+    settings = replication.get_replication_settings([])
+    assert settings['policy'] == 'fifo'
+
+    def scheduled_ids(settings, in_flight=None, cands=None):
+        """Return just the snapshot ids of what was scheduled"""
+        results = replication.schedule_replication_copies(
+            cands or candidates, settings, in_flight, now=now)
+        return [c['snapshot']['SnapshotId'] for c in results]
+
+    # fifo is oldest first, and all three fit in the default slots
+    assert scheduled_ids(settings) == ['snap-huge', 'snap-medium', 'snap-small']
+
+    # small first, and in-flight copies use up slots in the destination
+    settings = replication.get_replication_settings([{'replication_policy': 'small_first'}])
+    assert scheduled_ids(settings) == ['snap-small', 'snap-medium', 'snap-huge']
+    assert scheduled_ids(settings, in_flight={'us-east-1': 4}) == ['snap-small']
+
+    # a GiB budget skips the huge one, but keeps filling with ones that fit
+    settings = replication.get_replication_settings([
+        {'replication_policy': 'fifo', 'replication_max_gib': 200}])
+    assert scheduled_ids(settings) == ['snap-medium', 'snap-small']
+
+    # with a tight RPO, the oldest is closest to (or past) its deadline
+    settings = replication.get_replication_settings([
+        {'replication_policy': 'rpo_deadline', 'replication_rpo': '6 hours'}])
+    assert scheduled_ids(settings) == ['snap-huge', 'snap-medium', 'snap-small']
+
+    # a configuration's own RPO, stamped on its snapshots, sets their deadline
+    urgent = candidates + [candidate('snap-urgent', 50, 0.5, rpo='1 hour')]
+    settings = replication.get_replication_settings([{'replication_policy': 'rpo_deadline'}])
+    assert scheduled_ids(settings, cands=urgent)[0] == 'snap-urgent'
+
+    # age is weighed against size, so the medium one waited long enough to go first
+    settings = replication.get_replication_settings([{'replication_policy': 'age_weighted'}])
+    assert scheduled_ids(settings) == ['snap-medium', 'snap-small', 'snap-huge']
+
+    # priority beats the policy, slots are counted per destination region
+    prioritized = candidates + [candidate('snap-vip', 9000, 0, priority=10),
+                                candidate('snap-west', 9000, 0, region='us-west-2')]
+    settings = replication.get_replication_settings([
+        {'replication_policy': 'small_first', 'replication_copy_slots': 1}])
+    assert scheduled_ids(settings, cands=prioritized) == ['snap-vip', 'snap-west']
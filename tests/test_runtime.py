@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2016 Rackspace US, Inc.
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+"""Module for testing runtime module."""
+
+import threading
+import time
+import pytest
+from ebs_snapper import runtime
+
+
+def test_map():
+    """Test for method of the same name."""
+    state = runtime.RuntimeState()
+    assert state.map(lambda x: x * 2, [], 4) == []
+    assert state.map(lambda x: x * 2, [1, 2, 3], 1) == [2, 4, 6]
+    assert state.map(lambda x: x * 2, range(20), 4) == [x * 2 for x in range(20)]
+
+    # never more than workers at once, even though the pool is bigger
+    lock = threading.Lock()
+    running = [0, 0]  # now, most
+
+    def work(x):
+        """Track how many of us are running"""
+        with lock:
+            running[0] += 1
+            running[1] = max(running)
+        time.sleep(0.01)
+        with lock:
+            running[0] -= 1
+        return x
+
+    assert state.map(work, range(12), 3) == range(12)
+    assert running[1] <= 3
+
+    # the pool is kept for next time
+    pool = state.pool
+    state.map(work, range(4), 2)
+    assert state.pool is pool
+
+    with pytest.raises(ValueError):
+        state.map(lambda x: int(x), ['1', 'two'], 2)
+
+
+def test_reset():
+    """Test for method of the same name."""
+    state = runtime.RuntimeState()
+    state.clients['x'] = 'client'
+    state.discovered['y'] = (0, 'value')
+    state.configurations['z'] = (0, 'version', [])
+    state.compiled['w'] = 'compiled'
+    state.map(lambda x: x, [1, 2], 2)
+
+    state.reset()
+    assert state.clients == {}
+    assert state.discovered == {}
+    assert state.configurations == {}
+    assert state.compiled == {}
+    assert state.pool is None
+
+    # and still works after
+    assert state.map(lambda x: x + 1, [1, 2], 2) == [2, 3]
@@ -22,11 +22,12 @@
 """Module for testing snapshot module."""
 
 import datetime
+import json
 import dateutil
 import boto3
 from moto import mock_ec2, mock_sns, mock_dynamodb2, mock_sts, mock_iam
 from moto import mock_events, mock_cloudformation
-from ebs_snapper import snapshot, dynamo, utils, mocks
+from ebs_snapper import snapshot, dynamo, regional, utils, mocks
 from ebs_snapper import AWS_MOCK_ACCOUNT
 from crontab import CronTab
 
@@ -79,16 +80,49 @@ def test_perform_fanout_all_regions_snapshot(mocker):
 
     # patch the final message sender method
     ctx = utils.MockContext()
-    mocker.patch('ebs_snapper.snapshot.send_fanout_message')
+    mocker.patch('ebs_snapper.utils.sns_publish')
     snapshot.perform_fanout_all_regions(ctx)
 
     # fan out, and be sure we touched every instance we created before
-    for r in dummy_regions:
-        snapshot.send_fanout_message.assert_any_call(
-            context=ctx,
-            region=r,
-            sns_topic=expected_sns_topic,
-            cli=False)  # pylint: disable=E1103
+    sent = utils.sns_publish.call_args_list  # pylint: disable=E1103
+    assert set((c[1]['TopicArn'], c[1]['Region']) for c in sent) == \
+        set([(expected_sns_topic, 'us-east-1')])
+
+    # every region gets a message, carrying the configurations along
+    messages = [json.loads(c[1]['Message']) for c in sent]
+    assert set(dummy_regions) <= set(m['region'] for m in messages)
+    for m in messages:
+        assert m['configuration']['configurations'] == [config_data]
+
+
+@mock_ec2
+@mock_dynamodb2
+@mock_sns
+@mock_iam
+@mock_sts
+def test_perform_fanout_targeted_regions(mocker):
+    """Test that regions no configuration applies in don't get a message."""
+    mocks.create_sns_topic('CreateSnapshotTopic')
+    for dummy_region in ['us-west-2', 'us-east-1']:
+        mocks.create_instances(region=dummy_region)
+
+    mocks.create_dynamodb('us-east-1')
+    config_data = {
+        "match": {"tag:backup": "yes"},
+        "snapshot": {"retention": "3 days", "minimum": 4, "frequency": "11 hours"},
+        "regions": ["us-west-*"]
+    }
+    dynamo.store_configuration('us-east-1', 'west_only', AWS_MOCK_ACCOUNT, config_data)
+
+    mocker.patch('ebs_snapper.utils.sns_publish')
+    mocker.spy(regional, 'region_contains_instances')
+    snapshot.perform_fanout_all_regions(utils.MockContext())
+
+    sent = utils.sns_publish.call_args_list  # pylint: disable=E1103
+    assert [json.loads(c[1]['Message'])['region'] for c in sent] == ['us-west-2']
+    calls = regional.region_contains_instances.call_args_list  # pylint: disable=E1103
+    probed = [c[0][0] for c in calls]
+    assert all(r.startswith('us-west-') for r in probed)
 
 
 @mock_ec2
@@ -145,7 +179,7 @@ def test_perform_snapshot(mocker):
     ]
 
     # patch the final method that takes a snapshot
-    mocker.patch('ebs_snapper.utils.snapshot_and_tag')
+    mocker.patch('ebs_snapper.utils.snapshot_and_tag', return_value=None)
 
     # since there are no snapshots, we should expect this to trigger one
     ctx = utils.MockContext()
@@ -195,7 +229,7 @@ def test_perform_snapshot_skipped(mocker):
     utils.snapshot_and_tag(instance_id, 'ami-123abc', volume_id, delete_on, region)
 
     # patch the final method that takes a snapshot
-    mocker.patch('ebs_snapper.utils.snapshot_and_tag')
+    mocker.patch('ebs_snapper.utils.snapshot_and_tag', return_value=None)
 
     # since there are no snapshots, we should expect this to trigger one
     ctx = utils.MockContext()
@@ -273,7 +307,7 @@ def test_perform_snapshot_ignore_instance(mocker):
     dynamo.store_configuration('us-east-1', 'some_unique_id', AWS_MOCK_ACCOUNT, snapshot_settings)
 
     # patch the final method that takes a snapshot
-    mocker.patch('ebs_snapper.utils.snapshot_and_tag')
+    mocker.patch('ebs_snapper.utils.snapshot_and_tag', return_value=None)
 
     # since there are no snapshots, we should expect this to trigger one
     ctx = utils.MockContext()
@@ -313,7 +347,7 @@ def test_perform_snapshot_ignore_volume(mocker):
     snapshot_settings['ignore'].append(volume_id)
 
     # patch the final method that takes a snapshot
-    mocker.patch('ebs_snapper.utils.snapshot_and_tag')
+    mocker.patch('ebs_snapper.utils.snapshot_and_tag', return_value=None)
 
     # since there are no snapshots, we should expect this to trigger one
     ctx = utils.MockContext()
@@ -321,3 +355,55 @@ def test_perform_snapshot_ignore_volume(mocker):
 
     # test results
     utils.snapshot_and_tag.assert_not_called()  # pylint: disable=E1103
+
+
+def test_snapshot_admission():
+    """Test for class of the same name."""
+    cached_snapshots = [
+        {'SnapshotId': 'snap-1', 'VolumeId': 'vol-busy', 'State': 'pending'},
+        {'SnapshotId': 'snap-2', 'VolumeId': 'vol-idle', 'State': 'completed'},
+        {'SnapshotId': 'snap-3', 'VolumeId': 'vol-other', 'State': 'pending'},
+    ]
+    admission = snapshot.SnapshotAdmission(cached_snapshots, region_limit=4)
+    assert admission.region_pending == 2
+
+    # a volume with a pending snapshot is skipped, others are admitted
+    assert not admission.admit('vol-busy')
+    assert admission.admit('vol-idle')
+
+    # and once admitted, it counts as pending itself
+    assert not admission.admit('vol-idle')
+
+    # until the region runs out of budget
+    assert admission.admit('vol-new1')
+    assert not admission.admit('vol-new2')
+    assert admission.deferred == 3
+    assert admission.remaining() == 0
+
+
+@mock_ec2
+@mock_dynamodb2
+@mock_sns
+@mock_iam
+@mock_sts
+def test_perform_snapshot_not_admitted(mocker):
+    """Test that due snapshots roll over when the pending budget is used up"""
+    region = 'us-west-2'
+    snapshot_settings = {
+        'snapshot': {'minimum': 5, 'frequency': '2 hours', 'retention': '5 days'},
+        'match': {'tag:backup': 'yes'},
+        'snapshot_pending_limit': 1
+    }
+
+    # two instances that are due, but only room for one more pending snapshot
+    instance_ids = mocks.create_instances(region, count=2)
+    client = boto3.client('ec2', region_name=region)
+    client.create_tags(Resources=instance_ids, Tags=[{'Key': 'backup', 'Value': 'yes'}])
+
+    mocks.create_dynamodb('us-east-1')
+    dynamo.store_configuration('us-east-1', 'some_unique_id', AWS_MOCK_ACCOUNT, snapshot_settings)
+
+    mocker.patch('ebs_snapper.utils.snapshot_and_tag', return_value=None)
+    ctx = utils.MockContext()
+    snapshot.perform_snapshot(ctx, region)
+    assert utils.snapshot_and_tag.call_count == 1  # pylint: disable=E1103
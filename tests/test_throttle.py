@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2016 Rackspace US, Inc.
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+"""Module for testing throttle module."""
+
+import threading
+import boto3
+import pytest
+from botocore.exceptions import ClientError
+from moto import mock_ec2
+from ebs_snapper import throttle
+
+
+class FakeClock(object):
+    """A clock that only moves when something sleeps on it"""
+
+    def __init__(self):
+        self.now = 0.0
+        self.slept = []
+
+    def time(self):
+        """Return the fake time"""
+        return self.now
+
+    def sleep(self, seconds):
+        """Advance the fake time"""
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+def test_token_bucket():
+    """Test for class of the same name."""
+    clock = FakeClock()
+    bucket = throttle.TokenBucket(2, 3, clock=clock)
+
+    # the burst is free
+    for _ in range(3):
+        bucket.acquire()
+    assert clock.slept == []
+
+    # then we wait for the refill, at 2 per second
+    bucket.acquire()
+    assert clock.slept == [0.5]
+
+    # slowing down the bucket makes us wait longer
+    bucket.set_rate(1)
+    bucket.acquire()
+    assert clock.slept == [0.5, 1.0]
+
+
+def test_token_bucket_threads():
+    """Test that the bucket can be shared by a pool of threads"""
+    clock = FakeClock()
+    bucket = throttle.TokenBucket(1000, 10, clock=clock)
+    threads = [threading.Thread(target=bucket.acquire) for _ in range(20)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    # the first ten ride the burst, the rest had to wait for ten more to refill
+    assert bucket.tokens < 1
+    assert clock.now >= 10 / 1000.0 - throttle.TOKEN_EPSILON
+
+
+def test_operation_class():
+    """Test for method of the same name."""
+    assert throttle.operation_class('DescribeSnapshots') == 'read'
+    assert throttle.operation_class('ListTopics') == 'read'
+    assert throttle.operation_class('CopySnapshot') == 'copy'
+    assert throttle.operation_class('Publish') == 'publish'
+    assert throttle.operation_class('CreateSnapshot') == 'write'
+    assert throttle.operation_class('DeleteSnapshot') == 'write'
+
+
+def test_get_rate(monkeypatch):
+    """Test configuration, environment and default rate lookups"""
+    assert throttle.parse_rate('5') == (5.0, 5.0)
+    assert throttle.parse_rate('5,10') == (5.0, 10.0)
+    assert throttle.parse_rate([0.5]) == (0.5, 1.0)
+    for bad in ['0', '-1', '5,0']:
+        with pytest.raises(ValueError):
+            throttle.parse_rate(bad)
+
+    assert throttle.get_rate('ec2', 'write') == throttle.DEFAULT_RATES['write']
+
+    monkeypatch.setenv('EBS_SNAPPER_RATE_WRITE', '0')
+    assert throttle.get_rate('ec2', 'write') == throttle.DEFAULT_RATES['write']
+
+    monkeypatch.setenv('EBS_SNAPPER_RATE_WRITE', '3')
+    assert throttle.get_rate('ec2', 'write') == (3.0, 3.0)
+
+    monkeypatch.setenv('EBS_SNAPPER_RATE_EC2_WRITE', '4,8')
+    assert throttle.get_rate('ec2', 'write') == (4.0, 8.0)
+    assert throttle.get_rate('sns', 'write') == (3.0, 3.0)
+
+    # configuration wins over the environment, and applies to existing buckets
+    bucket = throttle.get_bucket('ec2', 'us-test-1', 'write')
+    throttle.configure({'ec2:write': '6,12'})
+    assert throttle.get_rate('ec2', 'write') == (6.0, 12.0)
+    assert bucket.rate == 6.0
+
+    throttle.configure(None)
+    monkeypatch.delenv('EBS_SNAPPER_RATE_WRITE')
+    monkeypatch.delenv('EBS_SNAPPER_RATE_EC2_WRITE')
+    throttle.configure(None)
+    assert bucket.rate == throttle.DEFAULT_RATES['write'][0]
+
+
+def test_configure_keeps_backoff():
+    """Test that configuring again doesn't undo a bucket's backoff"""
+    bucket = throttle.get_bucket('ec2', 'us-test-2', 'copy')
+    bucket.throttled()
+    assert bucket.health() == 0.5
+
+    # every region configures again, usually to the same rates
+    throttle.configure(None)
+    assert bucket.health() == 0.5
+
+    # a new rate keeps the same share of it
+    throttle.configure({'ec2:copy': '4,8'})
+    assert (bucket.rate, bucket.burst, bucket.health()) == (2.0, 8.0, 0.5)
+
+    throttle.configure(None)
+    assert bucket.rate == throttle.DEFAULT_RATES['copy'][0] * 0.5
+
+
+@mock_ec2
+def test_install(mocker):
+    """Test that clients from the default session are paced"""
+    throttle.install()
+    mocker.patch('ebs_snapper.throttle.acquire')
+
+    client = boto3.client('ec2', region_name='us-west-2')
+    client.describe_snapshots(MaxResults=5)
+    throttle.acquire.assert_any_call(  # pylint: disable=E1103
+        'ec2', 'us-west-2', 'DescribeSnapshots')
+
+
+def test_token_bucket_adaptive():
+    """Test that buckets slow down when throttled, and recover on success"""
+    bucket = throttle.TokenBucket(10, 10, clock=FakeClock())
+    assert bucket.health() == 1.0
+
+    bucket.throttled()
+    assert bucket.rate == 5.0
+    bucket.throttled()
+    assert bucket.rate == 2.5
+
+    # never below the floor
+    for _ in range(20):
+        bucket.throttled()
+    assert bucket.rate == 10 * throttle.MIN_RATE_FRACTION
+
+    # and back up to (but not past) the configured rate
+    for _ in range(40):
+        bucket.succeeded()
+    assert bucket.rate == 10.0
+
+
+def test_classify_error():
+    """Test for method of the same name."""
+    def client_error(code):
+        """Build a ClientError with a code"""
+        return ClientError({'Error': {'Code': code, 'Message': code}}, 'CopySnapshot')
+
+    assert throttle.classify_error(client_error('RequestLimitExceeded')) == 'throttling'
+    assert throttle.classify_error(client_error('ResourceLimitExceeded')) == 'capacity'
+    assert throttle.classify_error(client_error('InternalError')) == 'transient'
+    assert throttle.classify_error(client_error('InvalidSnapshot.NotFound')) is None
+    assert throttle.classify_error(ValueError('nope')) is None
+
+
+def test_backoff_delay():
+    """Test for method of the same name."""
+    for attempt in range(1, 10):
+        delay = throttle.backoff_delay('throttling', attempt)
+        assert 0 <= delay <= min(throttle.RETRY_MAX_DELAY, 2 ** (attempt - 1))
+
+
+def test_needs_retry_and_worker_count(mocker):
+    """Test the botocore retry handler, and that throttling shrinks worker pools"""
+    operation = mocker.MagicMock()
+    operation.name = 'DescribeSnapshots'
+    operation.service_model.service_name = 'ec2'
+    request_dict = {'context': {'client_region': 'us-retry-1'}}
+
+    def response(status, code=None):
+        """Build a botocore (http_response, parsed) tuple"""
+        http_response = mocker.MagicMock()
+        http_response.status_code = status
+        parsed = {'Error': {'Code': code}} if code else {}
+        return (http_response, parsed)
+
+    # success, or errors that won't get better, are not retried
+    assert throttle._needs_retry(  # pylint: disable=protected-access
+        response(200), operation, 1, None, request_dict) is None
+    assert throttle._needs_retry(  # pylint: disable=protected-access
+        response(400, 'InvalidParameterValue'), operation, 1, None, request_dict) is None
+
+    # throttling is retried, and slows down everyone using that region
+    assert throttle.worker_count('ec2', 'us-retry-1', 4) == 4
+    assert throttle._needs_retry(  # pylint: disable=protected-access
+        response(400, 'RequestLimitExceeded'), operation, 1, None, request_dict) is not None
+    assert throttle.worker_count('ec2', 'us-retry-1', 4) == 2
+
+    # 500s and connection errors are retried, until we run out of attempts
+    assert throttle._needs_retry(  # pylint: disable=protected-access
+        response(503), operation, 1, None, request_dict) is not None
+    assert throttle._needs_retry(  # pylint: disable=protected-access
+        None, operation, 1, IOError('reset'), request_dict) is not None
+    assert throttle._needs_retry(  # pylint: disable=protected-access
+        response(503), operation, throttle.RETRY_ATTEMPTS['transient'], None,
+        request_dict) is None
@@ -49,86 +49,6 @@ def test_get_owner_id():
     assert [AWS_MOCK_ACCOUNT] == utils.get_owner_id(utils.MockContext())
 
 
-@mock_ec2
-@mock_iam
-@mock_sts
-def test_get_regions_with_instances_or_snapshots():
-    """Test for method of the same name."""
-    client_uswest2 = boto3.client('ec2', region_name='us-west-2')
-
-    # toss an instance in us-west-2
-    client_uswest2.run_instances(ImageId='ami-123abc', MinCount=1, MaxCount=5)
-
-    # be sure we get us-west-2 *only*
-    assert ['us-west-2'] == utils.get_regions(
-        must_contain_instances=True,
-        must_contain_snapshots=False)
-
-    # now say we don't filter by instances, be sure we get a lot of regions
-    found_regions = utils.get_regions(
-        must_contain_instances=False,
-        must_contain_snapshots=False)
-    expected_regions = ['eu-west-1', 'sa-east-1', 'us-east-1',
-                        'ap-northeast-1', 'us-west-2', 'us-west-1']
-    for expected_region in expected_regions:
-        assert expected_region in found_regions
-
-    # now take a snapshot
-    client_uswest1 = boto3.client('ec2', region_name='us-west-1')
-    volume_results = client_uswest1.create_volume(Size=100, AvailabilityZone='us-west-1a')
-    client_uswest1.create_snapshot(VolumeId=volume_results['VolumeId'])
-
-    # be sure that snapshot filter works and only returns the snapshot region
-    assert ['us-west-1'] == utils.get_regions(
-        must_contain_instances=False,
-        must_contain_snapshots=True)
-
-    # now filter by both, should be nothing returned
-    found_regions = utils.get_regions(must_contain_instances=True, must_contain_snapshots=True)
-    assert len(found_regions) == 0
-
-    # now snap in us-west-2 where we have an instance as well
-    volume_results2 = client_uswest2.create_volume(Size=100, AvailabilityZone='us-west-2a')
-    client_uswest2.create_snapshot(VolumeId=volume_results2['VolumeId'])
-    found_regions = utils.get_regions(must_contain_instances=True, must_contain_snapshots=True)
-    assert found_regions == ['us-west-2']
-
-
-@mock_ec2
-@mock_iam
-@mock_sts
-def test_region_contains_instances():
-    """Test for method of the same name."""
-    client = boto3.client('ec2', region_name='us-west-2')
-
-    # toss an instance in us-west-2
-    client.run_instances(ImageId='ami-123abc', MinCount=1, MaxCount=5)
-
-    # be sure we get us-west-2
-    assert utils.region_contains_instances('us-west-2')
-
-    # be sure we don't get us-east-1
-    assert not utils.region_contains_instances('us-east-1')
-
-
-@mock_ec2
-@mock_iam
-@mock_sts
-def test_region_contains_snapshots():
-    """Test for method of the same name."""
-    client = boto3.client('ec2', region_name='us-west-2')
-
-    # toss a volume in us-west-2 and snapshot it
-    volume_results = client.create_volume(Size=100, AvailabilityZone='us-west-1a')
-    client.create_snapshot(VolumeId=volume_results['VolumeId'])
-
-    # be sure we get us-west-2
-    assert utils.region_contains_snapshots('us-west-2')
-
-    # be sure we don't get us-east-1
-    assert not utils.region_contains_snapshots('us-east-1')
-
-
 @mock_ec2
 @mock_sns
 @mock_iam
@@ -347,3 +267,72 @@ def test_build_replication_cache():
     cache2 = utils.build_replication_cache(context, tags, configurations, region, installed_region)
     assert cache2['replication_src_region'][0]['SnapshotId'] == src_snapshot['SnapshotId']
     assert cache2['replication_dst_region'][0]['SnapshotId'] == dst_snapshot['SnapshotId']
+
+
+@mock_ec2
+@mock_iam
+@mock_sts
+def test_delete_snapshot():
+    """Test that snapshots already gone are okay to delete"""
+    region = 'us-west-2'
+    client = boto3.client('ec2', region_name=region)
+    volume = client.create_volume(Size=100, AvailabilityZone=region + 'a')
+    snapshot_id = client.create_snapshot(VolumeId=volume['VolumeId'])['SnapshotId']
+
+    assert utils.delete_snapshot(snapshot_id, region) == 1
+    assert utils.delete_snapshot(snapshot_id, region) == 0
+
+
+@mock_sns
+def test_get_topic_arn_cached(mocker, monkeypatch):
+    """Test that topic ARNs come from the environment, or are looked up only once"""
+    mocks.create_sns_topic('CachedTopic', region_name='us-west-2')
+    mocker.spy(utils, 'find_topic_arn')
+
+    found_arn = utils.get_topic_arn('CachedTopic', default_region='us-west-2')
+    assert utils.get_topic_arn('CachedTopic', default_region='us-west-2') == found_arn
+    assert utils.find_topic_arn.call_count == 1  # pylint: disable=E1103
+
+    monkeypatch.setenv('EBS_SNAPPER_TOPIC_ARN_CACHEDTOPIC', 'arn:from:the:environment')
+    assert utils.get_topic_arn('CachedTopic', default_region='us-west-2') == \
+        'arn:from:the:environment'
+
+
+def test_map_concurrently():
+    """Test for method of the same name."""
+    items = range(20)
+    assert utils.map_concurrently(lambda x: x * 2, items, 4) == [x * 2 for x in items]
+    assert utils.map_concurrently(lambda x: x * 2, items, 1) == [x * 2 for x in items]
+    assert utils.map_concurrently(lambda x: x * 2, [], 4) == []
+
+
+def test_deadline_share_context():
+    """Test for class of the same name."""
+    ctx = utils.MockContext()
+    ctx.set_remaining_time_in_millis(300000)
+
+    # half of the 4 minutes beyond the 1 minute margin
+    share = utils.DeadlineShareContext(ctx, 0.5)
+    assert 170000 <= share.get_remaining_time_in_millis() <= 180000
+    assert utils.get_owner_id(share) == utils.get_owner_id(ctx)
+
+    # never more than the whole invocation has left
+    ctx.set_remaining_time_in_millis(1000)
+    assert share.get_remaining_time_in_millis() <= 1000
+
+
+def test_compile_snapshot_settings():
+    """Test for method of the same name."""
+    snapshot_settings = {
+        'snapshot': {'minimum': 5, 'frequency': '30 * * * *', 'retention': '5 days'},
+        'match': {'tag:backup': 'yes'}
+    }
+    first = utils.compile_snapshot_settings(snapshot_settings)
+    assert first[0] == timedelta(5)
+
+    # the same settings, even from another copy of the configuration, aren't parsed again
+    assert utils.compile_snapshot_settings(dict(snapshot_settings)) is first
+
+    changed = dict(snapshot_settings, snapshot={'minimum': 5, 'frequency': '1 hour',
+                                                'retention': '5 days'})
+    assert utils.compile_snapshot_settings(changed)[1] == timedelta(0, 3600)
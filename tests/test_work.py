@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2016 Rackspace US, Inc.
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+"""Module for testing work module."""
+
+import json
+import boto3
+import pytest
+from moto import mock_ec2, mock_sqs, mock_iam, mock_sts
+from ebs_snapper import work, clients, utils
+
+
+def test_get_work_queue_url(monkeypatch):
+    """Test for method of the same name."""
+    assert work.get_work_queue_url([]) is None
+    assert work.get_work_queue_url([{'work_queue_url': 'https://queue'}]) is None
+    assert work.get_work_queue_url([{'work_item_mode': 'queue',
+                                     'work_queue_url': 'https://queue'}]) == 'https://queue'
+
+    # falls back to the queue the template made, or inline if there isn't one
+    assert work.get_work_queue_url([{'work_item_mode': 'queue'}]) is None
+    monkeypatch.setenv(work.WORK_QUEUE_ENV, 'https://template-queue')
+    assert work.get_work_queue_url([{'work_item_mode': 'queue'}]) == 'https://template-queue'
+
+
+def test_work_queue_inline(mocker):
+    """Test that inline work is done right away, like it always was"""
+    mocker.patch('ebs_snapper.utils.delete_snapshot', return_value=1)
+    queue = work.WorkQueue(utils.MockContext(), [])
+
+    assert queue.submit(work.delete_item('snap-1234', 'us-east-1')) == 1
+    utils.delete_snapshot.assert_called_once_with(  # pylint: disable=E1103
+        'snap-1234', 'us-east-1')
+    assert queue.queued == 0
+
+
+@mock_sqs
+def test_work_queue_queued(mocker):
+    """Test that queued work is sent in batches, and not done here"""
+    mocker.patch('ebs_snapper.utils.delete_snapshot')
+    client = boto3.client('sqs', region_name='us-east-1')
+    queue_url = client.create_queue(QueueName='work-queue')['QueueUrl']
+    configurations = [{'work_item_mode': 'queue', 'work_queue_url': queue_url}]
+
+    queue = work.WorkQueue(utils.MockContext(), configurations)
+    for i in range(15):
+        assert queue.submit(work.delete_item('snap-{}'.format(i), 'us-east-1')) is None
+    queue.flush()
+
+    assert queue.queued == 15
+    utils.delete_snapshot.assert_not_called()  # pylint: disable=E1103
+
+
+@mock_ec2
+@mock_iam
+@mock_sts
+def test_perform_work_item_idempotent(mocker):
+    """Test that a snapshot work item done twice only makes one snapshot"""
+    region = 'us-west-2'
+    client = boto3.client('ec2', region_name=region)
+    volume = client.create_volume(Size=100, AvailabilityZone=region + 'a')
+    item = work.snapshot_item('i-1234', 'ami-123abc', volume['VolumeId'], '2030-01-01', region)
+    mocker.spy(utils, 'snapshot_and_tag')
+
+    first = work.perform_work_item(utils.MockContext(), item)
+    second = work.perform_work_item(utils.MockContext(), item)
+
+    assert first == second
+    assert utils.snapshot_and_tag.call_count == 1  # pylint: disable=E1103
+
+
+def test_perform_work_records(mocker):
+    """Test that one failed item doesn't fail (or repeat) the others"""
+    records = [
+        {'body': json.dumps(work.delete_item('snap-ok', 'us-east-1')),
+         'receiptHandle': 'handle-ok',
+         'eventSourceARN': 'arn:aws:sqs:eu-west-1:123456789012:WorkItemQueue'},
+        {'body': json.dumps({'type': 'nonsense'}), 'receiptHandle': 'handle-bad'},
+    ]
+    mocker.patch('ebs_snapper.utils.delete_snapshot', return_value=1)
+    sqs = mocker.patch('ebs_snapper.clients.get_client').return_value
+
+    with pytest.raises(Exception):
+        work.perform_work_records(utils.MockContext(), records, queue_url='https://queue')
+
+    utils.delete_snapshot.assert_called_once_with(  # pylint: disable=E1103
+        'snap-ok', 'us-east-1')
+    sqs.delete_message_batch.assert_called_once_with(
+        QueueUrl='https://queue', Entries=[{'Id': '0', 'ReceiptHandle': 'handle-ok'}])
+
+    # the queue is where the records came from
+    clients.get_client.assert_called_with('sqs', 'eu-west-1')  # pylint: disable=E1103
+    assert work.record_region({'awsRegion': 'us-west-2'}) == 'us-west-2'
+    assert work.record_region({}, 'ap-south-1') == 'ap-south-1'